@@ -0,0 +1,278 @@
+import time
+import asyncio
+
+from typing import Optional, Dict, Set
+
+from EntityLoader import LoadContext, LoadResult
+from StateMachine import State, StateMachine, host_of
+
+
+class AsyncLoadContextManager:
+    async def next(self) -> Optional[LoadContext]:
+        raise NotImplemented()
+
+    async def release(self):
+        """
+        returns objects fetched, but not handed out by next() yet, and persists buffered changes,
+        is called when load_many finishes
+        """
+        pass
+
+
+class AsyncLoadBehaviour:
+
+    async def load(self, obj: LoadContext) -> Optional[LoadResult]:
+        raise NotImplemented()
+
+    async def pre_load(self, obj: LoadContext):
+        """
+        represents preprocessing logic
+        this method is called before load() method call
+        :param obj: context of current load operation
+        :return:
+        """
+        raise NotImplemented()
+
+    async def handle_error(self, load_context: LoadContext, load_result: LoadResult, error_text: str):
+        """
+        represent handler of unexpected errors
+        this method is called after load_context.LoadObject's state was changed by StateMachine
+        :param load_context: context of current load operation
+        :param load_result: result (if exists) of current load operation
+        :param error_text: string-represented information about error
+        :return:
+        """
+        raise NotImplemented()
+
+    async def post_load(self, load_result: LoadResult):
+        """
+        represents pos-processing logic
+        this method is called after load() method call
+        :param load_result:
+        :return:
+        """
+        raise NotImplemented()
+
+
+class AsyncHostLimiter:
+    """
+    limits simultaneous loads of every host of AsyncEntityLoader, all calls are made on event loop thread
+    """
+    async def acquire(self, host: str):
+        """
+        waits until host may get one more simultaneous load
+        :param host: host of loaded object, '' for objects without host
+        """
+        raise NotImplemented()
+
+    def release(self, host: str, duration: Optional[float], load_result: Optional[LoadResult], error: Optional[Exception]):
+        """
+        is called once per acquire(), when load is finished
+        :param host: host of loaded object
+        :param duration: duration of AsyncLoadBehaviour.load() in seconds, None if it was not called
+        :param load_result: result of load, None if load failed
+        :param error: exception raised during load, None if load finished without exception
+        """
+        raise NotImplemented()
+
+
+class _LoadOutcome(object):
+    __slots__ = ('duration', 'load_result', 'error')
+
+    def __init__(self):
+        self.duration = None  # type: Optional[float]
+        self.load_result = None  # type: Optional[LoadResult]
+        self.error = None  # type: Optional[Exception]
+
+
+class AsyncEntityLoader:
+    """
+    asynchronous counterpart of EntityLoader, keeping up to max_in_flight loads at once
+    objects are switched to processing one by one on event loop thread,
+    so the same object is never handed out twice by AsyncLoadContextManager.next()
+    """
+    def __init__(
+        self,
+        load_context_manager: AsyncLoadContextManager,
+        load_behaviour: AsyncLoadBehaviour,
+        state_machine: StateMachine,
+        max_in_flight: int = 16,
+        max_in_flight_per_host: Optional[int] = 4,
+        host_limiter: Optional[AsyncHostLimiter] = None,
+        retry_delay_ms: int = 50,
+        max_retry_delay_ms: int = 5000
+    ):
+        """
+
+        :param load_context_manager: implementation of AsyncLoadContextManager
+        :param load_behaviour: implementation of AsyncLoadBehaviour
+        :param state_machine: implementation of StateMachine
+        :param max_in_flight: global limit of simultaneous loads
+        :param max_in_flight_per_host: limit of simultaneous loads per host, None - no limit
+        :param host_limiter: adaptive limits of simultaneous loads per host (e.g. AimdHostLimiter),
+                             replaces max_in_flight_per_host
+        :param retry_delay_ms: pause of load_many after the first failed switch to processing state,
+                               doubled by every next failure in a row
+        :param max_retry_delay_ms: the longest pause after failed switch to processing state
+        """
+        assert load_context_manager
+        assert load_behaviour
+        assert state_machine
+        assert max_in_flight > 0
+        assert max_in_flight_per_host is None or max_in_flight_per_host > 0
+        assert 0 < retry_delay_ms <= max_retry_delay_ms
+
+        self.__load_context_manager = load_context_manager
+        self.__load_behaviour = load_behaviour
+        self.__state_machine = state_machine
+        self.__max_in_flight = max_in_flight  # type: int
+        self.__max_in_flight_per_host = max_in_flight_per_host  # type: Optional[int]
+        self.__host_semaphores = {}  # type: Dict[str, asyncio.Semaphore]
+        self.__host_limiter = host_limiter  # type: Optional[AsyncHostLimiter]
+        self.__retry_delay = retry_delay_ms / 1000.0  # type: float
+        self.__max_retry_delay = max_retry_delay_ms / 1000.0  # type: float
+
+    async def load(self) -> Optional[LoadResult]:
+        """
+        load next unloaded object
+        :return: result of load operation
+        """
+        load_context = await self.__load_context_manager.next()
+
+        if not load_context:
+            return None
+
+        try:
+            if not self.__to_processing(load_context):
+                return None
+        except Exception as e:
+            print(str(e))
+            return None
+
+        return await self.__load(load_context)
+
+    async def load_many(self, count: Optional[int] = None) -> int:
+        """
+        load objects from AsyncLoadContextManager.next() keeping up to max_in_flight loads at once,
+        then AsyncLoadContextManager.release() returns fetched, but not loaded objects
+        :param count: maximum count of objects to load, None - until manager has no more objects
+        :return: count of started loads
+        """
+        in_flight = asyncio.Semaphore(self.__max_in_flight)
+        tasks = set()  # type: Set[asyncio.Future]
+        started = 0
+        failures = 0
+
+        try:
+            while count is None or started < count:
+                await in_flight.acquire()
+
+                load_context = await self.__load_context_manager.next()
+                if not load_context:
+                    in_flight.release()
+                    break
+
+                try:
+                    to_processing = self.__to_processing(load_context)
+                except Exception as e:
+                    print(str(e))
+                    in_flight.release()
+                    # manager hands out the same object again, storage gets time to recover
+                    failures += 1
+                    await asyncio.sleep(min(self.__retry_delay * 2 ** (failures - 1), self.__max_retry_delay))
+                    continue
+                failures = 0
+
+                if not to_processing:
+                    in_flight.release()
+                    continue
+
+                started += 1
+                task = asyncio.ensure_future(self.__load(load_context))
+                task.add_done_callback(lambda _: in_flight.release())
+                task.add_done_callback(tasks.discard)
+                tasks.add(task)
+
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            await self.__load_context_manager.release()
+
+        return started
+
+    def __to_processing(self, load_context: LoadContext) -> bool:
+        # objects claimed by AsyncLoadContextManager are already in processing state
+        if load_context.LoadObject.state == State.PROCESSING:
+            return True
+
+        load_object = self.__state_machine.to_processing(load_context.LoadObject)
+        if load_object is None:
+            # object was taken by somebody else
+            return False
+        load_context.LoadObject = load_object
+        return True
+
+    def __host_semaphore(self, resource: str) -> Optional[asyncio.Semaphore]:
+        if self.__max_in_flight_per_host is None:
+            return None
+
+        host = host_of(resource) or ''
+        semaphore = self.__host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.__max_in_flight_per_host)
+            self.__host_semaphores[host] = semaphore
+        return semaphore
+
+    async def __load(self, load_context: LoadContext) -> Optional[LoadResult]:
+        if self.__host_limiter is not None:
+            host = load_context.host or ''
+            await self.__host_limiter.acquire(host)
+            outcome = _LoadOutcome()
+            try:
+                return await self.__load_guarded(load_context, outcome)
+            finally:
+                self.__host_limiter.release(host, outcome.duration, outcome.load_result, outcome.error)
+
+        semaphore = self.__host_semaphore(load_context.Resource)
+
+        if semaphore is None:
+            return await self.__load_guarded(load_context)
+
+        async with semaphore:
+            return await self.__load_guarded(load_context)
+
+    async def __load_guarded(self, load_context: LoadContext, outcome: Optional[_LoadOutcome] = None) -> Optional[LoadResult]:
+        load_result = None
+        started_at = None
+
+        try:
+
+            await self.__load_behaviour.pre_load(load_context)
+
+            started_at = time.perf_counter()
+            load_result = await self.__load_behaviour.load(load_context)
+            if outcome is not None:
+                outcome.duration = time.perf_counter() - started_at
+                outcome.load_result = load_result
+
+            if load_result:
+                if not load_result.is_success():
+                    load_result.current_context.LoadObject.error = load_result.resp_text_data
+                self.__state_machine.change_state(load_result.current_context.LoadObject)
+
+            await self.__load_behaviour.post_load(load_result)
+
+            return load_result
+
+        except Exception as e:
+            print(str(e))
+            if outcome is not None and outcome.duration is None:
+                # load itself failed
+                outcome.error = e
+                if started_at is not None:
+                    outcome.duration = time.perf_counter() - started_at
+            load_context.LoadObject.error = str(e)
+            self.__state_machine.change_state(load_context.LoadObject)
+            await self.__load_behaviour.handle_error(load_context, load_result, str(e))
+
+        return load_result
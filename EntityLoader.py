@@ -1,17 +1,25 @@
 import time
+import signal
+import threading
 
-from typing import Optional
-from StateMachine import State, StateMachine
+from typing import Optional, Callable, Iterable
+from StateMachine import State, StateMachine, host_of
+from Metrics import Metrics
 
 
 class LoadContext:
-    def __init__(self, uid, resource, params, headers, load_object: State, obj=None):
+    def __init__(self, uid, resource, params, headers, load_object: State, obj=None, fingerprint: str = None):
         self.Uid = uid
         self.Resource = resource
         self.params = params
         self.headers = headers
         self.LoadObject = load_object
         self.obj = obj
+        self.fingerprint = fingerprint
+
+    @property
+    def host(self) -> Optional[str]:
+        return host_of(self.Resource)
 
 
 class LoadResult:
@@ -37,6 +45,34 @@ class LoadContextManager:
     def next(self) -> Optional[LoadContext]:
         raise NotImplemented()
 
+    def wait_for_work(self, timeout: float, stop=None) -> bool:
+        """
+        is called when next() found nothing, waits for new objects
+        :param timeout: maximum duration of waiting in seconds
+        :param stop: event, which interrupts waiting when set
+        :return: True if new objects may have appeared before timeout
+        """
+        if stop is not None:
+            stop.wait(timeout)
+        else:
+            time.sleep(timeout)
+        return False
+
+    def release(self):
+        """
+        returns objects fetched, but not handed out by next() yet, and persists buffered changes,
+        is called before loader stops
+        """
+        pass
+
+    def has_work(self) -> bool:
+        """
+        is called when next() found nothing: None may also mean, that all hosts are blocked for a while
+        or failed objects wait for their next attempt
+        :return: True if objects to load will appear without new objects being added
+        """
+        return False
+
 
 class LoadBehaviour:
 
@@ -81,6 +117,45 @@ class WaitBehaviour:
         """
         raise NotImplemented()
 
+    def before_load(self, load_context: LoadContext):
+        """
+        this method is called before LoadBehaviour.pre_load() and may wait for load_context's host
+        :param load_context: context of current load operation
+        :return: void
+        """
+        pass
+
+    def after_load(self, load_result: Optional[LoadResult]):
+        """
+        this method is called after LoadBehaviour.load() with its result
+        :param load_result: result of current load operation
+        :return: void
+        """
+        pass
+
+
+class LoadListener:
+    """
+    receives start and outcome of every load, e.g. to keep health of hosts
+    """
+    def on_start(self, load_context: LoadContext):
+        """
+        this method is called before WaitBehaviour.before_load(), when object is already in processing state
+        :param load_context: context of current load operation
+        :return: void
+        """
+        pass
+
+    def on_outcome(self, load_context: LoadContext, load_result: Optional[LoadResult], error: Optional[Exception]):
+        """
+        this method is called after load_context.LoadObject's state was changed by StateMachine
+        :param load_context: context of current load operation
+        :param load_result: result (if exists) of current load operation
+        :param error: exception raised during load, None if load finished without exception
+        :return: void
+        """
+        pass
+
 
 class EntityLoader:
     """
@@ -92,7 +167,9 @@ class EntityLoader:
         load_context_manager: LoadContextManager,
         load_behaviour: LoadBehaviour,
         wait_behaviour: WaitBehaviour,
-        state_machine: StateMachine
+        state_machine: StateMachine,
+        metrics: Optional[Metrics] = None,
+        listeners: Iterable[LoadListener] = ()
     ):
         """
 
@@ -100,6 +177,8 @@ class EntityLoader:
         :param load_behaviour: implementation of LoadBehaviour
         :param wait_behaviour: implementation of WaitBehaviour
         :param state_machine: implementation of StateMachine
+        :param metrics: receiver of phase durations and load counters, None - not measured
+        :param listeners: receivers of start and outcome of every load (e.g. CircuitBreaker)
         """
         assert load_behaviour
         assert wait_behaviour
@@ -110,6 +189,15 @@ class EntityLoader:
         self.__load_behaviour = load_behaviour
         self.__wait_behaviour = wait_behaviour
         self.__state_machine = state_machine
+        self.__metrics = metrics if metrics is not None else Metrics()
+        self.__listeners = list(listeners)
+        self.__stop = threading.Event()
+
+    def stop(self):
+        """
+        asks run_forever, started without own stop event, to stop after current load
+        """
+        self.__stop.set()
 
     def load(self) -> Optional[LoadResult]:
         """
@@ -118,32 +206,171 @@ class EntityLoader:
         """
 
         started_at = time.perf_counter()
-        result = self.__load()
-        duration_ms = int((time.perf_counter() - started_at) * 1000)
-        self.__wait_behaviour.wait(duration_ms)
+        load_context = self.__next()
+        result = self.__load(load_context)
+        self.__wait(started_at, load_context)
 
         return result
 
-    def __load(self) -> Optional[LoadResult]:
+    def load_many(self, count: Optional[int] = None) -> int:
+        """
+        load objects from StateMachineDao.get_unsuccessful until there are no more objects,
+        then LoadContextManager.release() returns fetched, but not loaded objects
+        :param count: maximum count of objects to load, None - no limit
+        :return: count of processed objects
+        """
+        loaded = 0
+
+        try:
+            while count is None or loaded < count:
+                started_at = time.perf_counter()
+                load_context = self.__next()
+                if not load_context:
+                    break
+
+                self.__load(load_context)
+                loaded += 1
+
+                self.__wait(started_at, load_context)
+        finally:
+            self.__load_context_manager.release()
+
+        return loaded
+
+    def run_forever(self,
+                    stop=None,
+                    idle_min_ms: int = 50,
+                    idle_max_ms: int = 5000,
+                    exit_when_empty: bool = False,
+                    handle_signals: bool = False,
+                    progress: Optional[Callable[[int], None]] = None,
+                    progress_every: int = 100) -> int:
+        """
+        loads objects until stop() is called or stop event is set.
+        When there is nothing to load, waits for new objects by LoadContextManager.wait_for_work:
+        from idle_min_ms, doubled after every fruitless attempt up to idle_max_ms.
+        Graceful drain: current load is finished, then LoadContextManager.release() returns
+        fetched, but not loaded objects and persists buffered state changes
+        :param stop: event (threading / multiprocessing), which stops loading when set, None - stop() does it
+        :param idle_min_ms: first wait for new objects
+        :param idle_max_ms: maximum wait for new objects
+        :param exit_when_empty: return, when there is nothing to load now and later
+                                (see LoadContextManager.has_work), instead of waiting
+        :param handle_signals: SIGTERM and SIGINT stop loading (only in main thread)
+        :param progress: is called with count of objects loaded since previous call
+        :param progress_every: count of loaded objects between progress calls
+        :return: count of processed objects
+        """
+        assert 0 < idle_min_ms <= idle_max_ms
+        assert progress_every > 0
+
+        stop = stop if stop is not None else self.__stop
+
+        previous_handlers = {}
+        if handle_signals:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                previous_handlers[signum] = signal.signal(signum, lambda *_: stop.set())
+
+        loaded = 0
+        reported = 0
+        idle_ms = idle_min_ms
+
+        try:
+            while not stop.is_set():
+                started_at = time.perf_counter()
+                load_context = self.__next()
+
+                if not load_context:
+                    if exit_when_empty and not self.__load_context_manager.has_work():
+                        break
+                    self.__load_context_manager.wait_for_work(idle_ms / 1000.0, stop)
+                    idle_ms = min(idle_ms * 2, idle_max_ms)
+                    continue
+
+                idle_ms = idle_min_ms
+                self.__load(load_context)
+                loaded += 1
+
+                if progress is not None and loaded - reported >= progress_every:
+                    progress(loaded - reported)
+                    reported = loaded
 
+                self.__wait(started_at, load_context)
+        finally:
+            self.__load_context_manager.release()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            self.__stop.clear()
+
+        if progress is not None and loaded > reported:
+            progress(loaded - reported)
+
+        return loaded
+
+    def __next(self) -> Optional[LoadContext]:
+        started_at = time.perf_counter()
         load_context = self.__load_context_manager.next()
+        self.__metrics.observe('claim', time.perf_counter() - started_at)
+        return load_context
+
+    def __wait(self, started_at: float, load_context: Optional[LoadContext]):
+        wait_started_at = time.perf_counter()
+        self.__wait_behaviour.wait(int((wait_started_at - started_at) * 1000))
+        self.__metrics.observe('wait', time.perf_counter() - wait_started_at, load_context.host if load_context else None)
+
+    def __load(self, load_context: Optional[LoadContext]) -> Optional[LoadResult]:
+
         load_result = None
 
         if load_context:
+            metrics = self.__metrics
+            host = load_context.host
+            phase_started_at = time.perf_counter()
+
+            def observe(phase: str) -> float:
+                now = time.perf_counter()
+                metrics.observe(phase, now - phase_started_at, host)
+                return now
+
             try:
 
-                load_context.LoadObject = self.__state_machine.to_processing(load_context.LoadObject)
+                # objects claimed by LoadContextManager are already in processing state
+                if load_context.LoadObject.state != State.PROCESSING:
+                    load_object = self.__state_machine.to_processing(load_context.LoadObject)
+                    phase_started_at = observe('to_processing')
+                    if load_object is None:
+                        # object was taken by somebody else
+                        return None
+                    load_context.LoadObject = load_object
+
+                for listener in self.__listeners:
+                    listener.on_start(load_context)
+
+                self.__wait_behaviour.before_load(load_context)
+                phase_started_at = observe('before_load')
 
                 self.__load_behaviour.pre_load(load_context)
+                phase_started_at = observe('pre_load')
 
                 load_result = self.__load_behaviour.load(load_context)
+                phase_started_at = observe('load')
+
+                self.__wait_behaviour.after_load(load_result)
+                phase_started_at = observe('after_load')
 
                 if load_result:
                     if not load_result.is_success():
                         load_result.current_context.LoadObject.error = load_result.resp_text_data
                     self.__state_machine.change_state(load_result.current_context.LoadObject)
+                    phase_started_at = observe('change_state')
 
                 self.__load_behaviour.post_load(load_result)
+                observe('post_load')
+
+                metrics.count(host, self.__status_of(load_result), load_context.LoadObject.state)
+
+                for listener in self.__listeners:
+                    listener.on_outcome(load_context, load_result, None)
 
                 return load_result
 
@@ -152,5 +379,13 @@ class EntityLoader:
                 load_context.LoadObject.error = str(e)
                 # warning: passing here after falling in __state_machine.to_processing ....
                 self.__state_machine.change_state(load_context.LoadObject)
+                metrics.count(host, 'error', load_context.LoadObject.state)
+                for listener in self.__listeners:
+                    listener.on_outcome(load_context, load_result, e)
                 self.__load_behaviour.handle_error(load_context, load_result, str(e))
         return load_result
+
+    def __status_of(self, load_result: Optional[LoadResult]) -> Optional[str]:
+        status_code = getattr(load_result, 'status_code', None)
+        return str(status_code) if status_code is not None else None
+
@@ -0,0 +1,41 @@
+from typing import Optional
+
+
+class Metrics:
+    """
+    receiver of EntityLoader measurements, this implementation ignores them
+
+    phases of one load (method names of collaborators):
+    claim (LoadContextManager.next), to_processing, before_load, pre_load, load, after_load,
+    change_state, post_load, wait
+    """
+    PHASES = (
+        'claim',
+        'to_processing',
+        'before_load',
+        'pre_load',
+        'load',
+        'after_load',
+        'change_state',
+        'post_load',
+        'wait'
+    )
+
+    def observe(self, phase: str, duration: float, host: Optional[str] = None):
+        """
+        :param phase: one of PHASES
+        :param duration: duration of phase in seconds
+        :param host: host of loaded object, None if phase does not belong to one host
+        :return: void
+        """
+        pass
+
+    def count(self, host: Optional[str], status: Optional[str], state: Optional[str]):
+        """
+        is called once per finished load
+        :param host: host of loaded object
+        :param status: status code of response, 'error' if load raised, None without response
+        :param state: state of object after load (StateMachine.change_state)
+        :return: void
+        """
+        pass
@@ -0,0 +1,213 @@
+import sys
+import time
+import signal
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, ContextManager, Optional, List, Dict
+
+from EntityLoader import EntityLoader
+
+
+class ThreadPoolRunner:
+    """
+    runs several EntityLoaders in a thread pool
+
+    every worker builds its own EntityLoader with loader_factory, because sqlite connections
+    can not be shared between threads. LoadContextManager of the built loader must claim objects
+    atomically (LoadContextManagerSQLite with claim=True), otherwise workers load the same objects
+    """
+    def __init__(self,
+                 loader_factory: Callable[[], ContextManager[EntityLoader]],
+                 workers: int = 32):
+        """
+        :param loader_factory: returns context manager, which opens dao's and yields EntityLoader
+        :param workers: count of worker threads
+        """
+        assert loader_factory
+        assert workers > 0
+
+        self.__loader_factory = loader_factory
+        self.__workers = workers  # type: int
+
+    def run(self, count_per_worker: Optional[int] = None) -> int:
+        """
+        load objects until every worker finds no more objects to load
+        :param count_per_worker: maximum count of objects loaded by one worker, None - no limit
+        :return: count of processed objects
+        """
+        with ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix='loader') as executor:
+            futures = [
+                executor.submit(self.__work, count_per_worker)
+                for _ in range(self.__workers)
+            ]
+            return sum(future.result() for future in futures)
+
+    def __work(self, count: Optional[int]) -> int:
+        with self.__loader_factory() as loader:  # type: EntityLoader
+            return loader.load_many(count)
+
+
+def _run_shard(loader_factory: Callable[[int, int], ContextManager[EntityLoader]],
+               shard_index: int,
+               shard_count: int,
+               reports,
+               stop,
+               batch_size: int,
+               idle_ms: int,
+               exit_when_empty: bool):
+    # supervisor decides when to stop, workers ignore Ctrl+C and SIGTERM sent to the whole process group
+    # (systemd, docker stop) and drain, when stop event is set
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    with loader_factory(shard_index, shard_count) as loader:  # type: EntityLoader
+        loader.run_forever(
+            stop=stop,
+            idle_min_ms=min(50, idle_ms),
+            idle_max_ms=idle_ms,
+            exit_when_empty=exit_when_empty,
+            progress=lambda loaded: reports.put((shard_index, loaded)),
+            progress_every=batch_size
+        )
+
+
+class ShardedProcessRunner:
+    """
+    supervisor of worker processes, worker i of N loads objects of shard i only
+    (see SQLiteStateMachineDao shard_index / shard_count), so workers never compete for the same rows.
+
+    every worker builds its own dao's and EntityLoader with loader_factory(shard_index, shard_count),
+    loader_factory must be picklable (top-level function or functools.partial of it).
+    Crashed workers are restarted, throughput of all workers is reported every report_interval_ms.
+    """
+    def __init__(self,
+                 loader_factory: Callable[[int, int], ContextManager[EntityLoader]],
+                 processes: int,
+                 batch_size: int = 100,
+                 idle_ms: int = 1000,
+                 restart_delay_ms: int = 1000,
+                 report_interval_ms: int = 10000,
+                 exit_when_empty: bool = False):
+        """
+        :param loader_factory: returns context manager, which opens dao's of the shard and yields EntityLoader
+        :param processes: count of worker processes and shards
+        :param batch_size: count of objects loaded between reports
+        :param idle_ms: maximum delay before next attempt, when shard has no objects to load
+                        (workers wake up earlier, when database is changed)
+        :param restart_delay_ms: delay before restart of crashed worker
+        :param report_interval_ms: interval of throughput reports
+        :param exit_when_empty: workers stop when their shards have neither created objects
+                                nor failed objects with attempts left
+        """
+        assert loader_factory
+        assert processes > 0
+        assert batch_size > 0
+
+        self.__loader_factory = loader_factory
+        self.__processes = processes  # type: int
+        self.__batch_size = batch_size  # type: int
+        self.__idle_ms = idle_ms  # type: int
+        self.__restart_delay = restart_delay_ms / 1000.0  # type: float
+        self.__report_interval = report_interval_ms / 1000.0  # type: float
+        self.__exit_when_empty = exit_when_empty  # type: bool
+        self.__stop = multiprocessing.Event()
+        self.__reports = multiprocessing.Queue()
+        self.__workers = {}  # type: Dict[int, multiprocessing.Process]
+        self.__loaded = [0] * processes  # type: List[int]
+        self.__restarts = 0  # type: int
+
+    def stop(self):
+        self.__stop.set()
+
+    def run(self) -> int:
+        """
+        runs workers until stop() is called, SIGTERM / SIGINT is received
+        or all workers exit (exit_when_empty)
+        :return: count of processed objects
+        """
+        previous_handlers = {
+            signum: signal.signal(signum, lambda *_: self.stop())
+            for signum in (signal.SIGINT, signal.SIGTERM)
+        }
+
+        try:
+            for shard_index in range(self.__processes):
+                self.__start(shard_index)
+
+            started_at = reported_at = time.perf_counter()
+            reported_count = 0
+
+            while self.__workers:
+                self.__drain_reports(timeout=0.2)
+                self.__supervise()
+
+                now = time.perf_counter()
+                if now - reported_at >= self.__report_interval:
+                    total = sum(self.__loaded)
+                    self.__report(total, total - reported_count, now - reported_at, now - started_at)
+                    reported_at, reported_count = now, total
+
+            self.__drain_reports(timeout=0)
+            total = sum(self.__loaded)
+            self.__report(total, total - reported_count, time.perf_counter() - reported_at, time.perf_counter() - started_at)
+            return total
+        finally:
+            self.__stop.set()
+            for process in self.__workers.values():
+                process.join()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def __start(self, shard_index: int):
+        process = multiprocessing.Process(
+            target=_run_shard,
+            name=str.format('loader-{0}', shard_index),
+            args=(
+                self.__loader_factory,
+                shard_index,
+                self.__processes,
+                self.__reports,
+                self.__stop,
+                self.__batch_size,
+                self.__idle_ms,
+                self.__exit_when_empty
+            )
+        )
+        process.start()
+        self.__workers[shard_index] = process
+
+    def __supervise(self):
+        for shard_index, process in list(self.__workers.items()):
+            if process.is_alive():
+                continue
+
+            process.join()
+            del self.__workers[shard_index]
+
+            if process.exitcode != 0 and not self.__stop.is_set():
+                print(str.format('worker {0} exited with code {1}, restarting', shard_index, process.exitcode), file=sys.stderr)
+                self.__restarts += 1
+                self.__stop.wait(self.__restart_delay)
+                if not self.__stop.is_set():
+                    self.__start(shard_index)
+
+    def __drain_reports(self, timeout: float):
+        try:
+            while True:
+                shard_index, loaded = self.__reports.get(timeout=timeout)
+                self.__loaded[shard_index] += loaded
+                timeout = 0
+        except Exception:
+            # queue.Empty
+            pass
+
+    def __report(self, total: int, count: int, interval: float, elapsed: float):
+        print(str.format(
+            'loaded: {0}, {1:.1f}/s (last {2:.0f}s: {3:.1f}/s), workers: {4}, restarts: {5}',
+            total,
+            total / elapsed if elapsed > 0 else 0.0,
+            interval,
+            count / interval if interval > 0 else 0.0,
+            len(self.__workers),
+            self.__restarts
+        ))
@@ -1,12 +1,26 @@
+import time
 import uuid
-import copy
-from typing import Optional
-from datetime import datetime, timezone
+import random
+import operator
+from typing import Optional, List, Iterable, Tuple
+from datetime import datetime, timezone, timedelta
+from urllib.parse import urlsplit
+
+
+def host_of(resource: Optional[str]) -> Optional[str]:
+    """
+    :param resource: url of resource
+    :return: lower-cased host name of resource, None if resource is not an url
+    """
+    if not resource:
+        return None
+    return urlsplit(resource).hostname
 
 
 class State(object):
     """
     Representation of resource state
+    slots-based, snapshot() and restore() are cheap replacement of deepcopy for rollback of transitions
     """
 
     CREATED = 'created'
@@ -14,6 +28,19 @@ class State(object):
     SUCCESSFUL = 'successful'
     FAILED = 'failed'
 
+    __slots__ = (
+        'uid',
+        'resource',
+        'state',
+        'attempt_count',
+        'last_attempt',
+        'error',
+        'last_update',
+        'version',
+        'next_attempt_at',
+        'priority'
+    )
+
     def __init__(self,
                  uid: uuid = None,
                  resource: str = None,
@@ -22,79 +49,49 @@ class State(object):
                  last_attempt: datetime = None,
                  error: str = None,
                  last_update: datetime = None,
-                 version: int = None):
-        self.__uid = uid  # type: uuid
-        self.__resource = resource  # type: str
-        self.__state = state  # type: str
-        self.__attempt_count = attempt_count  # type: int
-        self.__last_attempt = last_attempt  # type: datetime
-        self.__error = error  # type: str
-        self.__last_update = last_update  # type: datetime
-        self.__version = version  # type: int
-
-    @property
-    def uid(self) -> uuid.UUID:
-        return self.__uid
-
-    @uid.setter
-    def uid(self, value):
-        self.__uid = value
+                 version: int = None,
+                 next_attempt_at: datetime = None,
+                 priority: int = 0):
+        self.uid = uid  # type: uuid.UUID
+        self.resource = resource  # type: str
+        self.state = state  # type: str
+        self.attempt_count = attempt_count  # type: int
+        self.last_attempt = last_attempt  # type: datetime
+        self.error = error  # type: str
+        self.last_update = last_update  # type: datetime
+        self.version = version  # type: int
+        self.next_attempt_at = next_attempt_at  # type: datetime
+        # objects of higher priority are loaded first
+        self.priority = priority  # type: int
 
     @property
-    def resource(self):
-        return self.__resource
+    def host(self) -> Optional[str]:
+        return host_of(self.resource)
 
-    @resource.setter
-    def resource(self, value):
-        self.__resource = value
+    def snapshot(self) -> tuple:
+        """
+        :return: values of all fields, fields are immutable values, so no deep copy is needed
+        """
+        return _state_fields(self)
 
-    @property
-    def state(self) -> str:
-        return self.__state
+    def restore(self, snapshot: tuple):
+        """
+        :param snapshot: result of snapshot()
+        """
+        for name, value in zip(State.__slots__, snapshot):
+            setattr(self, name, value)
 
-    @state.setter
-    def state(self, value):
-        self.__state = value
 
-    @property
-    def attempt_count(self):
-        return self.__attempt_count
+_state_fields = operator.attrgetter(*State.__slots__)
 
-    @attempt_count.setter
-    def attempt_count(self, value):
-        self.__last_attempt = value
 
-    @property
-    def last_attempt(self):
-        return self.__last_attempt
-
-    @last_attempt.setter
-    def last_attempt(self, value):
-        self.__last_attempt = value
-
-    @property
-    def error(self):
-        return self.__error
-
-    @error.setter
-    def error(self, value):
-        self.__error = value
-
-    @property
-    def last_update(self):
-        return self.__last_update
-
-    @last_update.setter
-    def last_update(self, value):
-        self.__last_update = value
-
-    @property
-    def version(self):
-        return self.__version
-
-    @version.setter
-    def version(self, value):
-        self.__version = value
+class VersionConflictError(Exception):
+    """
+    raised by StateMachineDao, when objects were changed by somebody else since they were read
+    """
+    def __init__(self, uids: List[uuid.UUID]):
+        super().__init__(str.format('version conflict: {0}', ', '.join(uid.urn for uid in uids)))
+        self.uids = uids
 
 
 class StateMachineDao(object):
@@ -107,32 +104,142 @@ class StateMachineDao(object):
     def delete(self, obj: State) -> bool:
         raise NotImplemented()
 
-    def by_uid(self, uid) -> State:
+    def by_uid(self, uid) -> Optional[State]:
         raise NotImplemented()
 
     def get_unsuccessful(self) -> Optional[State]:
         raise NotImplemented()
 
+    def has_unsuccessful(self) -> bool:
+        """
+        :return: True if there are objects to load now or later: created ones and failed ones with attempts left,
+                 even if their next attempt is not due yet
+        """
+        return self.get_unsuccessful() is not None
+
+    def claim_unsuccessful(self, exclude_hosts: Iterable[str] = ()) -> Optional[State]:
+        """
+        atomically moves next unsuccessful object to processing state
+        :param exclude_hosts: objects of these hosts are not claimed
+        :return: claimed object in processing state, None if there is nothing to claim
+        """
+        raise NotImplemented()
+
+    def flush(self):
+        """
+        persists changes buffered by dao, if dao buffers them
+        """
+        pass
+
+    def release(self, objects: Iterable[State]) -> int:
+        """
+        returns claimed, but not loaded objects to their previous unsuccessful state without spending an attempt
+        (by default they are recovered only when their lease expires, if dao leases processing objects)
+        :param objects: objects in processing state, returned by claim_unsuccessful / claim_batch
+        :return: count of released objects
+        """
+        return 0
+
+    def wait_for_change(self, timeout: float, stop=None) -> bool:
+        """
+        waits until somebody else changes stored objects (e.g. adds new ones)
+        by default just sleeps, because changes can not be detected
+        :param timeout: maximum duration of waiting in seconds
+        :param stop: event (threading / multiprocessing), which interrupts waiting when set
+        :return: True if stored objects were changed
+        """
+        if stop is not None:
+            stop.wait(timeout)
+        else:
+            time.sleep(timeout)
+        return False
+
+    def reap_expired_leases(self) -> int:
+        """
+        moves processing objects, which lease has expired (their worker died or hung), back to failed state,
+        so they are retried, if dao leases processing objects
+        :return: count of reaped objects
+        """
+        return 0
+
+    def claim_batch(self, limit: int, exclude_hosts: Iterable[str] = ()) -> List[State]:
+        """
+        atomically moves up to limit unsuccessful objects of the highest priority to processing state
+        :param limit: maximum count of claimed objects
+        :param exclude_hosts: objects of these hosts are not claimed
+        :return: claimed objects in processing state
+        """
+        raise NotImplemented()
+
+    def claimable_hosts(self, exclude_hosts: Iterable[str] = ()) -> Tuple[Optional[int], List[Optional[str]]]:
+        """
+        :param exclude_hosts: objects of these hosts are ignored
+        :return: the highest priority of unsuccessful objects and hosts having unsuccessful objects of it
+                 (None - objects without host), (None, []) if there is nothing to claim
+        """
+        raise NotImplemented()
+
+    def claim_host_batch(self, host: Optional[str], limit: int, priority: int) -> List[State]:
+        """
+        atomically moves up to limit unsuccessful objects of host and priority to processing state
+        :param host: host of objects, None - objects without host
+        :param limit: maximum count of claimed objects
+        :param priority: priority of objects
+        :return: claimed objects in processing state
+        """
+        raise NotImplemented()
+
 
 class StateMachine:
     """
     ATTENTION! Using UTC
+
+    failed objects are retried until max_attempt_count attempts are made,
+    delay before next attempt grows exponentially: backoff_base_ms * 2 ^ (attempt_count - 1),
+    limited by backoff_max_ms and randomly shortened by up to jitter part of it
+
+    on VersionConflictError object is re-read: transition is repeated on the fresh object
+    (up to conflict_retries times) if it is still applicable, otherwise the object is dropped
     """
 
     def __init__(self,
                  max_attempt_count: int,
-                 dao: StateMachineDao):
+                 dao: StateMachineDao,
+                 backoff_base_ms: int = 1000,
+                 backoff_max_ms: int = 3600000,
+                 jitter: float = 0.5,
+                 conflict_retries: int = 1):
         assert dao is not None
         assert max_attempt_count > 0
+        assert 0 < backoff_base_ms <= backoff_max_ms
+        assert 0.0 <= jitter <= 1.0
+        assert conflict_retries >= 0
 
         self.__max_attempt_count = max_attempt_count  # type: int
         self.__dao = dao  # type: StateMachineDao
+        self.__backoff_base_ms = backoff_base_ms  # type: int
+        self.__backoff_max_ms = backoff_max_ms  # type: int
+        self.__jitter = jitter  # type: float
+        self.__conflict_retries = conflict_retries  # type: int
+
+    def next_attempt_delay(self, attempt_count: int) -> Optional[timedelta]:
+        """
+        :param attempt_count: count of made attempts
+        :return: delay before next attempt, None if attempts are exhausted
+        """
+        if attempt_count >= self.__max_attempt_count:
+            return None
+
+        delay_ms = min(self.__backoff_max_ms, self.__backoff_base_ms * 2 ** max(attempt_count - 1, 0))
+        delay_ms *= 1.0 - self.__jitter * random.random()
+
+        return timedelta(milliseconds=delay_ms)
 
     def create(self, obj: State):
         assert obj
         assert obj.state is None
 
-        saved = copy.deepcopy(obj)
+        saved = obj.snapshot()
 
         obj.state = State.CREATED
         obj.version = 1
@@ -141,49 +248,94 @@ class StateMachine:
         obj.error = None
 
         try:
-            obj = self.__dao.update(obj)
+            obj = self.__dao.create(obj)
         except Exception as e:
-            obj = saved
+            obj.restore(saved)
             raise e
 
         return obj
 
-    def to_processing(self, obj: State) -> State:
+    def to_processing(self, obj: State) -> Optional[State]:
+        """
+        :return: object in processing state, None if object was taken by somebody else
+        """
         assert obj
-        assert obj.state == State.CREATED
+        assert obj.state in (State.CREATED, State.FAILED)
 
-        last_obj = copy.deepcopy(obj)
+        for retry in range(self.__conflict_retries + 1):
+            saved = obj.snapshot()
 
-        obj.state = State.PROCESSING
-        obj.attempt_count += 1
-        obj.last_attempt = datetime.now(timezone.utc)
-
-        try:
-            self.__dao.update(obj)
-        except Exception as e:
-            obj = last_obj
-            raise e
+            obj.state = State.PROCESSING
+            obj.attempt_count += 1
+            obj.last_attempt = datetime.now(timezone.utc)
+            obj.next_attempt_at = None
+            obj.error = None
 
-        return obj
+            try:
+                self.__dao.update(obj)
+                return obj
+            except VersionConflictError as e:
+                if obj.uid not in e.uids:
+                    # conflict of another buffered transition, this one is written
+                    return obj
+                obj.restore(saved)
+            except Exception as e:
+                obj.restore(saved)
+                raise e
+
+            fresh = self.__dao.by_uid(obj.uid)
+            if fresh is None or not self.__is_loadable(fresh):
+                print(str.format('{0} is dropped: it was taken by somebody else', obj.uid.urn))
+                return None
+            obj.restore(fresh.snapshot())
+
+        print(str.format('{0} is dropped: too many version conflicts', obj.uid.urn))
+        return None
 
     def change_state(self, obj: State) -> State:
+        """
+        :return: object in new state, or fresh object if it was taken by somebody else during processing
+        """
         assert obj is not None
         assert obj.state == State.PROCESSING
 
-        last_obj = copy.deepcopy(obj)
-
-        if obj.error is not None:
-            obj.state = State.FAILED
-        elif obj.error is None:
-            obj.error = None
-            obj.state = State.SUCCESSFUL
-        else:
-            obj.error = str.format('unexpected state: {0}, error: {1}', (obj.state, str(obj.error)))
-
-        try:
-            obj = self.__dao.update(obj)
-        except Exception as e:
-            obj = last_obj
-            raise e
-
+        for retry in range(self.__conflict_retries + 1):
+            saved = obj.snapshot()
+
+            if obj.error is not None:
+                obj.state = State.FAILED
+                delay = self.next_attempt_delay(obj.attempt_count or 0)
+                obj.next_attempt_at = datetime.now(timezone.utc) + delay if delay is not None else None
+            elif obj.error is None:
+                obj.error = None
+                obj.state = State.SUCCESSFUL
+                obj.next_attempt_at = None
+            else:
+                obj.error = str.format('unexpected state: {0}, error: {1}', (obj.state, str(obj.error)))
+
+            try:
+                return self.__dao.update(obj)
+            except VersionConflictError as e:
+                if obj.uid not in e.uids:
+                    return obj
+                obj.restore(saved)
+            except Exception as e:
+                obj.restore(saved)
+                raise e
+
+            fresh = self.__dao.by_uid(obj.uid)
+            if fresh is None or fresh.state != State.PROCESSING or fresh.attempt_count != obj.attempt_count:
+                print(str.format('{0} is dropped: it was changed by somebody else', obj.uid.urn))
+                return fresh
+            # the same attempt, row was only touched by somebody else
+            obj.version = fresh.version
+
+        print(str.format('{0} is dropped: too many version conflicts', obj.uid.urn))
         return obj
+
+    def __is_loadable(self, obj: State) -> bool:
+        if obj.state == State.CREATED:
+            return True
+        return obj.state == State.FAILED \
+            and obj.next_attempt_at is not None \
+            and obj.next_attempt_at <= datetime.now(timezone.utc)
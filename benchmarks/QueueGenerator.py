@@ -0,0 +1,60 @@
+import os
+import sys
+import sqlite3
+import argparse
+from typing import Iterator
+
+from default.BulkImporter import BulkImporter, ImportStats
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sqlite.sql')
+
+
+def synthetic_entries(rows: int, port: int, hosts: int = 1) -> Iterator[dict]:
+    """
+    resources of stub server, spread round-robin over hosts 127.0.0.1 .. 127.0.0.<hosts>
+    """
+    assert rows > 0
+    assert 0 < hosts < 255
+
+    for i in range(rows):
+        yield {
+            'resource': str.format('http://127.0.0.{0}:{1}/r/{2}', 1 + i % hosts, port, i),
+            'params': {'page': i % 100}
+        }
+
+
+def generate(connection_string: str, rows: int, port: int, hosts: int = 1, progress=None) -> ImportStats:
+    """
+    creates database with sqlite.sql schema and fills it with rows of created resources
+    """
+    if os.path.exists(connection_string):
+        os.remove(connection_string)
+
+    connection = sqlite3.connect(connection_string)
+    try:
+        with open(SCHEMA_PATH, 'r', encoding='utf-8') as schema:
+            connection.executescript(schema.read())
+        connection.commit()
+    finally:
+        connection.close()
+
+    with BulkImporter(connection_string, chunk_size=10000, dedup=False, progress=progress) as importer:
+        return importer.import_entries(synthetic_entries(rows, port, hosts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='generates synthetic queue database for benchmarks')
+    parser.add_argument('db', help='path to created sqlite database, existing file is replaced')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--port', type=int, default=8089, help='port of stub server')
+    parser.add_argument('--hosts', type=int, default=1, help='count of distinct hosts 127.0.0.x')
+    args = parser.parse_args(argv)
+
+    def progress(stats: ImportStats):
+        print(str(stats), file=sys.stderr)
+
+    print(str(generate(args.db, args.rows, args.port, args.hosts, progress)))
+
+
+if __name__ == '__main__':
+    main()
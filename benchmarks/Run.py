@@ -0,0 +1,377 @@
+"""
+offline benchmark of loader modes against local stub server
+
+    python -m benchmarks.Run --rows 10000 --count 2000 --latency-ms 5 --output bench.json
+
+every scenario runs in its own spawned process on a fresh copy of the generated database,
+so peak RSS (resource.getrusage) belongs to the scenario only
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import sqlite3
+import asyncio
+import argparse
+import platform
+import threading
+import contextlib
+import subprocess
+import multiprocessing
+from typing import Optional, List, Dict, Callable
+
+from EntityLoader import EntityLoader, LoadBehaviour, LoadResult, LoadContext
+from AsyncEntityLoader import AsyncEntityLoader, AsyncLoadBehaviour
+from StateMachine import StateMachine
+from Runner import ThreadPoolRunner
+from default.SQLiteStorage import SQLiteStorage
+from default.StateMachineDao import SQLiteStateMachineDao
+from default.MemoryStateMachineDao import MemoryStateMachineDao, MemoryHttpParamsDao, MemoryLoadContextManager
+from default.LoadContextManagerSQLite import LoadContextManagerSQLite, AsyncLoadContextManagerSQLite, HttpParamsDao
+from default.HttpLoadBehaviour import HttpLoadBehaviour, HttpSessionPool, SimpleWaitBehaviour
+from benchmarks.StubServer import StubHttpServer
+from benchmarks.QueueGenerator import generate
+
+SCENARIOS = ('sequential', 'claim', 'batch', 'threads', 'async', 'memory')
+
+
+def percentile(values: List[float], part: float) -> Optional[float]:
+    """
+    nearest-rank percentile of values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(part * len(ordered))) - 1))]
+
+
+class _Timer(object):
+    def __init__(self):
+        self.total = 0.0  # type: float
+        self.__lock = threading.Lock()
+
+    def add(self, duration: float):
+        with self.__lock:
+            self.total += duration
+
+
+class _TimedProxy(object):
+    """
+    proxy of dao, summing duration of every call into timer
+    """
+    def __init__(self, target, timer: _Timer):
+        self.__target = target
+        self.__timer = timer
+
+    def __getattr__(self, name):
+        attr = getattr(self.__target, name)
+        if not callable(attr):
+            return attr
+
+        timer = self.__timer
+
+        def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                timer.add(time.perf_counter() - started_at)
+
+        return timed
+
+
+class _TimedLoadBehaviour(LoadBehaviour):
+    def __init__(self, load_behaviour: LoadBehaviour):
+        self.__load_behaviour = load_behaviour
+        self.latencies = []  # type: List[float]
+
+    def load(self, obj: LoadContext) -> Optional[LoadResult]:
+        started_at = time.perf_counter()
+        try:
+            return self.__load_behaviour.load(obj)
+        finally:
+            # list.append is atomic, the same instance is shared by threads
+            self.latencies.append(time.perf_counter() - started_at)
+
+    def pre_load(self, obj: LoadContext):
+        self.__load_behaviour.pre_load(obj)
+
+    def handle_error(self, load_context: LoadContext, load_result: LoadResult, error_text: str):
+        self.__load_behaviour.handle_error(load_context, load_result, error_text)
+
+    def post_load(self, load_result: LoadResult):
+        self.__load_behaviour.post_load(load_result)
+
+
+class _AsyncTimedLoadBehaviour(AsyncLoadBehaviour):
+    def __init__(self, load_behaviour: AsyncLoadBehaviour):
+        self.__load_behaviour = load_behaviour
+        self.latencies = []  # type: List[float]
+
+    async def load(self, obj: LoadContext) -> Optional[LoadResult]:
+        started_at = time.perf_counter()
+        try:
+            return await self.__load_behaviour.load(obj)
+        finally:
+            self.latencies.append(time.perf_counter() - started_at)
+
+    async def pre_load(self, obj: LoadContext):
+        await self.__load_behaviour.pre_load(obj)
+
+    async def handle_error(self, load_context: LoadContext, load_result: LoadResult, error_text: str):
+        await self.__load_behaviour.handle_error(load_context, load_result, error_text)
+
+    async def post_load(self, load_result: LoadResult):
+        await self.__load_behaviour.post_load(load_result)
+
+
+@contextlib.contextmanager
+def _open_daos(db: str, timer: _Timer, group_commit_size: int = 1):
+    storage = SQLiteStorage(db)
+    with SQLiteStateMachineDao(storage, group_commit_size=group_commit_size) as dao:
+        with HttpParamsDao(storage) as http_dao:
+            yield _TimedProxy(dao, timer), _TimedProxy(http_dao, timer)
+
+
+def _run_sync(db: str, config: dict, timer: _Timer, claim: bool, batch_size: int, group_commit_size: int):
+    load_behaviour = _TimedLoadBehaviour(HttpLoadBehaviour(HttpSessionPool()))
+
+    with _open_daos(db, timer, group_commit_size) as (dao, http_dao):
+        loader = EntityLoader(
+            LoadContextManagerSQLite(dao, http_dao, claim=claim, batch_size=batch_size),
+            load_behaviour,
+            SimpleWaitBehaviour(0),
+            StateMachine(config['max_attempts'], dao)
+        )
+        loaded = loader.load_many(config['count'])
+
+    return loaded, load_behaviour.latencies, 1
+
+
+def _run_threads(db: str, config: dict, timer: _Timer):
+    workers = config['workers']
+    load_behaviours = []  # type: List[_TimedLoadBehaviour]
+
+    @contextlib.contextmanager
+    def loader_factory():
+        # session of HttpSessionPool is not shared between threads, every worker owns its pool
+        with HttpSessionPool() as session_pool, _open_daos(db, timer, config['batch_size']) as (dao, http_dao):
+            load_behaviour = _TimedLoadBehaviour(HttpLoadBehaviour(session_pool))
+            load_behaviours.append(load_behaviour)
+            yield EntityLoader(
+                LoadContextManagerSQLite(dao, http_dao, claim=True, batch_size=config['batch_size']),
+                load_behaviour,
+                SimpleWaitBehaviour(0),
+                StateMachine(config['max_attempts'], dao)
+            )
+
+    loaded = ThreadPoolRunner(loader_factory, workers).run(max(1, config['count'] // workers))
+    return loaded, [latency for load_behaviour in load_behaviours for latency in load_behaviour.latencies], workers
+
+
+def _run_memory(db: str, config: dict, timer: _Timer):
+    load_behaviour = _TimedLoadBehaviour(HttpLoadBehaviour(HttpSessionPool()))
+    http_dao = MemoryHttpParamsDao()
+
+    # warm start and the final snapshot are timed as dao calls too
+    started_at = time.perf_counter()
+    dao = MemoryStateMachineDao(db, snapshot_interval_ms=None, http_params_dao=http_dao)
+    dao.open()
+    timer.add(time.perf_counter() - started_at)
+    try:
+        loader = EntityLoader(
+            MemoryLoadContextManager(_TimedProxy(dao, timer), _TimedProxy(http_dao, timer), batch_size=config['batch_size']),
+            load_behaviour,
+            SimpleWaitBehaviour(0),
+            StateMachine(config['max_attempts'], _TimedProxy(dao, timer))
+        )
+        loaded = loader.load_many(config['count'])
+    finally:
+        started_at = time.perf_counter()
+        dao.close()
+        timer.add(time.perf_counter() - started_at)
+
+    return loaded, load_behaviour.latencies, 1
+
+
+def _run_async(db: str, config: dict, timer: _Timer):
+    # aiohttp is optional dependency of AsyncHttpLoadBehaviour
+    from default.AsyncHttpLoadBehaviour import AsyncHttpLoadBehaviour
+
+    async def run(dao, http_dao):
+        async with AsyncHttpLoadBehaviour(limit=config['workers']) as http:
+            load_behaviour = _AsyncTimedLoadBehaviour(http)
+            loader = AsyncEntityLoader(
+                AsyncLoadContextManagerSQLite(
+                    LoadContextManagerSQLite(dao, http_dao, claim=True, batch_size=config['batch_size'])
+                ),
+                load_behaviour,
+                StateMachine(config['max_attempts'], dao),
+                max_in_flight=config['workers'],
+                max_in_flight_per_host=None
+            )
+            return await loader.load_many(config['count']), load_behaviour.latencies
+
+    with _open_daos(db, timer, config['batch_size']) as (dao, http_dao):
+        loaded, latencies = asyncio.run(run(dao, http_dao))
+
+    return loaded, latencies, 1
+
+
+def _scenario_runner(name: str, config: dict) -> Callable:
+    if name == 'sequential':
+        return lambda db, timer: _run_sync(db, config, timer, False, 1, 1)
+    if name == 'claim':
+        return lambda db, timer: _run_sync(db, config, timer, True, 1, 1)
+    if name == 'batch':
+        return lambda db, timer: _run_sync(db, config, timer, True, config['batch_size'], config['batch_size'])
+    if name == 'threads':
+        return lambda db, timer: _run_threads(db, config, timer)
+    if name == 'async':
+        return lambda db, timer: _run_async(db, config, timer)
+    if name == 'memory':
+        return lambda db, timer: _run_memory(db, config, timer)
+    raise ValueError(str.format('unknown scenario: {0}', name))
+
+
+def _states(db: str) -> Dict[str, int]:
+    connection = sqlite3.connect(db)
+    try:
+        return dict(connection.execute('select "state", count(*) from "resource" group by "state"').fetchall())
+    finally:
+        connection.close()
+
+
+def run_scenario(name: str, db: str, config: dict) -> dict:
+    """
+    runs scenario on db, supposed to be called in a fresh process
+    """
+    import resource
+
+    timer = _Timer()
+    started_at = time.perf_counter()
+    loaded, latencies, concurrency = _scenario_runner(name, config)(db, timer)
+    elapsed = time.perf_counter() - started_at
+
+    return {
+        'scenario': name,
+        'loaded': loaded,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(loaded / elapsed, 1) if elapsed > 0 else None,
+        'latency_ms': {
+            key: round(value * 1000, 3) if value is not None else None
+            for key, value in (
+                ('p50', percentile(latencies, 0.50)),
+                ('p95', percentile(latencies, 0.95)),
+                ('p99', percentile(latencies, 0.99))
+            )
+        },
+        # share of wall time of all workers spent in dao calls
+        'db_time_share': round(timer.total / (elapsed * concurrency), 4) if elapsed > 0 else None,
+        # kilobytes on linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'states': _states(db)
+    }
+
+
+def _scenario_process(name: str, db: str, config: dict, results):
+    try:
+        results.put(run_scenario(name, db, config))
+    except Exception as e:
+        results.put({'scenario': name, 'error': repr(e)})
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='offline benchmark of loader modes against local stub server')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--db', default=None, help='existing database made by benchmarks.QueueGenerator, '
+                                                   'generated into work directory by default')
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'apicaller_bench'))
+    parser.add_argument('--rows', type=int, default=10000, help='rows of generated database')
+    parser.add_argument('--hosts', type=int, default=1, help='distinct hosts of generated database')
+    parser.add_argument('--count', type=int, default=2000, help='objects loaded by every scenario')
+    parser.add_argument('--workers', type=int, default=16, help='threads of "threads" and loads in flight of "async"')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--max-attempts', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8089, help='port of stub server')
+    parser.add_argument('--latency-ms', type=float, default=5)
+    parser.add_argument('--payload-size', type=int, default=1024)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--output', default=None, help='json report file, stdout by default')
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error(str.format('unknown scenario: {0}', name))
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    template = args.db
+    if template is None:
+        template = os.path.join(args.work_dir, 'queue.db')
+        print(str.format('generating {0} rows into {1}', args.rows, template), file=sys.stderr)
+        generate(template, args.rows, args.port, args.hosts)
+
+    config = {
+        'count': args.count,
+        'workers': args.workers,
+        'batch_size': args.batch_size,
+        'max_attempts': args.max_attempts,
+        'latency_ms': args.latency_ms,
+        'payload_size': args.payload_size,
+        'error_rate': args.error_rate,
+        'hosts': args.hosts,
+        'rows': args.rows if args.db is None else None
+    }
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+
+    # several 127.0.0.x hosts require listening on all addresses
+    bind = '' if args.hosts > 1 else '127.0.0.1'
+    with StubHttpServer(args.port, args.latency_ms, args.payload_size, args.error_rate, bind):
+        for name in names:
+            db = os.path.join(args.work_dir, name + '.db')
+            shutil.copyfile(template, db)
+
+            queue = context.Queue()
+            process = context.Process(target=_scenario_process, args=(name, db, config, queue), name=name)
+            process.start()
+            result = queue.get()
+            process.join()
+
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+            os.remove(db)
+
+    report = {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'config': config,
+        'scenarios': results
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, nagle's algorithm would delay body by delayed ack of client
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server  # type: StubHttpServer
+
+        if server.latency_ms > 0:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency_ms / 1000.0)
+
+        if server.error_rate > 0 and random.random() < server.error_rate:
+            code, body = 500, b'stub error'
+        else:
+            code, body = 200, server.payload
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubHttpServer(ThreadingHTTPServer):
+    """
+    local http server answering every GET with payload_size bytes after latency_ms (+-50%)
+    or with 500 response with error_rate probability
+    """
+    daemon_threads = True
+    # default backlog of 5 drops connects of concurrent clients, which are retried only after a second
+    request_queue_size = 1024
+
+    def __init__(self,
+                 port: int = 0,
+                 latency_ms: float = 0,
+                 payload_size: int = 1024,
+                 error_rate: float = 0.0,
+                 bind: str = '127.0.0.1'):
+        """
+        :param port: listened port, 0 - any free port
+        :param latency_ms: average delay of response
+        :param payload_size: size of successful response body
+        :param error_rate: part of responses with 500 status
+        :param bind: listened address, '' - all addresses (required for several 127.0.0.x hosts on some systems)
+        """
+        assert latency_ms >= 0
+        assert payload_size >= 0
+        assert 0.0 <= error_rate <= 1.0
+
+        super().__init__((bind, port), _StubHandler)
+
+        self.latency_ms = latency_ms  # type: float
+        self.payload = b'x' * payload_size  # type: bytes
+        self.error_rate = error_rate  # type: float
+        self.__thread = None  # type: threading.Thread
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.serve_forever, name='stub-http', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        if self.__thread is not None:
+            self.shutdown()
+            self.server_close()
+            self.__thread.join()
+            self.__thread = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='stub http server for benchmarks')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--bind', default='127.0.0.1')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--payload-size', type=int, default=1024)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    server = StubHttpServer(args.port, args.latency_ms, args.payload_size, args.error_rate, args.bind)
+    print(str.format('listening on {0}:{1}', args.bind or '*', server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
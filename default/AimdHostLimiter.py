@@ -0,0 +1,225 @@
+import time
+import asyncio
+from collections import deque
+from typing import Optional, Dict, Set, List, Iterable
+
+from AsyncEntityLoader import AsyncHostLimiter
+from EntityLoader import LoadResult
+
+
+class _HostLimit(object):
+    __slots__ = ('limit', 'in_flight', 'waiters', 'samples', 'calls', 'errors', 'saturated', 'baseline', 'p95', 'decreased_at')
+
+    def __init__(self, limit: int):
+        self.limit = limit  # type: int
+        self.in_flight = 0  # type: int
+        self.waiters = deque()  # type: deque
+        self.samples = []  # type: List[float]
+        self.calls = 0  # type: int
+        self.errors = 0  # type: int
+        self.saturated = False  # type: bool
+        self.baseline = None  # type: Optional[float]
+        self.p95 = None  # type: Optional[float]
+        self.decreased_at = 0.0  # type: float
+
+
+class AimdHostLimiter(AsyncHostLimiter):
+    """
+    additive increase / multiplicative decrease of simultaneous loads of every host for AsyncEntityLoader.
+
+    after every window_size loads of host its limit is:
+    - multiplied by decrease_factor, when part of failed loads (exceptions and 5xx responses) exceeds error_rate
+      or p95 of load duration exceeds latency_tolerance times baseline of host;
+    - increased by one, when window was healthy and host used its whole limit during it.
+    baseline falls to every lower p95 at once and rises to every higher p95 by baseline_decay part of the gap,
+    so one fast window is forgotten in a few windows and a host, which got slower, gets a new baseline
+    instead of min_limit forever.
+    429 and 503 responses decrease limit at once, but not more often than every cooldown_ms.
+    Every change is kept in changes() with its reason.
+    Pass this object as host filter of LoadContextManagerSQLite to claim objects of hosts below their limits only.
+    """
+
+    def __init__(self,
+                 initial_limit: int = 4,
+                 min_limit: int = 1,
+                 max_limit: int = 64,
+                 window_size: int = 20,
+                 latency_tolerance: float = 2.0,
+                 baseline_decay: float = 0.1,
+                 error_rate: float = 0.1,
+                 decrease_factor: float = 0.5,
+                 overload_statuses: Iterable[int] = (429, 503),
+                 cooldown_ms: int = 1000,
+                 history_size: int = 1000):
+        """
+        :param initial_limit: limit of host without observed loads
+        :param min_limit: the lowest limit
+        :param max_limit: the highest limit
+        :param window_size: count of loads of host between limit evaluations
+        :param latency_tolerance: allowed growth of p95 of load duration relative to baseline
+        :param baseline_decay: part of the gap between higher p95 of window and baseline added to baseline
+        :param error_rate: allowed part of failed loads in window
+        :param decrease_factor: multiplier of limit on decrease
+        :param overload_statuses: status codes decreasing limit at once
+        :param cooldown_ms: minimum interval between immediate decreases of host
+        :param history_size: count of kept limit changes
+        """
+        assert 0 < min_limit <= initial_limit <= max_limit
+        assert window_size > 0
+        assert latency_tolerance >= 1.0
+        assert 0.0 < baseline_decay <= 1.0
+        assert 0.0 <= error_rate < 1.0
+        assert 0.0 < decrease_factor < 1.0
+        assert cooldown_ms >= 0
+
+        self.__initial_limit = initial_limit  # type: int
+        self.__min_limit = min_limit  # type: int
+        self.__max_limit = max_limit  # type: int
+        self.__window_size = window_size  # type: int
+        self.__latency_tolerance = latency_tolerance  # type: float
+        self.__baseline_decay = baseline_decay  # type: float
+        self.__error_rate = error_rate  # type: float
+        self.__decrease_factor = decrease_factor  # type: float
+        self.__overload_statuses = frozenset(overload_statuses)
+        self.__cooldown = cooldown_ms / 1000.0  # type: float
+        self.__hosts = {}  # type: Dict[str, _HostLimit]
+        self.__changes = deque(maxlen=history_size)  # type: deque
+
+    def limits(self) -> Dict[str, int]:
+        return {host: host_limit.limit for host, host_limit in self.__hosts.items()}
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        :return: limit, loads in flight, p95 of the last window and baseline (ms) of every host
+        """
+        return {
+            host: {
+                'limit': host_limit.limit,
+                'in_flight': host_limit.in_flight,
+                'waiting': len(host_limit.waiters),
+                'p95_ms': round(host_limit.p95 * 1000, 3) if host_limit.p95 is not None else None,
+                'baseline_ms': round(host_limit.baseline * 1000, 3) if host_limit.baseline is not None else None
+            }
+            for host, host_limit in self.__hosts.items()
+        }
+
+    def changes(self) -> List[dict]:
+        """
+        :return: the last limit changes: time (unix), host, old and new limit and reason
+        """
+        return list(self.__changes)
+
+    def blocked_hosts(self) -> Set[str]:
+        """
+        :return: hosts using their whole limit
+        """
+        return {host for host, host_limit in self.__hosts.items() if host and host_limit.in_flight >= host_limit.limit}
+
+    async def acquire(self, host: str):
+        host_limit = self.__host(host)
+
+        while host_limit.in_flight >= host_limit.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            host_limit.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in host_limit.waiters:
+                    host_limit.waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # woken, but cancelled before taking the slot: it goes to the next waiter
+                    self.__wake(host_limit)
+                raise
+
+        host_limit.in_flight += 1
+        if host_limit.in_flight >= host_limit.limit:
+            host_limit.saturated = True
+
+    def release(self, host: str, duration: Optional[float], load_result: Optional[LoadResult], error: Optional[Exception]):
+        host_limit = self.__host(host)
+        host_limit.in_flight -= 1
+
+        status_code = getattr(load_result, 'status_code', None)
+        now = time.monotonic()
+
+        if status_code in self.__overload_statuses:
+            if now - host_limit.decreased_at >= self.__cooldown:
+                self.__decrease(host, host_limit, now, str.format('status {0}', status_code))
+        elif duration is not None and now - duration < host_limit.decreased_at:
+            # load started before the last decrease tells about the old limit
+            pass
+        elif duration is not None or error is not None:
+            # loads cancelled before they finished have neither duration nor error
+            host_limit.calls += 1
+            host_limit.errors += error is not None or (status_code is not None and status_code >= 500)
+            if duration is not None:
+                host_limit.samples.append(duration)
+            if host_limit.calls >= self.__window_size:
+                self.__evaluate(host, host_limit, now)
+
+        self.__wake(host_limit)
+
+    def __host(self, host: str) -> _HostLimit:
+        host_limit = self.__hosts.get(host)
+        if host_limit is None:
+            host_limit = self.__hosts[host] = _HostLimit(self.__initial_limit)
+        return host_limit
+
+    def __evaluate(self, host: str, host_limit: _HostLimit, now: float):
+        samples = sorted(host_limit.samples)
+        p95 = samples[min(len(samples) - 1, int(0.95 * len(samples)))] if samples else None
+        error_rate = host_limit.errors / host_limit.calls
+
+        host_limit.p95 = p95
+        # window is compared with baseline of previous windows
+        baseline = host_limit.baseline if host_limit.baseline is not None else p95
+        if p95 is not None:
+            if p95 <= baseline:
+                host_limit.baseline = p95
+            else:
+                host_limit.baseline = baseline + self.__baseline_decay * (p95 - baseline)
+
+        if error_rate > self.__error_rate:
+            self.__decrease(host, host_limit, now, str.format('error rate {0:.2f} > {1:.2f}', error_rate, self.__error_rate))
+        elif p95 is not None and p95 > self.__latency_tolerance * baseline:
+            self.__decrease(host, host_limit, now, str.format(
+                'p95 {0:.1f}ms > {1} x baseline {2:.1f}ms', p95 * 1000, self.__latency_tolerance, baseline * 1000
+            ))
+        elif host_limit.saturated and host_limit.limit < self.__max_limit:
+            self.__change(host, host_limit, host_limit.limit + 1, str.format(
+                'healthy: p95 {0:.1f}ms, error rate {1:.2f}', (p95 or 0.0) * 1000, error_rate
+            ))
+            self.__reset_window(host_limit)
+        else:
+            self.__reset_window(host_limit)
+
+    def __decrease(self, host: str, host_limit: _HostLimit, now: float, reason: str):
+        host_limit.decreased_at = now
+        self.__change(host, host_limit, max(self.__min_limit, int(host_limit.limit * self.__decrease_factor)), reason)
+        self.__reset_window(host_limit)
+
+    def __change(self, host: str, host_limit: _HostLimit, limit: int, reason: str):
+        if limit == host_limit.limit:
+            return
+        self.__changes.append({
+            'time': time.time(),
+            'host': host,
+            'old': host_limit.limit,
+            'new': limit,
+            'reason': reason
+        })
+        host_limit.limit = limit
+
+    def __reset_window(self, host_limit: _HostLimit):
+        host_limit.samples = []
+        host_limit.calls = 0
+        host_limit.errors = 0
+        host_limit.saturated = host_limit.in_flight >= host_limit.limit
+
+    def __wake(self, host_limit: _HostLimit):
+        free = host_limit.limit - host_limit.in_flight
+        while free > 0 and host_limit.waiters:
+            waiter = host_limit.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
@@ -0,0 +1,90 @@
+import json
+import aiohttp
+from typing import Optional
+
+from AsyncEntityLoader import AsyncLoadBehaviour
+from EntityLoader import LoadResult, LoadContext
+from default.HttpLoadBehaviour import HttpLoadResult
+from default.SpillStore import SpillStore
+
+
+class AsyncHttpLoadResult(HttpLoadResult):
+    @property
+    def status_code(self) -> int:
+        return self.result.status
+
+    @property
+    def encoding(self) -> Optional[str]:
+        return self.result.charset
+
+
+class AsyncHttpLoadBehaviour(AsyncLoadBehaviour):
+    """
+    aiohttp based implementation of AsyncLoadBehaviour
+    session is created on first load, so it belongs to running event loop
+    """
+    def __init__(self, limit: int = 100, limit_per_host: int = 0, spill_store: Optional[SpillStore] = None):
+        """
+        :param limit: limit of simultaneous connections, 0 - no limit
+        :param limit_per_host: limit of simultaneous connections per host, 0 - no limit
+        :param spill_store: if set, bodies are streamed by chunks into it and results carry Body handles
+        """
+        self.__limit = limit  # type: int
+        self.__limit_per_host = limit_per_host  # type: int
+        self.__spill_store = spill_store  # type: Optional[SpillStore]
+        self.__session = None  # type: Optional[aiohttp.ClientSession]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    def __get_session(self) -> aiohttp.ClientSession:
+        if self.__session is None:
+            connector = aiohttp.TCPConnector(limit=self.__limit, limit_per_host=self.__limit_per_host)
+            self.__session = aiohttp.ClientSession(connector=connector)
+        return self.__session
+
+    async def load(self, obj: LoadContext) -> Optional[LoadResult]:
+
+        j_headers = json.loads(obj.headers) if obj.headers else None
+        j_params = json.loads(obj.params) if obj.params else None
+
+        async with self.__get_session().get(obj.Resource, headers=j_headers, params=j_params) as resp:
+            if self.__spill_store is None:
+                raw_data = await resp.read()
+            else:
+                writer = self.__spill_store.writer()
+                try:
+                    async for chunk in resp.content.iter_chunked(self.__spill_store.chunk_size):
+                        writer.write(chunk)
+                except BaseException:
+                    writer.abort()
+                    raise
+                raw_data = writer.close()
+
+        load_result = AsyncHttpLoadResult(
+            result=resp,
+            current_context=obj,
+            resp_text_data=None,
+            resp_raw_data=raw_data,
+            resp_additional_info=None
+        )
+
+        return load_result
+
+    async def pre_load(self, obj: LoadContext):
+        pass
+
+    async def handle_error(self, load_context: LoadContext, load_result: LoadResult, error_text: str):
+        pass
+
+    async def post_load(self, load_result: LoadResult):
+        if self.__spill_store is not None:
+            self.__spill_store.collect_if_due()
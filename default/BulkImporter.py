@@ -0,0 +1,235 @@
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import argparse
+from datetime import datetime, timezone
+from typing import Optional, Iterator, Iterable, List, Callable, Union
+
+from StateMachine import State, host_of
+from default.LoadContextManagerSQLite import request_fingerprint
+from default.SQLiteStorage import SQLiteStorage
+
+
+class ImportStats(object):
+    def __init__(self):
+        self.read = 0  # type: int
+        self.inserted = 0  # type: int
+        self.started_at = time.perf_counter()  # type: float
+        self.finished_at = None  # type: Optional[float]
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    @property
+    def rows_per_second(self) -> float:
+        duration = self.duration
+        return self.read / duration if duration > 0 else 0.0
+
+    def __str__(self):
+        return str.format(
+            'read: {0}, inserted: {1}, skipped: {2}, {3:.1f}s, {4:.0f} rows/s',
+            self.read, self.inserted, self.read - self.inserted, self.duration, self.rows_per_second
+        )
+
+
+def read_jsonl(path: str) -> Iterator[dict]:
+    """
+    streams objects of json lines file, blank lines are skipped
+    :param path: path to file, '-' - stdin
+    """
+    stream = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8')
+    try:
+        for line_number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise ValueError(str.format('{0}:{1}: {2}', path, line_number, str(e)))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+class BulkImporter(object):
+    """
+    inserts resources into "resource" and "http_params" tables by chunked executemany,
+    committing every chunks_per_transaction chunks.
+    Every entry is an object with "resource" and optional "uid", "params", "headers", "priority" and "parent_uid"
+    (params and headers are json objects or json-serialized strings, higher priority is loaded first,
+    parent_uid is uid of resource, which response linked this one)
+    """
+
+    __resource_sql = '''
+insert {0} into
+    "resource"
+("uid", "resource", "host", "state", attempt_count, last_attempt, "error", last_update, "version", next_attempt_at, "priority", "parent_uid")
+values
+(:uid, :resource, :host, :state, 0, null, null, :last_update, 1, null, :priority, :parent_uid)
+'''
+
+    __http_params_sql = '''
+insert {0} into
+    "http_params"
+("uid", "resource", "headers", "params", "fingerprint")
+values
+(:uid, :resource, :headers, :params, :fingerprint)
+'''
+
+    def __init__(self,
+                 connection_string: Union[str, SQLiteStorage],
+                 chunk_size: int = 5000,
+                 chunks_per_transaction: int = 20,
+                 dedup: bool = True,
+                 progress: Optional[Callable[[ImportStats], None]] = None):
+        """
+        :param connection_string: path to sqlite database or storage shared with other dao's
+        :param chunk_size: count of rows inserted by one executemany
+        :param chunks_per_transaction: count of chunks committed together
+        :param dedup: entries with existing uid are skipped, otherwise import fails on them
+        :param progress: called after every chunk
+        """
+        assert connection_string
+        assert chunk_size > 0
+        assert chunks_per_transaction > 0
+
+        self.__storage = SQLiteStorage.of(connection_string)  # type: SQLiteStorage
+        self.__connection = None  # type: sqlite3.Connection
+        self.__is_closed = False
+        self.__chunk_size = chunk_size  # type: int
+        self.__chunks_per_transaction = chunks_per_transaction  # type: int
+        self.__dedup = dedup  # type: bool
+        self.__progress = progress
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        if not self.__connection:
+            self.__storage.open()
+            self.__connection = self.__storage.connection
+
+    def close(self):
+        if self.__connection and (not self.__is_closed):
+            self.__storage.close()
+            self.__connection = None
+            self.__is_closed = True
+
+    def import_file(self, path: str) -> ImportStats:
+        return self.import_entries(read_jsonl(path))
+
+    def import_entries(self, entries: Iterable[dict]) -> ImportStats:
+        assert self.__connection
+
+        stats = ImportStats()
+        or_ignore = 'or ignore' if self.__dedup else ''
+        resource_sql = self.__resource_sql.format(or_ignore)
+        http_params_sql = self.__http_params_sql.format(or_ignore)
+
+        chunks = 0
+        try:
+            for chunk in self.__chunks(entries):
+                resource_rows, http_params_rows = self.__to_rows(chunk)
+
+                cursor = self.__connection.executemany(resource_sql, resource_rows)
+                stats.inserted += cursor.rowcount
+                self.__connection.executemany(http_params_sql, http_params_rows)
+                stats.read += len(chunk)
+
+                chunks += 1
+                if chunks % self.__chunks_per_transaction == 0:
+                    self.__connection.commit()
+
+                if self.__progress:
+                    self.__progress(stats)
+
+            self.__connection.commit()
+        except Exception:
+            self.__connection.rollback()
+            raise
+        finally:
+            stats.finished_at = time.perf_counter()
+
+        return stats
+
+    def __chunks(self, entries: Iterable[dict]) -> Iterator[List[dict]]:
+        chunk = []
+        for entry in entries:
+            chunk.append(entry)
+            if len(chunk) >= self.__chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def __to_rows(self, chunk: List[dict]):
+        now = int(datetime.now(timezone.utc).timestamp() * 1000000)
+        resource_rows = []
+        http_params_rows = []
+
+        for entry in chunk:
+            resource = entry['resource']
+            uid = uuid.UUID(entry['uid']).urn if entry.get('uid') else uuid.uuid4().urn
+            params = self.__to_json(entry.get('params'))
+            headers = self.__to_json(entry.get('headers'))
+
+            resource_rows.append({
+                'uid': uid,
+                'resource': resource,
+                'host': host_of(resource),
+                'state': State.CREATED,
+                'last_update': now,
+                'priority': int(entry.get('priority') or 0),
+                'parent_uid': uuid.UUID(entry['parent_uid']).urn if entry.get('parent_uid') else None
+            })
+            http_params_rows.append({
+                'uid': uid,
+                'resource': resource,
+                'headers': headers,
+                'params': params,
+                'fingerprint': request_fingerprint(resource, params, headers)
+            })
+
+        return resource_rows, http_params_rows
+
+    def __to_json(self, value) -> Optional[str]:
+        if value is None or isinstance(value, str):
+            return value
+        return json.dumps(value, ensure_ascii=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='bulk import of json lines file into resource and http_params tables')
+    parser.add_argument('file', help='json lines file, "-" - stdin')
+    parser.add_argument('--db', required=True, help='path to sqlite database')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--chunks-per-transaction', type=int, default=20)
+    parser.add_argument('--no-dedup', action='store_true', help='fail on existing uid instead of skipping it')
+    parser.add_argument('--quiet', action='store_true', help='do not report progress')
+    args = parser.parse_args(argv)
+
+    def progress(stats: ImportStats):
+        print(str(stats), file=sys.stderr)
+
+    with BulkImporter(
+            args.db,
+            chunk_size=args.chunk_size,
+            chunks_per_transaction=args.chunks_per_transaction,
+            dedup=not args.no_dedup,
+            progress=None if args.quiet else progress
+    ) as importer:
+        stats = importer.import_file(args.file)
+
+    print(str(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import time
+import threading
+from collections import deque
+from typing import Optional, Dict, Set, Iterable
+
+from EntityLoader import LoadListener, LoadContext, LoadResult
+
+
+class _HostCircuit(object):
+    __slots__ = ('state', 'outcomes', 'failures', 'open_until', 'open_duration', 'probes')
+
+    def __init__(self, window_size: int, open_duration: float):
+        self.state = CircuitBreaker.CLOSED  # type: str
+        self.outcomes = deque(maxlen=window_size)  # type: deque
+        self.failures = 0  # type: int
+        self.open_until = 0.0  # type: float
+        self.open_duration = open_duration  # type: float
+        self.probes = 0  # type: int
+
+
+class CircuitBreaker(LoadListener):
+    """
+    circuit breaker of every host, fed by EntityLoader (pass it as listener):
+    closed - loads go on, circuit opens when failure_rate of the last window_size loads
+             (at least min_calls of them) failed;
+    open - objects of host are not claimed (pass this object as host filter of LoadContextManagerSQLite),
+           already claimed ones are released without spending attempts, lasts open_ms;
+    half-open - up to half_open_probes probe loads, success closes circuit, failure opens it again
+                for twice longer time (up to max_open_ms).
+    Failures are exceptions and unsuccessful results, except responses with ignored_statuses,
+    which do not tell anything about health of host. One instance may be shared by threads.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self,
+                 failure_rate: float = 0.5,
+                 window_size: int = 20,
+                 min_calls: int = 5,
+                 open_ms: int = 30000,
+                 max_open_ms: int = 600000,
+                 half_open_probes: int = 1,
+                 ignored_statuses: Iterable[int] = (400, 401, 403, 404, 410)):
+        """
+        :param failure_rate: part of failed loads of window, which opens circuit
+        :param window_size: count of the last loads of host taken into account
+        :param min_calls: minimum count of loads in window to open circuit
+        :param open_ms: first duration of open state
+        :param max_open_ms: maximum duration of open state
+        :param half_open_probes: count of simultaneous probe loads in half-open state
+        :param ignored_statuses: status codes of unsuccessful results, which are not failures of host
+        """
+        assert 0.0 < failure_rate <= 1.0
+        assert 0 < min_calls <= window_size
+        assert 0 < open_ms <= max_open_ms
+        assert half_open_probes > 0
+
+        self.__failure_rate = failure_rate  # type: float
+        self.__window_size = window_size  # type: int
+        self.__min_calls = min_calls  # type: int
+        self.__open_duration = open_ms / 1000.0  # type: float
+        self.__max_open_duration = max_open_ms / 1000.0  # type: float
+        self.__half_open_probes = half_open_probes  # type: int
+        self.__ignored_statuses = frozenset(ignored_statuses)
+        self.__circuits = {}  # type: Dict[str, _HostCircuit]
+        self.__lock = threading.Lock()
+
+    def state_of(self, host: Optional[str]) -> str:
+        with self.__lock:
+            circuit = self.__circuits.get(host)
+            return self.__refresh(circuit, time.monotonic()) if circuit else CircuitBreaker.CLOSED
+
+    def states(self) -> Dict[str, str]:
+        """
+        :return: states of hosts, which circuit is not closed
+        """
+        now = time.monotonic()
+        with self.__lock:
+            states = {host: self.__refresh(circuit, now) for host, circuit in self.__circuits.items()}
+        return {host: state for host, state in states.items() if state != CircuitBreaker.CLOSED}
+
+    def blocked_hosts(self) -> Set[str]:
+        """
+        :return: hosts, which objects must not be claimed: open ones and half-open ones with all probes in flight
+        """
+        return self.__not_loadable_hosts()
+
+    def released_hosts(self) -> Set[str]:
+        """
+        :return: hosts, which claimed, but not loaded objects must be released
+        """
+        return self.__not_loadable_hosts()
+
+    def on_start(self, load_context: LoadContext):
+        host = load_context.host
+        if not host:
+            return
+
+        with self.__lock:
+            circuit = self.__circuits.get(host)
+            if circuit and self.__refresh(circuit, time.monotonic()) == CircuitBreaker.HALF_OPEN:
+                circuit.probes += 1
+
+    def on_outcome(self, load_context: LoadContext, load_result: Optional[LoadResult], error: Optional[Exception]):
+        host = load_context.host
+        if not host:
+            return
+
+        failed = self.__is_failure(load_result, error)
+        now = time.monotonic()
+
+        with self.__lock:
+            circuit = self.__circuits.get(host)
+            if circuit is None:
+                if not failed:
+                    # healthy hosts get circuits only after their first failure
+                    return
+                circuit = self.__circuits[host] = _HostCircuit(self.__window_size, self.__open_duration)
+
+            state = self.__refresh(circuit, now)
+
+            if state == CircuitBreaker.HALF_OPEN:
+                circuit.probes = max(circuit.probes - 1, 0)
+                if failed:
+                    self.__open(circuit, now, min(circuit.open_duration * 2, self.__max_open_duration))
+                else:
+                    self.__close(circuit)
+            elif state == CircuitBreaker.CLOSED:
+                if len(circuit.outcomes) == circuit.outcomes.maxlen and circuit.outcomes[0]:
+                    circuit.failures -= 1
+                circuit.outcomes.append(failed)
+                circuit.failures += failed
+
+                calls = len(circuit.outcomes)
+                if calls >= self.__min_calls and circuit.failures >= self.__failure_rate * calls:
+                    self.__open(circuit, now, circuit.open_duration)
+            # outcomes of loads started before circuit opened are ignored
+
+    def __not_loadable_hosts(self) -> Set[str]:
+        now = time.monotonic()
+        with self.__lock:
+            return {
+                host for host, circuit in self.__circuits.items()
+                if self.__refresh(circuit, now) == CircuitBreaker.OPEN
+                or (circuit.state == CircuitBreaker.HALF_OPEN and circuit.probes >= self.__half_open_probes)
+            }
+
+    def __is_failure(self, load_result: Optional[LoadResult], error: Optional[Exception]) -> bool:
+        if error is not None:
+            return True
+        if load_result is None or load_result.is_success():
+            return False
+        return getattr(load_result, 'status_code', None) not in self.__ignored_statuses
+
+    def __refresh(self, circuit: _HostCircuit, now: float) -> str:
+        if circuit.state == CircuitBreaker.OPEN and now >= circuit.open_until:
+            circuit.state = CircuitBreaker.HALF_OPEN
+            circuit.probes = 0
+        return circuit.state
+
+    def __open(self, circuit: _HostCircuit, now: float, duration: float):
+        circuit.state = CircuitBreaker.OPEN
+        circuit.open_duration = duration
+        circuit.open_until = now + duration
+        circuit.outcomes.clear()
+        circuit.failures = 0
+
+    def __close(self, circuit: _HostCircuit):
+        circuit.state = CircuitBreaker.CLOSED
+        circuit.open_duration = self.__open_duration
+        circuit.outcomes.clear()
+        circuit.failures = 0
@@ -0,0 +1,183 @@
+import copy
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict
+
+from AsyncEntityLoader import AsyncLoadBehaviour
+from EntityLoader import LoadBehaviour, LoadResult, LoadContext
+from default.LoadContextManagerSQLite import request_fingerprint
+
+
+def _fingerprint(obj: LoadContext) -> str:
+    if obj.fingerprint is None:
+        obj.fingerprint = request_fingerprint(obj.Resource, obj.params, obj.headers)
+    return obj.fingerprint
+
+
+def _for_context(load_result: Optional[LoadResult], obj: LoadContext) -> Optional[LoadResult]:
+    """
+    shallow copy of result bound to another context, so every waiting object changes its own state
+    """
+    if load_result is None:
+        return None
+    result = copy.copy(load_result)
+    result.current_context = obj
+    return result
+
+
+class _RecentResults(object):
+    def __init__(self, ttl_ms: int, max_size: int):
+        self.__ttl = ttl_ms / 1000.0  # type: float
+        self.__max_size = max_size  # type: int
+        self.__results = OrderedDict()  # type: OrderedDict
+
+    def get(self, key: str) -> Optional[LoadResult]:
+        item = self.__results.get(key)
+        if item is None:
+            return None
+        if time.monotonic() - item[0] > self.__ttl:
+            del self.__results[key]
+            return None
+        return item[1]
+
+    def put(self, key: str, load_result: Optional[LoadResult]):
+        if self.__ttl <= 0 or load_result is None:
+            return
+        self.__results[key] = (time.monotonic(), load_result)
+        self.__results.move_to_end(key)
+        while len(self.__results) > self.__max_size:
+            self.__results.popitem(last=False)
+
+
+class _InFlight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None  # type: Optional[LoadResult]
+        self.error = None  # type: Optional[Exception]
+
+
+class CoalescingLoadBehaviour(LoadBehaviour):
+    """
+    LoadBehaviour wrapper, which makes one network call for identical requests (equal fingerprints):
+    a request waits for identical request in flight in another thread or takes result completed
+    less than ttl_ms ago. Every object gets its own copy of result, so it goes through its own
+    StateMachine.change_state. Share one instance between workers of ThreadPoolRunner.
+    """
+    def __init__(self, load_behaviour: LoadBehaviour, ttl_ms: int = 0, max_recent: int = 1024):
+        """
+        :param load_behaviour: behaviour making actual loads
+        :param ttl_ms: how long completed result is reused, 0 - only requests in flight are coalesced
+        :param max_recent: maximum count of reused completed results
+        """
+        assert load_behaviour
+        assert ttl_ms >= 0
+        assert max_recent > 0
+
+        self.__load_behaviour = load_behaviour
+        self.__recent = _RecentResults(ttl_ms, max_recent)
+        self.__in_flight = {}  # type: Dict[str, _InFlight]
+        self.__lock = threading.Lock()
+        self.coalesced = 0  # type: int
+
+    def load(self, obj: LoadContext) -> Optional[LoadResult]:
+        key = _fingerprint(obj)
+
+        with self.__lock:
+            recent = self.__recent.get(key)
+            if recent is not None:
+                self.coalesced += 1
+                return _for_context(recent, obj)
+
+            in_flight = self.__in_flight.get(key)
+            owner = in_flight is None
+            if owner:
+                in_flight = _InFlight()
+                self.__in_flight[key] = in_flight
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return _for_context(in_flight.result, obj)
+
+        try:
+            in_flight.result = self.__load_behaviour.load(obj)
+            return in_flight.result
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__in_flight[key]
+                self.__recent.put(key, in_flight.result)
+            in_flight.done.set()
+
+    def pre_load(self, obj: LoadContext):
+        self.__load_behaviour.pre_load(obj)
+
+    def handle_error(self, load_context: LoadContext, load_result: LoadResult, error_text: str):
+        self.__load_behaviour.handle_error(load_context, load_result, error_text)
+
+    def post_load(self, load_result: LoadResult):
+        self.__load_behaviour.post_load(load_result)
+
+
+class AsyncCoalescingLoadBehaviour(AsyncLoadBehaviour):
+    """
+    asynchronous counterpart of CoalescingLoadBehaviour for AsyncEntityLoader
+    """
+    def __init__(self, load_behaviour: AsyncLoadBehaviour, ttl_ms: int = 0, max_recent: int = 1024):
+        assert load_behaviour
+        assert ttl_ms >= 0
+        assert max_recent > 0
+
+        self.__load_behaviour = load_behaviour
+        self.__recent = _RecentResults(ttl_ms, max_recent)
+        self.__in_flight = {}  # type: Dict[str, asyncio.Future]
+        self.coalesced = 0  # type: int
+
+    async def load(self, obj: LoadContext) -> Optional[LoadResult]:
+        key = _fingerprint(obj)
+
+        recent = self.__recent.get(key)
+        if recent is not None:
+            self.coalesced += 1
+            return _for_context(recent, obj)
+
+        in_flight = self.__in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+            return _for_context(await asyncio.shield(in_flight), obj)
+
+        in_flight = asyncio.get_running_loop().create_future()
+        self.__in_flight[key] = in_flight
+        try:
+            result = await self.__load_behaviour.load(obj)
+            self.__recent.put(key, result)
+            in_flight.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            # waiters are not cancelled with owner, their loads fail as usual and are retried
+            in_flight.set_exception(RuntimeError('coalesced load was cancelled'))
+            in_flight.exception()
+            raise
+        except Exception as e:
+            in_flight.set_exception(e)
+            # retrieve exception, so it is not reported when nobody waits for it
+            in_flight.exception()
+            raise
+        finally:
+            del self.__in_flight[key]
+
+    async def pre_load(self, obj: LoadContext):
+        await self.__load_behaviour.pre_load(obj)
+
+    async def handle_error(self, load_context: LoadContext, load_result: LoadResult, error_text: str):
+        await self.__load_behaviour.handle_error(load_context, load_result, error_text)
+
+    async def post_load(self, load_result: LoadResult):
+        await self.__load_behaviour.post_load(load_result)
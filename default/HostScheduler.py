@@ -0,0 +1,76 @@
+import fnmatch
+from typing import Optional, Iterable, Tuple, Dict, List, Set
+
+
+class HostScheduler(object):
+    """
+    smooth weighted round-robin over hosts (as nginx upstreams): a host of weight w gets w of every
+    sum-of-weights picks, picks of one host are spread evenly instead of coming in a row.
+    Current weights are kept between pick() calls, so fairness holds across claimed batches.
+    """
+
+    def __init__(self, weights: Iterable[Tuple[str, int]] = (), default_weight: int = 1):
+        """
+        :param weights: (host pattern, weight) - fnmatch patterns of hosts with own weight, the first matched is used
+        :param default_weight: weight of other hosts (and objects without host)
+        """
+        assert default_weight > 0
+
+        self.__rules = [(pattern.lower(), weight) for pattern, weight in weights]  # type: List[Tuple[str, int]]
+        for _, weight in self.__rules:
+            assert weight > 0
+        self.__default_weight = default_weight  # type: int
+        self.__weights = {}  # type: Dict[Optional[str], int]
+        self.__current = {}  # type: Dict[Optional[str], int]
+
+    @property
+    def hosts(self) -> List[Optional[str]]:
+        return list(self.__current)
+
+    def weight_of(self, host: Optional[str]) -> int:
+        weight = self.__weights.get(host)
+        if weight is None:
+            weight = self.__default_weight
+            for pattern, rule_weight in self.__rules:
+                if fnmatch.fnmatchcase(host or '', pattern):
+                    weight = rule_weight
+                    break
+            self.__weights[host] = weight
+        return weight
+
+    def set_hosts(self, hosts: Iterable[Optional[str]]):
+        """
+        replaces scheduled hosts, remaining hosts keep their current weights
+        """
+        self.__current = {host: self.__current.get(host, 0) for host in hosts}
+
+    def remove(self, host: Optional[str]):
+        self.__current.pop(host, None)
+
+    def pick(self, count: int, exclude_hosts: Set[str] = frozenset()) -> List[Optional[str]]:
+        """
+        :param count: count of picks
+        :param exclude_hosts: hosts skipped by this call, they do not gain current weight
+        :return: sequence of picked hosts, empty if there are no hosts to pick
+        """
+        hosts = [host for host in self.__current if host not in exclude_hosts]
+        if not hosts:
+            return []
+
+        weights = [self.weight_of(host) for host in hosts]
+        total = sum(weights)
+        current = self.__current
+        picked = []
+
+        for _ in range(count):
+            # index, not host: None is a host too (objects without host)
+            best_index = -1
+            for index, (host, weight) in enumerate(zip(hosts, weights)):
+                current[host] += weight
+                if best_index < 0 or current[host] > current[hosts[best_index]]:
+                    best_index = index
+            best = hosts[best_index]
+            current[best] -= total
+            picked.append(best)
+
+        return picked
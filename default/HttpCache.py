@@ -0,0 +1,218 @@
+import time
+import sqlite3
+from typing import Optional, Dict, Union, Set
+
+from default.SpillStore import SpillStore, Body, InlineBody, SpilledBody
+from default.SQLiteStorage import SQLiteStorage
+
+
+class HttpCacheEntry(object):
+    def __init__(self,
+                 key: str,
+                 etag: Optional[str],
+                 last_modified: Optional[str],
+                 body: Body,
+                 encoding: Optional[str]):
+        self.Key = key
+        self.ETag = etag
+        self.LastModified = last_modified
+        self.Body = body
+        self.Encoding = encoding
+
+    def validators(self) -> Dict[str, str]:
+        """
+        :return: headers of conditional request
+        """
+        headers = {}
+        if self.ETag:
+            headers['If-None-Match'] = self.ETag
+        if self.LastModified:
+            headers['If-Modified-Since'] = self.LastModified
+        return headers
+
+
+class HttpValidatorCache(object):
+    """
+    cache of response bodies with their ETag / Last-Modified validators, stored in "http_cache" table
+    bodies are kept inline in the table or referenced by SpillStore digest,
+    least recently used entries are evicted when total size of bodies exceeds max_bytes
+    (evicted entries do not remove spilled files, they can be shared with other bodies,
+    SpillStore.collect(keep=digests()) removes files of evicted entries)
+    """
+
+    def __init__(self, connection_string: Union[str, SQLiteStorage], max_bytes: int = 256 * 1024 * 1024, spill_store: Optional[SpillStore] = None):
+        """
+        :param connection_string: path to sqlite database or storage shared with other dao's
+        :param max_bytes: maximum total size of cached bodies
+        :param spill_store: store of spilled bodies, the one of HttpLoadBehaviour,
+                            without it SpilledBody is copied into the table
+        """
+        assert connection_string
+        assert max_bytes > 0
+
+        self.__storage = SQLiteStorage.of(connection_string)  # type: SQLiteStorage
+        self.__connection = None  # type: sqlite3.Connection
+        self.__is_closed = False
+        self.__max_bytes = max_bytes  # type: int
+        self.__spill_store = spill_store  # type: Optional[SpillStore]
+        self.__total_size = 0  # type: int
+        self.hits = 0  # type: int
+        self.misses = 0  # type: int
+        self.evictions = 0  # type: int
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        if not self.__connection:
+            self.__storage.open()
+            self.__connection = self.__storage.connection
+            self.__total_size = self.__connection.execute('select coalesce(sum("size"), 0) from "http_cache"').fetchone()[0]
+
+    def close(self):
+        if self.__connection and (not self.__is_closed):
+            self.__storage.close()
+            self.__connection = None
+            self.__is_closed = True
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': self.__total_size
+        }
+
+    def digests(self) -> Set[str]:
+        """
+        :return: digests of spilled bodies referenced by cache
+        """
+        cursor = self.__connection.execute('select distinct "body_digest" from "http_cache" where "body_digest" is not null')
+        digests = {row[0] for row in cursor}
+        cursor.close()
+        return digests
+
+    def get(self, key: str) -> Optional[HttpCacheEntry]:
+        sql = '''
+select
+    "key",
+    "etag",
+    "last_modified",
+    "body",
+    "body_digest",
+    "encoding"
+from
+    "http_cache"
+where
+    "key" = :key
+'''
+        cursor = self.__connection.execute(sql, {'key': key})
+        row = cursor.fetchone()
+        cursor.close()
+        if row is None:
+            return None
+
+        if row[4] is not None:
+            body = self.__spill_store.get(row[4]) if self.__spill_store else None
+            if body is None:
+                # spilled file is gone, entry can not be validated anymore
+                self.__delete(key)
+                return None
+        else:
+            body = InlineBody(row[3] or b'')
+
+        return HttpCacheEntry(row[0], row[1], row[2], body, row[5])
+
+    def hit(self, key: str):
+        """
+        registers use of entry, which makes it the most recently used one
+        """
+        self.hits += 1
+        self.__connection.execute(
+            'update "http_cache" set "last_access" = :last_access where "key" = :key',
+            {'key': key, 'last_access': self.__now()}
+        )
+        self.__connection.commit()
+
+    def miss(self):
+        self.misses += 1
+
+    def put(self,
+            key: str,
+            etag: Optional[str],
+            last_modified: Optional[str],
+            body: Union[bytes, Body],
+            encoding: Optional[str]):
+        """
+        stores body with its validators, responses without validators are not stored.
+        SpilledBody is referenced by digest, when cache has spill store, and copied into the table otherwise
+        """
+        if not etag and not last_modified:
+            return
+
+        if isinstance(body, SpilledBody) and self.__spill_store is not None:
+            inline, digest, size = None, body.digest, body.size
+        elif isinstance(body, Body) and body.size > self.__max_bytes:
+            return
+        else:
+            data = body.bytes() if isinstance(body, Body) else body
+            inline, digest, size = data, None, len(data)
+
+        if size > self.__max_bytes:
+            return
+
+        sql = '''
+insert into
+    "http_cache"
+("key", "etag", "last_modified", "body", "body_digest", "encoding", "size", "last_access")
+values
+(:key, :etag, :last_modified, :body, :body_digest, :encoding, :size, :last_access)
+'''
+        args = {
+            'key': key,
+            'etag': etag,
+            'last_modified': last_modified,
+            'body': inline,
+            'body_digest': digest,
+            'encoding': encoding,
+            'size': size,
+            'last_access': self.__now()
+        }
+
+        self.__delete(key, commit=False)
+        self.__connection.execute(sql, args)
+        self.__total_size += size
+        self.__evict()
+        self.__connection.commit()
+
+    def __delete(self, key: str, commit: bool = True):
+        cursor = self.__connection.execute('delete from "http_cache" where "key" = :key returning "size"', {'key': key})
+        row = cursor.fetchone()
+        cursor.close()
+        if row is not None:
+            self.__total_size -= row[0]
+        if commit:
+            self.__connection.commit()
+
+    def __evict(self):
+        if self.__total_size <= self.__max_bytes:
+            return
+
+        evicted = []
+        cursor = self.__connection.execute('select "key", "size" from "http_cache" order by "last_access"')
+        for key, size in cursor:
+            if self.__total_size <= self.__max_bytes:
+                break
+            evicted.append({'key': key})
+            self.__total_size -= size
+        cursor.close()
+
+        self.__connection.executemany('delete from "http_cache" where "key" = :key', evicted)
+        self.evictions += len(evicted)
+
+    def __now(self) -> int:
+        return int(time.time() * 1000000)
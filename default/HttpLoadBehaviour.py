@@ -1,41 +1,202 @@
 import json
 import time
+import fnmatch
+import threading
 import requests
-from typing import Optional
+import requests.adapters
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional, Iterable, Tuple, Dict, Set
 
 from EntityLoader import LoadBehaviour, WaitBehaviour, LoadResult, LoadContext
+from default.SpillStore import SpillStore, Body
+from default.HttpCache import HttpValidatorCache
+from default.LoadContextManagerSQLite import request_fingerprint
 
 
 class HttpLoadResult(LoadResult):
+    """
+    resp_raw_data is bytes or Body handle, resp_text_data is decoded from it on first access if missed
+    """
     def __init__(
             self,
             result,
             current_context: LoadContext,
             resp_text_data: Optional[str],
             resp_raw_data,
-            resp_additional_info
+            resp_additional_info,
+            encoding: Optional[str] = None
     ):
+        self.__text_data = None  # type: Optional[str]
+        self.__encoding = encoding  # type: Optional[str]
         super().__init__(result, current_context, resp_text_data,resp_raw_data, resp_additional_info)
 
+    @property
+    def resp_text_data(self) -> Optional[str]:
+        if self.__text_data is None and self.resp_raw_data is not None:
+            if isinstance(self.resp_raw_data, Body):
+                self.__text_data = self.resp_raw_data.text(self.encoding)
+            else:
+                self.__text_data = self.resp_raw_data.decode(self.encoding or 'utf-8', errors='replace')
+        return self.__text_data
+
+    @resp_text_data.setter
+    def resp_text_data(self, value: Optional[str]):
+        self.__text_data = value
+
+    @property
+    def status_code(self) -> int:
+        return self.result.status_code
+
+    @property
+    def encoding(self) -> Optional[str]:
+        return self.__encoding or self.result.encoding
+
     def is_success(self) -> bool:
-        return self.result.status_code < 400
+        return self.status_code < 400
+
+
+class HttpSessionPool(object):
+    """
+    requests.Session with keep-alive connection pool per host
+    session is not shared between threads, every worker should own its pool
+    """
+    def __init__(self,
+                 pool_connections: int = 10,
+                 pool_maxsize: int = 10,
+                 connect_timeout: Optional[float] = 5.0,
+                 read_timeout: Optional[float] = 30.0):
+        """
+        :param pool_connections: count of hosts, which pools are kept
+        :param pool_maxsize: count of keep-alive connections kept for a host
+        :param connect_timeout: connect timeout in seconds, None - no timeout
+        :param read_timeout: read timeout in seconds, None - no timeout
+        """
+        assert pool_connections > 0
+        assert pool_maxsize > 0
+
+        self.__adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.__session = requests.Session()
+        self.__session.mount('http://', self.__adapter)
+        self.__session.mount('https://', self.__adapter)
+        self.__timeout = (connect_timeout, read_timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.__session.close()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.__session.get(url, timeout=self.__timeout, **kwargs)
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        :return: statistics by host: opened connections, sent requests, idle connections
+                 and ratio of requests sent over reused connections; 'total' - sum over hosts
+        """
+        result = {}  # type: Dict[str, dict]
+        pools = self.__adapter.poolmanager.pools
+
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            result['{0}://{1}:{2}'.format(key.key_scheme, key.key_host, key.key_port)] = self.__pool_stats(
+                pool.num_connections,
+                pool.num_requests,
+                sum(1 for connection in list(pool.pool.queue) if connection is not None) if pool.pool else 0
+            )
+
+        result['total'] = self.__pool_stats(
+            sum(v['connections'] for v in result.values()),
+            sum(v['requests'] for v in result.values()),
+            sum(v['idle'] for v in result.values())
+        )
+        return result
+
+    def __pool_stats(self, connections: int, requests_count: int, idle: int) -> dict:
+        return {
+            'connections': connections,
+            'requests': requests_count,
+            'idle': idle,
+            'reuse_ratio': 1.0 - connections / requests_count if requests_count else 0.0
+        }
 
 
 class HttpLoadBehaviour(LoadBehaviour):
-    def __init__(self):
-        pass
+    def __init__(self,
+                 session_pool: Optional[HttpSessionPool] = None,
+                 spill_store: Optional[SpillStore] = None,
+                 cache: Optional[HttpValidatorCache] = None):
+        """
+        :param session_pool: pool of keep-alive connections, default pool is created if missed
+        :param spill_store: if set, bodies are streamed by chunks into it and results carry Body handles
+        :param cache: if set, requests are sent with cached validators and 304 responses are served from it,
+                      such results have resp_additional_info == {'cache': 'hit'};
+                      give it the same spill_store, otherwise spilled bodies are copied into its table
+        """
+        self.__session_pool = session_pool or HttpSessionPool()
+        self.__spill_store = spill_store  # type: Optional[SpillStore]
+        self.__cache = cache  # type: Optional[HttpValidatorCache]
+
+    @property
+    def session_pool(self) -> HttpSessionPool:
+        return self.__session_pool
 
     def load(self, obj: LoadContext) -> Optional[LoadResult]:
 
         j_headers = json.loads(obj.headers) if obj.headers else None
         j_params = json.loads(obj.params) if obj.params else None
-        resp = requests.get(obj.Resource, headers=j_headers, params=j_params)
+
+        cache_key = None
+        cached = None
+        if self.__cache is not None:
+            cache_key = request_fingerprint(obj.Resource, obj.params, obj.headers)
+            cached = self.__cache.get(cache_key)
+            if cached is not None:
+                j_headers = dict(j_headers or {}, **cached.validators())
+
+        if self.__spill_store is None:
+            resp = self.__session_pool.get(obj.Resource, headers=j_headers, params=j_params)
+            raw_data = resp.content
+        else:
+            resp = self.__session_pool.get(obj.Resource, headers=j_headers, params=j_params, stream=True)
+            try:
+                raw_data = self.__spill_store.write(resp.iter_content(self.__spill_store.chunk_size))
+            finally:
+                resp.close()
+
+        if cached is not None and resp.status_code == 304:
+            self.__cache.hit(cache_key)
+            return HttpLoadResult(
+                result=resp,
+                current_context=obj,
+                resp_text_data=None,
+                resp_raw_data=cached.Body,
+                resp_additional_info={'cache': 'hit'},
+                encoding=cached.Encoding
+            )
+
+        if self.__cache is not None:
+            self.__cache.miss()
+            if resp.status_code == 200:
+                self.__cache.put(
+                    cache_key,
+                    resp.headers.get('ETag'),
+                    resp.headers.get('Last-Modified'),
+                    raw_data,
+                    resp.encoding
+                )
 
         load_result = HttpLoadResult(
             result=resp,
             current_context=obj,
-            resp_text_data=resp.text,
-            resp_raw_data=resp.content,
+            resp_text_data=None,
+            resp_raw_data=raw_data,
             resp_additional_info=None
         )
 
@@ -48,7 +209,8 @@ class HttpLoadBehaviour(LoadBehaviour):
         pass
 
     def post_load(self, load_result: LoadResult):
-        pass
+        if self.__spill_store is not None:
+            self.__spill_store.collect_if_due(self.__cache.digests() if self.__cache is not None else ())
 
 
 class SimpleWaitBehaviour(WaitBehaviour):
@@ -60,3 +222,123 @@ class SimpleWaitBehaviour(WaitBehaviour):
             return
 
         time.sleep((self.__wait_milliseconds - load_duration) / 1000.0)
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, burst: int):
+        assert rate > 0
+        assert burst > 0
+
+        self.rate = rate  # type: float
+        self.burst = burst  # type: int
+        self.tokens = float(burst)  # type: float
+        self.updated_at = time.monotonic()  # type: float
+        self.blocked_until = 0.0  # type: float
+
+    def refill(self, now: float):
+        self.tokens = min(float(self.burst), self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, now: float) -> float:
+        """
+        takes one token, even if it is not available yet
+        :return: seconds to wait until taken token becomes available
+        """
+        self.refill(now)
+        self.tokens -= 1.0
+        delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(delay, self.blocked_until - now)
+
+    def is_blocked(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens < 1.0 or self.blocked_until > now
+
+
+class TokenBucketWaitBehaviour(WaitBehaviour):
+    """
+    keeps token bucket for every host, so a load waits only for tokens of its own host.
+    429 and 503 responses block their host for Retry-After seconds (retry_after_ms without header).
+    Pass this object as host filter of LoadContextManagerSQLite to claim objects of hosts having tokens only.
+    """
+
+    def __init__(self,
+                 rate: float,
+                 burst: int = 1,
+                 rules: Iterable[Tuple[str, float, int]] = (),
+                 retry_after_ms: int = 1000):
+        """
+        :param rate: default count of loads per second for a host
+        :param burst: default count of loads, which a host may get at once
+        :param rules: (host pattern, rate, burst) - fnmatch patterns of hosts with own rate and burst,
+                      the first matched rule is used
+        :param retry_after_ms: how long host is blocked after 429 or 503 response without Retry-After
+        """
+        assert rate > 0
+        assert burst > 0
+        assert retry_after_ms >= 0
+
+        self.__rate = rate  # type: float
+        self.__burst = burst  # type: int
+        self.__rules = list(rules)  # type: list
+        self.__retry_after = retry_after_ms / 1000.0  # type: float
+        self.__buckets = {}  # type: Dict[str, TokenBucket]
+        self.__lock = threading.Lock()
+
+    def wait(self, load_duration: int):
+        # loads wait for tokens of their hosts in before_load, there is no global delay
+        pass
+
+    def before_load(self, load_context: LoadContext):
+        with self.__lock:
+            delay = self.__bucket(load_context.host or '').reserve(time.monotonic())
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def after_load(self, load_result: Optional[LoadResult]):
+        if load_result is None or getattr(load_result, 'status_code', None) not in (429, 503):
+            return
+
+        retry_after = self.__retry_after_seconds(load_result)
+        now = time.monotonic()
+
+        with self.__lock:
+            bucket = self.__bucket(load_result.current_context.host or '')
+            bucket.refill(now)
+            bucket.tokens = min(bucket.tokens, 0.0)
+            bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+
+    def blocked_hosts(self) -> Set[str]:
+        """
+        :return: hosts without available tokens
+        """
+        now = time.monotonic()
+        with self.__lock:
+            return {host for host, bucket in self.__buckets.items() if host and bucket.is_blocked(now)}
+
+    def __bucket(self, host: str) -> TokenBucket:
+        bucket = self.__buckets.get(host)
+        if bucket is None:
+            rate, burst = self.__rate, self.__burst
+            for pattern, rule_rate, rule_burst in self.__rules:
+                if fnmatch.fnmatch(host, pattern):
+                    rate, burst = rule_rate, rule_burst
+                    break
+            bucket = TokenBucket(rate, burst)
+            self.__buckets[host] = bucket
+        return bucket
+
+    def __retry_after_seconds(self, load_result: LoadResult) -> float:
+        value = load_result.result.headers.get('Retry-After')
+        if not value:
+            return self.__retry_after
+
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return self.__retry_after
@@ -0,0 +1,473 @@
+import os
+import re
+import mmap
+import time
+import zlib
+import uuid
+import struct
+import threading
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Iterable, Tuple, BinaryIO
+
+from StateMachine import State, StateMachineDao
+from default.MemoryStateMachineDao import MemoryStateMachineDao
+
+# length and crc32 of record body
+_HEADER = struct.Struct('<II')
+# op, uid, state, priority, attempt_count (-1 - None), version,
+# last_attempt, last_update, next_attempt_at (microseconds, 0 - None), length of resource, length of error (-1 - None)
+_BODY = struct.Struct('<B16sBiiIqqqIi')
+
+_PUT = 1
+_DELETE = 2
+
+_STATES = (State.CREATED, State.PROCESSING, State.SUCCESSFUL, State.FAILED)
+_STATE_CODES = {state: code for code, state in enumerate(_STATES)}
+
+_SEGMENT_NAME = re.compile(r'^segment-(\d+)\.log$')
+
+
+def _to_int_timestamp(value: Optional[datetime]) -> int:
+    if not value:
+        return 0
+    return int(value.timestamp() * 1000000)
+
+
+def _from_int_timestamp(value: int) -> Optional[datetime]:
+    if not value:
+        return None
+    return datetime.fromtimestamp(value / 1000000.0, timezone.utc)
+
+
+def encode_record(obj: State, deleted: bool = False) -> bytes:
+    """
+    :return: binary record of object state (or of its deletion) with header
+    """
+    resource = (obj.resource or '').encode('utf-8') if not deleted else b''
+    error = obj.error.encode('utf-8') if obj.error is not None and not deleted else None
+
+    if deleted:
+        body = _BODY.pack(_DELETE, obj.uid.bytes, 0, 0, -1, 0, 0, 0, 0, 0, -1)
+    else:
+        body = _BODY.pack(
+            _PUT,
+            obj.uid.bytes,
+            _STATE_CODES[obj.state],
+            obj.priority or 0,
+            obj.attempt_count if obj.attempt_count is not None else -1,
+            obj.version,
+            _to_int_timestamp(obj.last_attempt),
+            _to_int_timestamp(obj.last_update),
+            _to_int_timestamp(obj.next_attempt_at),
+            len(resource),
+            len(error) if error is not None else -1
+        )
+    body = body + resource + (error or b'')
+    return _HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_record(buffer, offset: int) -> Tuple[Optional[State], bool, int]:
+    """
+    :param buffer: bytes or memory map of segment
+    :param offset: offset of record
+    :return: object state, True if it is deletion (only uid is set), size of record
+    :raises ValueError: record is truncated or corrupted
+    """
+    if offset + _HEADER.size > len(buffer):
+        raise ValueError('truncated header')
+    length, crc = _HEADER.unpack_from(buffer, offset)
+    start = offset + _HEADER.size
+    if length < _BODY.size or start + length > len(buffer):
+        raise ValueError('truncated record')
+    if zlib.crc32(buffer[start:start + length]) != crc:
+        raise ValueError('crc mismatch')
+
+    op, uid, state, priority, attempt_count, version, last_attempt, last_update, next_attempt_at, \
+        resource_length, error_length = _BODY.unpack_from(buffer, start)
+    uid = uuid.UUID(bytes=uid)
+    size = _HEADER.size + length
+
+    if op == _DELETE:
+        return State(uid), True, size
+
+    position = start + _BODY.size
+    resource = bytes(buffer[position:position + resource_length]).decode('utf-8')
+    position += resource_length
+    error = bytes(buffer[position:position + error_length]).decode('utf-8') if error_length >= 0 else None
+
+    return State(
+        uid,
+        resource,
+        _STATES[state],
+        attempt_count if attempt_count >= 0 else None,
+        _from_int_timestamp(last_attempt),
+        error,
+        _from_int_timestamp(last_update),
+        version,
+        _from_int_timestamp(next_attempt_at),
+        priority
+    ), False, size
+
+
+class JournalStateMachineDao(StateMachineDao):
+    """
+    ATTENTION! UTC is required
+
+    objects are kept by MemoryStateMachineDao (claims and transitions without sql),
+    every change is appended as a compact binary record (encode_record) to the active segment file
+    of directory instead of a random update of sqlite row. Index maps uid to its latest record.
+
+    segments: segment-<n>.log, the active one is sealed when it grows over segment_size.
+    Records are written to OS buffers on flush() and every flush_interval_ms (checked on change),
+    with fsync=True they are also synced to disk on flush(); changes not flushed yet are lost if the process dies.
+
+    recovery: open() scans all segments through read-only memory maps, the record of the highest version
+    of every object wins, torn record at the end of the last segment (crash during write) is cut off.
+    Processing objects were interrupted and become failed.
+
+    compaction: compact() copies live records of sealed segments into the active one and removes sealed segments,
+    background thread compacts every compact_interval_ms when dead records take compact_ratio of sealed segments.
+    Changes wait while compaction runs.
+
+    export() writes all objects to "resource" table of sqlite schema, import_sqlite() fills empty journal from it.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 segment_size: int = 64 * 1024 * 1024,
+                 fsync: bool = False,
+                 flush_interval_ms: Optional[int] = 1000,
+                 compact_ratio: float = 0.5,
+                 compact_interval_ms: Optional[int] = 10000,
+                 max_attempt_count: Optional[int] = None):
+        """
+        :param directory: directory of segments, created if missed
+        :param segment_size: size of segment, which makes it sealed
+        :param fsync: flush() syncs active segment to disk
+        :param flush_interval_ms: maximum age of records kept in process buffers, None - until flush()
+        :param compact_ratio: part of dead records in sealed segments, which triggers compaction
+        :param compact_interval_ms: interval of compaction checks, None - compact() is called explicitly
+        :param max_attempt_count: interrupted objects are not retried after this count of attempts
+                                  (pass StateMachine's one), None - always retried
+        """
+        assert directory
+        assert segment_size > 0
+        assert flush_interval_ms is None or flush_interval_ms >= 0
+        assert 0.0 < compact_ratio <= 1.0
+        assert compact_interval_ms is None or compact_interval_ms > 0
+
+        self.__directory = directory  # type: str
+        self.__segment_size = segment_size  # type: int
+        self.__fsync = fsync  # type: bool
+        self.__flush_interval = \
+            flush_interval_ms / 1000.0 if flush_interval_ms is not None else None  # type: Optional[float]
+        self.__compact_ratio = compact_ratio  # type: float
+        self.__compact_interval = \
+            compact_interval_ms / 1000.0 if compact_interval_ms is not None else None  # type: Optional[float]
+        self.__memory = MemoryStateMachineDao(max_attempt_count=max_attempt_count)
+
+        # uid -> (segment, offset, size, version) of the latest record
+        self.__index = {}  # type: Dict[uuid.UUID, Tuple[int, int, int, int]]
+        self.__segment_sizes = {}  # type: Dict[int, int]
+        self.__live_sizes = {}  # type: Dict[int, int]
+        self.__segment = None  # type: Optional[int]
+        self.__file = None  # type: Optional[BinaryIO]
+        self.__offset = 0  # type: int
+        self.__flushed_at = time.monotonic()  # type: float
+        self.__lock = threading.RLock()
+        self.__stop = threading.Event()
+        self.__compactor = None  # type: Optional[threading.Thread]
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        if self.__file is not None:
+            return
+
+        os.makedirs(self.__directory, exist_ok=True)
+        rows = self.__recover()
+
+        segments = sorted(self.__segment_sizes)
+        if segments and self.__segment_sizes[segments[-1]] < self.__segment_size:
+            self.__open_segment(segments[-1])
+        else:
+            self.__open_segment(segments[-1] + 1 if segments else 1)
+
+        for obj in self.__memory.load(rows):
+            self.__append(obj)
+        self.flush()
+
+        if self.__compact_interval is not None:
+            self.__stop.clear()
+            self.__compactor = threading.Thread(target=self.__compact_periodically, name='journal-compact', daemon=True)
+            self.__compactor.start()
+
+    def close(self):
+        if self.__file is None:
+            return
+
+        if self.__compactor is not None:
+            self.__stop.set()
+            self.__compactor.join()
+            self.__compactor = None
+
+        with self.__lock:
+            self.flush()
+            self.__file.close()
+            self.__file = None
+
+    def flush(self):
+        """
+        writes buffered records to OS (and to disk with fsync)
+        """
+        with self.__lock:
+            self.__file.flush()
+            if self.__fsync:
+                os.fsync(self.__file.fileno())
+            self.__flushed_at = time.monotonic()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: count of segments, count of objects, total and live size of records
+        """
+        with self.__lock:
+            return {
+                'segments': len(self.__segment_sizes),
+                'objects': len(self.__index),
+                'size': sum(self.__segment_sizes.values()),
+                'live_size': sum(self.__live_sizes.values())
+            }
+
+    def counts(self) -> Dict[str, int]:
+        return self.__memory.counts()
+
+    def update(self, obj: State) -> State:
+        obj = self.__memory.update(obj)
+        self.__append(obj)
+        return obj
+
+    def create(self, obj: State) -> State:
+        obj = self.__memory.create(obj)
+        self.__append(obj)
+        return obj
+
+    def delete(self, obj: State) -> bool:
+        if not self.__memory.delete(obj):
+            return False
+        self.__append(obj, deleted=True)
+        return True
+
+    def by_uid(self, uid) -> Optional[State]:
+        return self.__memory.by_uid(uid)
+
+    def get_unsuccessful(self) -> Optional[State]:
+        return self.__memory.get_unsuccessful()
+
+    def has_unsuccessful(self) -> bool:
+        return self.__memory.has_unsuccessful()
+
+    def claim_unsuccessful(self, exclude_hosts: Iterable[str] = ()) -> Optional[State]:
+        claimed = self.claim_batch(1, exclude_hosts)
+        return claimed[0] if claimed else None
+
+    def claim_batch(self, limit: int, exclude_hosts: Iterable[str] = ()) -> List[State]:
+        return self.__append_all(self.__memory.claim_batch(limit, exclude_hosts))
+
+    def claimable_hosts(self, exclude_hosts: Iterable[str] = ()) -> Tuple[Optional[int], List[Optional[str]]]:
+        return self.__memory.claimable_hosts(exclude_hosts)
+
+    def claim_host_batch(self, host: Optional[str], limit: int, priority: int) -> List[State]:
+        return self.__append_all(self.__memory.claim_host_batch(host, limit, priority))
+
+    def release(self, objects: Iterable[State]) -> int:
+        objects = list(objects)
+        released = self.__memory.release(objects)
+        if released:
+            for obj in objects:
+                fresh = self.__memory.by_uid(obj.uid)
+                if fresh is not None and fresh.version > obj.version:
+                    self.__append(fresh)
+        return released
+
+    def wait_for_change(self, timeout: float, stop=None) -> bool:
+        self.flush()
+        return self.__memory.wait_for_change(timeout, stop)
+
+    def export(self, connection_string: str) -> int:
+        """
+        writes all objects to "resource" table of sqlite database (schema is created or migrated)
+        :return: count of written objects
+        """
+        return self.__memory.export(connection_string)
+
+    def import_sqlite(self, connection_string: str) -> int:
+        """
+        loads unfinished objects of sqlite database into empty journal
+        :return: count of loaded objects
+        """
+        assert self.__file is not None
+        assert not self.__index, 'journal is not empty'
+
+        loaded = self.__memory.load_from(connection_string)
+        self.__append_all(self.__memory.objects())
+        self.flush()
+        return loaded
+
+    def compact(self) -> int:
+        """
+        copies live records of sealed segments into the active one and removes sealed segments
+        :return: count of removed bytes
+        """
+        with self.__lock:
+            sealed = [segment for segment in sorted(self.__segment_sizes) if segment != self.__segment]
+            if not sealed:
+                return 0
+
+            live = {segment: [] for segment in sealed}  # type: Dict[int, List[Tuple[uuid.UUID, int, int, int]]]
+            for uid, (segment, offset, size, version) in self.__index.items():
+                if segment in live:
+                    live[segment].append((uid, offset, size, version))
+
+            removed = 0
+            for segment in sealed:
+                records = sorted(live[segment], key=lambda record: record[1])
+                if records:
+                    with open(self.__segment_path(segment), 'rb') as f:
+                        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                            for uid, offset, size, version in records:
+                                self.__write(uid, m[offset:offset + size], version)
+                                removed -= size
+                removed += self.__segment_sizes[segment]
+
+            # copies must be durable before the originals disappear
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+            self.__flushed_at = time.monotonic()
+
+            for segment in sealed:
+                os.remove(self.__segment_path(segment))
+                del self.__segment_sizes[segment]
+                self.__live_sizes.pop(segment, None)
+
+            return removed
+
+    def __segment_path(self, segment: int) -> str:
+        return os.path.join(self.__directory, str.format('segment-{0:06d}.log', segment))
+
+    def __open_segment(self, segment: int):
+        self.__file = open(self.__segment_path(segment), 'ab')
+        self.__segment = segment
+        self.__offset = self.__file.tell()
+        self.__segment_sizes[segment] = self.__offset
+        self.__live_sizes.setdefault(segment, 0)
+
+    def __append_all(self, objects: List[State]) -> List[State]:
+        for obj in objects:
+            self.__append(obj)
+        return objects
+
+    def __append(self, obj: State, deleted: bool = False):
+        record = encode_record(obj, deleted)
+        with self.__lock:
+            if deleted:
+                self.__drop(obj.uid)
+                self.__write_raw(record)
+            else:
+                self.__write(obj.uid, record, obj.version)
+
+            if self.__flush_interval is not None and time.monotonic() - self.__flushed_at >= self.__flush_interval:
+                self.flush()
+
+    def __write(self, uid: uuid.UUID, record: bytes, version: int):
+        current = self.__index.get(uid)
+        if current is not None and current[3] > version:
+            # newer state of object was written by another thread first
+            self.__write_raw(record)
+            return
+
+        self.__drop(uid)
+        segment, offset = self.__write_raw(record)
+        self.__index[uid] = (segment, offset, len(record), version)
+        self.__live_sizes[segment] += len(record)
+
+    def __write_raw(self, record: bytes) -> Tuple[int, int]:
+        if self.__offset >= self.__segment_size:
+            self.flush()
+            self.__file.close()
+            self.__open_segment(self.__segment + 1)
+
+        segment, offset = self.__segment, self.__offset
+        self.__file.write(record)
+        self.__offset += len(record)
+        self.__segment_sizes[segment] = self.__offset
+        return segment, offset
+
+    def __drop(self, uid: uuid.UUID):
+        current = self.__index.pop(uid, None)
+        if current is not None:
+            self.__live_sizes[current[0]] -= current[2]
+
+    def __recover(self) -> List[State]:
+        segments = sorted(
+            int(match.group(1)) for match in map(_SEGMENT_NAME.match, os.listdir(self.__directory)) if match
+        )
+        latest = {}  # type: Dict[uuid.UUID, State]
+        records = 0
+
+        for i, segment in enumerate(segments):
+            path = self.__segment_path(segment)
+            size = os.path.getsize(path)
+            offset = 0
+
+            if size > 0:
+                with open(path, 'rb') as f:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        while offset < size:
+                            try:
+                                obj, deleted, record_size = decode_record(m, offset)
+                            except ValueError as e:
+                                if i != len(segments) - 1:
+                                    raise ValueError(str.format('{0} is corrupted at {1}: {2}', path, offset, e))
+                                break
+                            records += 1
+
+                            if deleted:
+                                latest.pop(obj.uid, None)
+                                self.__drop(obj.uid)
+                            else:
+                                current = self.__index.get(obj.uid)
+                                if current is None or current[3] <= obj.version:
+                                    self.__drop(obj.uid)
+                                    latest[obj.uid] = obj
+                                    self.__index[obj.uid] = (segment, offset, record_size, obj.version)
+                                    self.__live_sizes[segment] = self.__live_sizes.get(segment, 0) + record_size
+                            offset += record_size
+
+            if offset < size:
+                print(str.format('{0}: torn record at {1} is cut off', path, offset))
+                with open(path, 'r+b') as f:
+                    f.truncate(offset)
+            self.__segment_sizes[segment] = offset
+            self.__live_sizes.setdefault(segment, 0)
+
+        if records:
+            print(str.format('{0} records of {1} segments are recovered, {2} objects', records, len(segments), len(latest)))
+
+        return list(latest.values())
+
+    def __compact_periodically(self):
+        while not self.__stop.wait(self.__compact_interval):
+            try:
+                with self.__lock:
+                    sealed = [segment for segment in self.__segment_sizes if segment != self.__segment]
+                    total = sum(self.__segment_sizes[segment] for segment in sealed)
+                    live = sum(self.__live_sizes[segment] for segment in sealed)
+                if total and 1.0 - live / total >= self.__compact_ratio:
+                    self.compact()
+            except Exception as e:
+                print(str(e))
@@ -1,9 +1,39 @@
 import sqlite3
+import json
+import time
+import hashlib
 import uuid
-from typing import Optional
+from collections import deque, Counter
+from typing import Optional, List, Dict, Iterable, Set, Tuple, Union
 
+from AsyncEntityLoader import AsyncLoadContextManager
 from EntityLoader import LoadContextManager, LoadContext
-from StateMachine import StateMachineDao
+from StateMachine import State, StateMachineDao
+from default.HostScheduler import HostScheduler
+from default.SQLiteStorage import SQLiteStorage
+
+
+def request_fingerprint(resource: str, params: Optional[str], headers: Optional[str]) -> str:
+    """
+    canonical fingerprint of http request: sha256 of normalized json of resource, params and headers,
+    keys are sorted and header names are lower-cased, so equal requests get equal fingerprints
+    :param resource: url of resource
+    :param params: json-serialized query parameters
+    :param headers: json-serialized headers
+    :return: hex digest
+    """
+    j_params = json.loads(params) if params else None
+    j_headers = json.loads(headers) if headers else None
+    if isinstance(j_headers, dict):
+        j_headers = {str(k).lower(): v for k, v in j_headers.items()}
+
+    canonical = json.dumps(
+        {'resource': resource, 'params': j_params, 'headers': j_headers},
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
 
 
 class HttpParams(object):
@@ -11,18 +41,29 @@ class HttpParams(object):
                  uid: uuid.UUID,
                  resource: str,
                  params: str,
-                 headers: str):
+                 headers: str,
+                 fingerprint: Optional[str] = None):
         self.Uid = uid
         self.Resource = resource
         self.Params = params
         self.Headers = headers
+        self.__fingerprint = fingerprint  # type: Optional[str]
+
+    @property
+    def Fingerprint(self) -> str:
+        if self.__fingerprint is None:
+            self.__fingerprint = request_fingerprint(self.Resource, self.Params, self.Headers)
+        return self.__fingerprint
 
 
 class HttpParamsDao(object):
-    def __init__(self, connection_string: str):
+    def __init__(self, connection_string: Union[str, SQLiteStorage]):
+        """
+        :param connection_string: path to sqlite database or storage shared with other dao's
+        """
         assert connection_string
 
-        self.__connection_string = connection_string  # type: str
+        self.__storage = SQLiteStorage.of(connection_string)  # type: SQLiteStorage
         self.__connection = None  # type: sqlite3.Connection
         self.__is_closed = False
 
@@ -35,11 +76,12 @@ class HttpParamsDao(object):
 
     def open(self):
         if not self.__connection:
-            self.__connection = sqlite3.connect(self.__connection_string)
+            self.__storage.open()
+            self.__connection = self.__storage.connection
 
     def close(self):
         if self.__connection and (not self.__is_closed):
-            self.__connection.close()
+            self.__storage.close()
             self.__connection = None
             self.__is_closed = True
 
@@ -47,15 +89,16 @@ class HttpParamsDao(object):
         sql = '''
 insert into
     "http_params"
-("uid", "resource", "headers", "params")
+("uid", "resource", "headers", "params", "fingerprint")
 values
-(:uid, :resource, :headers, :params)
+(:uid, :resource, :headers, :params, :fingerprint)
 '''
         args = {
             'uid': obj.Uid.urn,
             'resource': obj.Resource,
             'headers': obj.Headers,
-            'params': obj.Params
+            'params': obj.Params,
+            'fingerprint': obj.Fingerprint
         }
 
         cursor = self.__connection.execute(sql, args)
@@ -67,11 +110,12 @@ values
     def update(self, obj: HttpParams) -> HttpParams:
         sql = '''
 update
-    "http_header"
+    "http_params"
 set
     "resource" = :resource,
     "params" = :params,
-    "headers" = :headers
+    "headers" = :headers,
+    "fingerprint" = :fingerprint
 where
     "uid" = :uid
 '''
@@ -79,7 +123,8 @@ where
             'uid': obj.Uid.urn,
             'resource': obj.Resource,
             'headers': obj.Headers,
-            'params': obj.Params
+            'params': obj.Params,
+            'fingerprint': request_fingerprint(obj.Resource, obj.Params, obj.Headers)
         }
 
         cursor = self.__connection.execute(sql, args)
@@ -94,7 +139,8 @@ select
     uid,
     "resource",
     "headers",
-    "params"
+    "params",
+    "fingerprint"
 from
     "http_params"
 where
@@ -104,53 +150,271 @@ where
             'uid': uid
         }
         cursor = self.__connection.execute(sql, args)
-        if cursor.rowcount <= 0:
-            return None
         row = cursor.fetchone()
-        params = HttpParams(
+        cursor.close()
+        if row is None:
+            return None
+        return self.__to_params(row)
+
+    def by_uids(self, uids: Iterable[str]) -> Dict[str, HttpParams]:
+        """
+        loads parameters of several objects by single query
+        :param uids: urn's of objects
+        :return: parameters by urn, objects without parameters are missed
+        """
+        sql = '''
+select
+    p.uid,
+    p."resource",
+    p."headers",
+    p."params",
+    p."fingerprint"
+from
+    json_each(:uids) as u
+    join "http_params" as p on p.uid = u.value
+'''
+        args = {
+            'uids': json.dumps(list(uids))
+        }
+        cursor = self.__connection.execute(sql, args)
+        result = {row[0]: self.__to_params(row) for row in cursor}
+        cursor.close()
+        return result
+
+    def by_fingerprint(self, fingerprint: str) -> List[HttpParams]:
+        """
+        :param fingerprint: request_fingerprint of parameters
+        :return: parameters of all objects requesting the same
+        """
+        sql = '''
+select
+    uid,
+    "resource",
+    "headers",
+    "params",
+    "fingerprint"
+from
+    "http_params"
+where
+    "fingerprint" = :fingerprint
+'''
+        cursor = self.__connection.execute(sql, {'fingerprint': fingerprint})
+        result = [self.__to_params(row) for row in cursor]
+        cursor.close()
+        return result
+
+    def __to_params(self, row) -> HttpParams:
+        return HttpParams(
             uid=uuid.UUID(row[0]),
             resource=row[1],
-            params=row[2],
-            headers=row[3]
+            params=row[3],
+            headers=row[2],
+            fingerprint=row[4]
         )
-        cursor.close()
-        return params
 
 
 class LoadContextManagerSQLite(LoadContextManager):
     def __init__(self,
                  state_machine_dao: StateMachineDao,
-                 http_params_dao: HttpParamsDao):
+                 http_params_dao: HttpParamsDao,
+                 claim: bool = False,
+                 batch_size: int = 1,
+                 host_filters: Iterable = (),
+                 fair: bool = False,
+                 host_weights: Iterable[Tuple[str, int]] = (),
+                 hosts_refresh_ms: int = 1000):
+        """
+        :param state_machine_dao: implementation of StateMachineDao
+        :param http_params_dao: dao of http parameters
+        :param claim: objects are moved to processing state by StateMachineDao.claim_unsuccessful,
+                      required when several loaders work with the same database
+        :param batch_size: count of objects claimed by next() at once, requires claim
+        :param host_filters: objects with blocked_hosts() method (e.g. TokenBucketWaitBehaviour),
+                             objects of blocked hosts are not claimed, requires claim.
+                             Filters with released_hosts() method (e.g. CircuitBreaker) also make
+                             claimed, but not handed out objects of these hosts released without spending attempts
+        :param fair: objects of the highest priority are claimed by weighted round-robin over their hosts,
+                     so one host with a lot of objects does not starve others, requires claim
+        :param host_weights: (host pattern, weight) - weights of fair scheduling, 1 for other hosts
+        :param hosts_refresh_ms: interval of re-reading of hosts and the highest priority for fair scheduling,
+                                 new hosts and higher priorities are noticed after it
+        """
         assert state_machine_dao
         assert http_params_dao
+        assert batch_size > 0
+        assert claim or batch_size == 1
+        assert claim or not host_filters
+        assert claim or not fair
+        assert hosts_refresh_ms >= 0
 
         self.__state_machine_dao = state_machine_dao
         self.__http_params_dao = http_params_dao
+        self.__claim = claim  # type: bool
+        self.__batch_size = batch_size  # type: int
+        self.__host_filters = list(host_filters)
+        self.__claimed = deque()  # type: deque
+        self.__scheduler = HostScheduler(host_weights) if fair else None  # type: Optional[HostScheduler]
+        self.__hosts_refresh = hosts_refresh_ms / 1000.0  # type: float
+        self.__hosts_refreshed_at = None  # type: Optional[float]
+        self.__priority = None  # type: Optional[int]
 
     def next(self) -> Optional[LoadContext]:
-        next_resource = self.__state_machine_dao.get_unsuccessful()
+        if self.__batch_size > 1 or self.__scheduler is not None:
+            # the second claim excludes hosts, which objects were just released
+            for _ in range(2):
+                if not self.__claimed:
+                    self.__claimed.extend(self.next_batch(self.__batch_size))
+                self.__release_hosts()
+                if self.__claimed:
+                    return self.__claimed.popleft()
+            return None
+
+        if self.__claim:
+            next_resource = self.__state_machine_dao.claim_unsuccessful(self.__blocked_hosts())
+        else:
+            next_resource = self.__state_machine_dao.get_unsuccessful()
 
         if next_resource:
-            http_params = self.__http_params_dao.by_uid(next_resource.uid.urn)
-
-            if http_params:
-                return LoadContext(
-                    http_params.Uid,
-                    http_params.Resource,
-                    http_params.Params,
-                    http_params.Headers,
-                    next_resource,
-                    None
-                )
-            else:
-                return LoadContext(
-                    next_resource.uid,
-                    next_resource.resource,
-                    None,
-                    None,
-                    next_resource,
-                    None
-                )
+            return self.__to_context(next_resource, self.__http_params_dao.by_uid(next_resource.uid.urn))
 
         return None
 
+    def wait_for_work(self, timeout: float, stop=None) -> bool:
+        return self.__state_machine_dao.wait_for_change(timeout, stop)
+
+    def has_work(self) -> bool:
+        return bool(self.__claimed) or self.__state_machine_dao.has_unsuccessful()
+
+    def release(self):
+        """
+        claimed, but not handed out objects are released without spending their attempt
+        """
+        if self.__claimed:
+            self.__state_machine_dao.release([context.LoadObject for context in self.__claimed])
+            self.__claimed.clear()
+        self.__state_machine_dao.flush()
+
+    def next_batch(self, k: int) -> List[LoadContext]:
+        """
+        claims up to k objects and loads their parameters
+        costs two queries per batch instead of two queries per object
+        :param k: maximum count of objects
+        :return: contexts of claimed objects, already in processing state
+        """
+        if self.__scheduler is not None:
+            resources = self.__claim_fair(k)
+        else:
+            resources = self.__state_machine_dao.claim_batch(k, self.__blocked_hosts())
+        if not resources:
+            return []
+
+        http_params = self.__http_params_dao.by_uids(r.uid.urn for r in resources)
+
+        return [self.__to_context(r, http_params.get(r.uid.urn)) for r in resources]
+
+    def __claim_fair(self, k: int) -> List[State]:
+        blocked = self.__blocked_hosts()
+
+        resources, refreshed = self.__claim_scheduled(k, blocked, False)
+        if resources or refreshed:
+            return resources
+
+        # known hosts of the band are drained: look at the fresh hosts once
+        return self.__claim_scheduled(k, blocked, True)[0]
+
+    def __claim_scheduled(self, k: int, blocked: Set[str], refresh: bool) -> Tuple[List[State], bool]:
+        scheduler = self.__scheduler
+        now = time.monotonic()
+
+        refresh = refresh \
+            or self.__hosts_refreshed_at is None \
+            or now - self.__hosts_refreshed_at >= self.__hosts_refresh \
+            or not scheduler.hosts
+        if refresh:
+            self.__priority, hosts = self.__state_machine_dao.claimable_hosts(blocked)
+            scheduler.set_hosts(hosts)
+            self.__hosts_refreshed_at = now
+
+        if self.__priority is None:
+            return [], refresh
+
+        picked = scheduler.pick(k, blocked)
+        claimed = {}  # type: Dict[Optional[str], deque]
+        for host, count in Counter(picked).items():
+            host_resources = self.__state_machine_dao.claim_host_batch(host, count, self.__priority)
+            if len(host_resources) < count:
+                # host has no more objects of the band
+                scheduler.remove(host)
+            claimed[host] = deque(host_resources)
+
+        # keep round-robin order inside of the batch
+        resources = []
+        for host in picked:
+            if claimed[host]:
+                resources.append(claimed[host].popleft())
+        return resources, refresh
+
+    def __release_hosts(self):
+        if not self.__claimed:
+            return
+
+        released_hosts = set()  # type: Set[str]
+        for host_filter in self.__host_filters:
+            if hasattr(host_filter, 'released_hosts'):
+                released_hosts.update(host_filter.released_hosts())
+        if not released_hosts:
+            return
+
+        kept = deque()
+        released = []
+        for context in self.__claimed:
+            (released if context.host in released_hosts else kept).append(context)
+
+        if released:
+            self.__state_machine_dao.release([context.LoadObject for context in released])
+            self.__claimed = kept
+
+    def __blocked_hosts(self) -> Set[str]:
+        blocked = set()  # type: Set[str]
+        for host_filter in self.__host_filters:
+            blocked.update(host_filter.blocked_hosts())
+        return blocked
+
+    def __to_context(self, resource: State, http_params: Optional[HttpParams]) -> LoadContext:
+        if http_params:
+            return LoadContext(
+                http_params.Uid,
+                http_params.Resource,
+                http_params.Params,
+                http_params.Headers,
+                resource,
+                None,
+                http_params.Fingerprint
+            )
+
+        return LoadContext(
+            resource.uid,
+            resource.resource,
+            None,
+            None,
+            resource,
+            None
+        )
+
+
+class AsyncLoadContextManagerSQLite(AsyncLoadContextManager):
+    """
+    asynchronous adapter over LoadContextManagerSQLite
+    sqlite calls are short and local, so they are made on event loop thread,
+    which also keeps sqlite connections used from a single thread
+    """
+    def __init__(self, load_context_manager: LoadContextManagerSQLite):
+        assert load_context_manager
+
+        self.__load_context_manager = load_context_manager
+
+    async def next(self) -> Optional[LoadContext]:
+        return self.__load_context_manager.next()
+
+    async def release(self):
+        self.__load_context_manager.release()
@@ -0,0 +1,720 @@
+import time
+import uuid
+import heapq
+import itertools
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Set, Iterable, Tuple
+
+from StateMachine import State, StateMachineDao, VersionConflictError, host_of
+from default.SQLiteStorage import SQLiteStorage
+from default.LoadContextManagerSQLite import LoadContextManagerSQLite, HttpParams
+
+
+def _to_int_timestamp(value: Optional[datetime]) -> Optional[int]:
+    if not value:
+        return None
+    return int(value.timestamp() * 1000000)
+
+
+def _from_int_timestamp(value: Optional[int]) -> Optional[datetime]:
+    if not value:
+        return None
+    return datetime.fromtimestamp(value / 1000000.0, timezone.utc)
+
+
+def _copy(obj: State) -> State:
+    copy = State()
+    copy.restore(obj.snapshot())
+    return copy
+
+
+class _HostQueue(object):
+    __slots__ = ('ready', 'created')
+
+    def __init__(self):
+        # (uid, seq) of failed objects due for next attempt and of created objects
+        self.ready = deque()  # type: deque
+        self.created = deque()  # type: deque
+
+
+class MemoryHttpParamsDao(object):
+    """
+    in-memory counterpart of HttpParamsDao, filled from sqlite and written back by MemoryStateMachineDao
+    """
+
+    def __init__(self):
+        self.__params = {}  # type: Dict[str, HttpParams]
+        self.__fingerprints = {}  # type: Dict[str, Set[str]]
+        self.__changed = set()  # type: Set[str]
+        self.__lock = threading.Lock()
+
+    def insert(self, obj: HttpParams) -> HttpParams:
+        with self.__lock:
+            self.__put(obj)
+            self.__changed.add(obj.Uid.urn)
+        return obj
+
+    def update(self, obj: HttpParams) -> HttpParams:
+        return self.insert(obj)
+
+    def load(self, params: Iterable[HttpParams]):
+        """
+        adds stored parameters, they are not written back until changed
+        """
+        with self.__lock:
+            for obj in params:
+                self.__put(obj)
+
+    def take_changes(self) -> List[HttpParams]:
+        """
+        :return: parameters inserted or updated since the previous call
+        """
+        with self.__lock:
+            changed = [self.__params[urn] for urn in self.__changed if urn in self.__params]
+            self.__changed = set()
+        return changed
+
+    def mark_changed(self, uids: Iterable[str]):
+        """
+        returns parameters to the next take_changes() (e.g. when they were not written)
+        """
+        with self.__lock:
+            self.__changed.update(uids)
+
+    def by_uid(self, uid: str) -> Optional[HttpParams]:
+        return self.__params.get(uid)
+
+    def by_uids(self, uids: Iterable[str]) -> Dict[str, HttpParams]:
+        params = self.__params
+        return {uid: params[uid] for uid in uids if uid in params}
+
+    def by_fingerprint(self, fingerprint: str) -> List[HttpParams]:
+        with self.__lock:
+            return [self.__params[urn] for urn in self.__fingerprints.get(fingerprint, ())]
+
+    def __put(self, obj: HttpParams):
+        urn = obj.Uid.urn
+        previous = self.__params.get(urn)
+        if previous is not None:
+            self.__fingerprints.get(previous.Fingerprint, set()).discard(urn)
+        self.__params[urn] = obj
+        self.__fingerprints.setdefault(obj.Fingerprint, set()).add(urn)
+
+
+class MemoryStateMachineDao(StateMachineDao):
+    """
+    ATTENTION! UTC is required
+
+    keeps objects in memory for short high-rate runs of one process (one instance may be shared by threads):
+    created and due failed objects are queued by priority and host, failed objects wait for next attempt
+    in a heap by next_attempt_at, so claim and transition cost O(1) or O(log n) without any sql.
+
+    with connection_string set, open() loads unfinished objects (created, processing, failed with next attempt)
+    and their http parameters from sqlite (warm start), processing ones were interrupted and become failed.
+    Changed objects are written back to "resource" (and "http_params" of http_params_dao)
+    every snapshot_interval_ms and on close(). Database must not be changed by others during the run,
+    objects changed after the last snapshot are lost if the process dies.
+    """
+
+    __load_sql = '''
+select
+    "uid"
+    , "resource"
+    , "state"
+    , attempt_count
+    , last_attempt
+    , "error"
+    , last_update
+    , "version"
+    , next_attempt_at
+    , "priority"
+from
+    "resource"
+where
+    "state" in (:created_state, :processing_state)
+    or ("state" = :failed_state and next_attempt_at is not null)
+'''
+
+    __load_params_sql = '''
+select
+    p.uid
+    , p."resource"
+    , p."headers"
+    , p."params"
+    , p."fingerprint"
+from
+    "http_params" p
+    join "resource" r on r."uid" = p."uid"
+where
+    r."state" in (:created_state, :processing_state)
+    or (r."state" = :failed_state and r.next_attempt_at is not null)
+'''
+
+    __save_sql = '''
+insert into
+    "resource"
+("uid", "resource", "host", "state", attempt_count, last_attempt, "error", last_update, "version", next_attempt_at, "priority")
+values
+(:uid, :resource, :host, :state, :attempt_count, :last_attempt, :error, :last_update, :version, :next_attempt_at, :priority)
+on conflict ("uid") do update set
+    "resource" = excluded."resource"
+    , "host" = excluded."host"
+    , "state" = excluded."state"
+    , attempt_count = excluded.attempt_count
+    , last_attempt = excluded.last_attempt
+    , "error" = excluded."error"
+    , last_update = excluded.last_update
+    , "version" = excluded."version"
+    , next_attempt_at = excluded.next_attempt_at
+    , lease_until = null
+    , worker_id = null
+    , "priority" = excluded."priority"
+'''
+
+    __save_params_sql = '''
+insert into
+    "http_params"
+("uid", "resource", "headers", "params", "fingerprint")
+values
+(:uid, :resource, :headers, :params, :fingerprint)
+on conflict ("uid") do update set
+    "resource" = excluded."resource"
+    , "headers" = excluded."headers"
+    , "params" = excluded."params"
+    , "fingerprint" = excluded."fingerprint"
+'''
+
+    def __init__(self,
+                 connection_string: Optional[str] = None,
+                 snapshot_interval_ms: Optional[int] = 10000,
+                 warm_start: bool = True,
+                 http_params_dao: Optional[MemoryHttpParamsDao] = None,
+                 max_attempt_count: Optional[int] = None):
+        """
+        :param connection_string: path to sqlite database of snapshots, None - objects are kept in memory only
+        :param snapshot_interval_ms: interval of snapshots, None - only on close()
+        :param warm_start: load unfinished objects of database on open()
+        :param http_params_dao: http parameters loaded and written together with objects
+        :param max_attempt_count: interrupted objects are not retried after this count of attempts
+                                  (pass StateMachine's one), None - always retried
+        """
+        assert snapshot_interval_ms is None or snapshot_interval_ms > 0
+        assert max_attempt_count is None or max_attempt_count > 0
+
+        self.__connection_string = connection_string  # type: Optional[str]
+        self.__snapshot_interval = \
+            snapshot_interval_ms / 1000.0 if snapshot_interval_ms is not None else None  # type: Optional[float]
+        self.__warm_start = warm_start  # type: bool
+        self.__http_params_dao = http_params_dao  # type: Optional[MemoryHttpParamsDao]
+        self.__max_attempt_count = max_attempt_count  # type: Optional[int]
+
+        self.__rows = {}  # type: Dict[uuid.UUID, State]
+        self.__bands = {}  # type: Dict[int, Dict[Optional[str], _HostQueue]]
+        # seq of the only valid queue entry of object, other entries of object are skipped
+        self.__queued = {}  # type: Dict[uuid.UUID, int]
+        self.__due = []  # type: List[Tuple[float, int, uuid.UUID]]
+        self.__seq = itertools.count()
+        self.__dirty = set()  # type: Set[uuid.UUID]
+        self.__deleted = set()  # type: Set[uuid.UUID]
+        self.__lock = threading.Lock()
+        self.__changed = threading.Condition(self.__lock)
+        self.__change_count = 0  # type: int
+
+        self.__is_opened = False  # type: bool
+        self.__snapshot_lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__snapshotter = None  # type: Optional[threading.Thread]
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        if self.__is_opened:
+            return
+        self.__is_opened = True
+
+        if self.__connection_string and self.__warm_start:
+            self.load_from(self.__connection_string)
+
+        if self.__connection_string and self.__snapshot_interval is not None:
+            self.__stop.clear()
+            self.__snapshotter = threading.Thread(target=self.__snapshot_periodically, name='memory-snapshot', daemon=True)
+            self.__snapshotter.start()
+
+    def close(self):
+        if not self.__is_opened:
+            return
+        self.__is_opened = False
+
+        if self.__snapshotter is not None:
+            self.__stop.set()
+            self.__snapshotter.join()
+            self.__snapshotter = None
+        if self.__connection_string:
+            self.snapshot()
+
+    def counts(self) -> Dict[str, int]:
+        """
+        :return: count of objects by state
+        """
+        counts = {}  # type: Dict[str, int]
+        with self.__lock:
+            for row in self.__rows.values():
+                counts[row.state] = counts.get(row.state, 0) + 1
+        return counts
+
+    def snapshot(self) -> int:
+        """
+        writes objects changed since the previous snapshot to sqlite
+        :return: count of written objects
+        """
+        assert self.__connection_string
+
+        with self.__snapshot_lock:
+            with self.__lock:
+                dirty, self.__dirty = self.__dirty, set()
+                deleted, self.__deleted = self.__deleted, set()
+                rows = [self.__to_args(self.__rows[uid]) for uid in dirty if uid in self.__rows]
+            params = self.__http_params_dao.take_changes() if self.__http_params_dao is not None else []
+
+            try:
+                with SQLiteStorage(self.__connection_string) as storage:
+                    connection = storage.connection
+                    connection.executemany(self.__save_sql, rows)
+                    connection.executemany(
+                        'delete from "resource" where "uid" = :uid', [{'uid': uid.urn} for uid in deleted]
+                    )
+                    connection.executemany(self.__save_params_sql, [
+                        {
+                            'uid': p.Uid.urn,
+                            'resource': p.Resource,
+                            'headers': p.Headers,
+                            'params': p.Params,
+                            'fingerprint': p.Fingerprint
+                        }
+                        for p in params
+                    ])
+                    connection.commit()
+            except Exception:
+                # written by the next snapshot
+                with self.__lock:
+                    self.__dirty.update(dirty)
+                    self.__deleted.update(deleted - set(self.__rows))
+                if self.__http_params_dao is not None:
+                    self.__http_params_dao.mark_changed(p.Uid.urn for p in params)
+                raise
+
+        return len(rows)
+
+    def load(self, rows: Iterable[State]) -> List[State]:
+        """
+        adds stored objects as they are, they are not written by snapshots until changed.
+        Processing objects were interrupted (their worker died during load) and become failed
+        :return: interrupted objects in their new state
+        """
+        now = datetime.now(timezone.utc)
+        interrupted = []  # type: List[State]
+
+        with self.__lock:
+            for row in rows:
+                row = _copy(row)
+                if row.state == State.PROCESSING:
+                    row.state = State.FAILED
+                    row.error = 'interrupted'
+                    row.last_update = now
+                    row.version += 1
+                    exhausted = self.__max_attempt_count is not None \
+                        and (row.attempt_count or 0) >= self.__max_attempt_count
+                    row.next_attempt_at = None if exhausted else now
+                    self.__mark_dirty(row.uid)
+                    interrupted.append(_copy(row))
+                self.__rows[row.uid] = row
+                self.__deleted.discard(row.uid)
+                self.__enqueue(row)
+            self.__notify()
+
+        if interrupted:
+            print(str.format('{0} interrupted objects are moved to failed state', len(interrupted)))
+
+        return interrupted
+
+    def load_from(self, connection_string: str) -> int:
+        """
+        loads unfinished objects (created, processing, failed with next attempt) of sqlite database
+        and their http parameters, if http_params_dao is set
+        :return: count of loaded objects
+        """
+        args = {
+            'created_state': State.CREATED,
+            'processing_state': State.PROCESSING,
+            'failed_state': State.FAILED
+        }
+        with SQLiteStorage(connection_string, migrate=True) as storage:
+            connection = storage.connection
+            rows = connection.execute(self.__load_sql, args).fetchall()
+            params = connection.execute(self.__load_params_sql, args).fetchall() \
+                if self.__http_params_dao is not None else []
+
+        self.load(
+            State(
+                uuid.UUID(values[0])
+                , values[1]
+                , values[2]
+                , values[3]
+                , _from_int_timestamp(values[4])
+                , values[5]
+                , _from_int_timestamp(values[6])
+                , values[7]
+                , _from_int_timestamp(values[8])
+                , values[9]
+            )
+            for values in rows
+        )
+
+        if self.__http_params_dao is not None:
+            self.__http_params_dao.load(
+                HttpParams(uid=uuid.UUID(p[0]), resource=p[1], params=p[3], headers=p[2], fingerprint=p[4])
+                for p in params
+            )
+
+        return len(rows)
+
+    def objects(self) -> List[State]:
+        """
+        :return: copies of all objects
+        """
+        with self.__lock:
+            return [_copy(row) for row in self.__rows.values()]
+
+    def export(self, connection_string: str) -> int:
+        """
+        writes all objects to "resource" table of sqlite database, existing rows are replaced
+        :return: count of written objects
+        """
+        with self.__lock:
+            rows = [self.__to_args(row) for row in self.__rows.values()]
+
+        with SQLiteStorage(connection_string, migrate=True) as storage:
+            storage.connection.executemany(self.__save_sql, rows)
+            storage.connection.commit()
+
+        return len(rows)
+
+    def update(self, obj: State) -> State:
+        assert obj
+
+        with self.__lock:
+            row = self.__rows.get(obj.uid)
+            if row is None or row.version != obj.version:
+                raise VersionConflictError([obj.uid])
+
+            obj.last_update = datetime.now(timezone.utc)
+            obj.version += 1
+            row.restore(obj.snapshot())
+            self.__mark_dirty(row.uid)
+            self.__enqueue(row)
+
+        return obj
+
+    def create(self, obj: State) -> State:
+        assert obj
+
+        with self.__lock:
+            if obj.uid in self.__rows:
+                raise ValueError(str.format('{0} already exists', obj.uid.urn))
+
+            obj.version = 1
+            obj.last_update = datetime.now(timezone.utc)
+            row = _copy(obj)
+            self.__rows[row.uid] = row
+            self.__deleted.discard(row.uid)
+            self.__mark_dirty(row.uid)
+            self.__enqueue(row)
+            self.__notify()
+
+        return obj
+
+    def delete(self, obj: State) -> bool:
+        with self.__lock:
+            row = self.__rows.pop(obj.uid, None)
+            if row is None:
+                return False
+            self.__queued.pop(obj.uid, None)
+            self.__dirty.discard(obj.uid)
+            if self.__connection_string:
+                self.__deleted.add(obj.uid)
+            return True
+
+    def by_uid(self, uid) -> Optional[State]:
+        if not isinstance(uid, uuid.UUID):
+            uid = uuid.UUID(str(uid))
+        with self.__lock:
+            row = self.__rows.get(uid)
+            return _copy(row) if row is not None else None
+
+    def has_unsuccessful(self) -> bool:
+        with self.__lock:
+            return bool(self.__queued)
+
+    def get_unsuccessful(self) -> Optional[State]:
+        with self.__lock:
+            self.__promote_due()
+            priority = self.__top_priority(())
+            if priority is None:
+                return None
+
+            for host_queue in self.__bands[priority].values():
+                for queue in (host_queue.ready, host_queue.created):
+                    if self.__clean(queue):
+                        return _copy(self.__rows[queue[0][0]])
+        return None
+
+    def claim_unsuccessful(self, exclude_hosts: Iterable[str] = ()) -> Optional[State]:
+        claimed = self.claim_batch(1, exclude_hosts)
+        return claimed[0] if claimed else None
+
+    def claim_batch(self, limit: int, exclude_hosts: Iterable[str] = ()) -> List[State]:
+        """
+        failed objects due for next attempt are claimed before created ones, as by SQLiteStateMachineDao
+        """
+        assert limit > 0
+
+        exclude_hosts = set(exclude_hosts)
+        with self.__lock:
+            self.__promote_due()
+            priority = self.__top_priority(exclude_hosts)
+            if priority is None:
+                return []
+
+            queues = [
+                host_queue for host, host_queue in self.__bands[priority].items() if host not in exclude_hosts
+            ]
+            claimed = []  # type: List[State]
+            for kind in ('ready', 'created'):
+                for host_queue in queues:
+                    self.__take(getattr(host_queue, kind), limit, claimed)
+                    if len(claimed) == limit:
+                        return claimed
+            return claimed
+
+    def claimable_hosts(self, exclude_hosts: Iterable[str] = ()) -> Tuple[Optional[int], List[Optional[str]]]:
+        exclude_hosts = set(exclude_hosts)
+        with self.__lock:
+            self.__promote_due()
+            priority = self.__top_priority(exclude_hosts)
+            if priority is None:
+                return None, []
+            return priority, [host for host in self.__bands[priority] if host not in exclude_hosts]
+
+    def claim_host_batch(self, host: Optional[str], limit: int, priority: int) -> List[State]:
+        assert limit > 0
+
+        with self.__lock:
+            self.__promote_due()
+            host_queue = self.__bands.get(priority, {}).get(host)
+            claimed = []  # type: List[State]
+            if host_queue is not None:
+                self.__take(host_queue.ready, limit, claimed)
+                self.__take(host_queue.created, limit, claimed)
+            return claimed
+
+    def release(self, objects: Iterable[State]) -> int:
+        """
+        objects with the only (released) attempt become created again, others become failed and due now
+        """
+        now = datetime.now(timezone.utc)
+        released = 0
+
+        with self.__lock:
+            for obj in objects:
+                row = self.__rows.get(obj.uid)
+                if row is None or row.version != obj.version or row.state != State.PROCESSING:
+                    continue
+
+                attempt_count = row.attempt_count or 0
+                row.state = State.CREATED if attempt_count <= 1 else State.FAILED
+                row.next_attempt_at = None if attempt_count <= 1 else now
+                row.attempt_count = max(attempt_count - 1, 0)
+                row.last_update = now
+                row.version += 1
+                self.__mark_dirty(row.uid)
+                self.__enqueue(row)
+                released += 1
+
+            if released:
+                self.__notify()
+
+        return released
+
+    def wait_for_change(self, timeout: float, stop=None) -> bool:
+        """
+        wakes up when objects are created or released by other threads, or when next attempt of failed object is due
+        """
+        deadline = time.monotonic() + timeout
+
+        with self.__changed:
+            change_count = self.__change_count
+            while True:
+                if self.__change_count != change_count:
+                    return True
+
+                remaining = deadline - time.monotonic()
+                if self.__due:
+                    due_in = self.__due[0][0] - time.time()
+                    if due_in <= 0:
+                        return True
+                    remaining = min(remaining, due_in)
+                if remaining <= 0:
+                    return False
+
+                if stop is not None:
+                    if stop.is_set():
+                        return False
+                    # stop event can not notify condition, it is checked periodically
+                    remaining = min(remaining, 0.05)
+
+                self.__changed.wait(remaining)
+
+    def __mark_dirty(self, uid: uuid.UUID):
+        # without database nobody takes changes
+        if self.__connection_string:
+            self.__dirty.add(uid)
+
+    def __notify(self):
+        self.__change_count += 1
+        self.__changed.notify_all()
+
+    def __enqueue(self, row: State):
+        uid = row.uid
+        if row.state == State.CREATED:
+            seq = next(self.__seq)
+            self.__queued[uid] = seq
+            self.__host_queue(row).created.append((uid, seq))
+        elif row.state == State.FAILED and row.next_attempt_at is not None:
+            seq = next(self.__seq)
+            self.__queued[uid] = seq
+            heapq.heappush(self.__due, (row.next_attempt_at.timestamp(), seq, uid))
+        else:
+            self.__queued.pop(uid, None)
+
+    def __host_queue(self, row: State) -> _HostQueue:
+        band = self.__bands.get(row.priority)
+        if band is None:
+            band = self.__bands[row.priority] = {}
+        host = host_of(row.resource)
+        host_queue = band.get(host)
+        if host_queue is None:
+            host_queue = band[host] = _HostQueue()
+        return host_queue
+
+    def __promote_due(self):
+        due = self.__due
+        now = time.time()
+        while due and due[0][0] <= now:
+            _, seq, uid = heapq.heappop(due)
+            if self.__queued.get(uid) == seq:
+                self.__host_queue(self.__rows[uid]).ready.append((uid, seq))
+
+    def __clean(self, queue: deque) -> bool:
+        """
+        drops stale entries from the head of queue
+        :return: True if queue has valid entry
+        """
+        queued = self.__queued
+        while queue:
+            uid, seq = queue[0]
+            if queued.get(uid) == seq:
+                return True
+            queue.popleft()
+        return False
+
+    def __top_priority(self, exclude_hosts: Set[str]) -> Optional[int]:
+        for priority in sorted(self.__bands, reverse=True):
+            band = self.__bands[priority]
+            for host in list(band):
+                host_queue = band[host]
+                if not self.__clean(host_queue.ready) and not self.__clean(host_queue.created):
+                    del band[host]
+            if not band:
+                del self.__bands[priority]
+            elif any(host not in exclude_hosts for host in band):
+                return priority
+        return None
+
+    def __take(self, queue: deque, limit: int, claimed: List[State]):
+        now = datetime.now(timezone.utc)
+        while len(claimed) < limit and self.__clean(queue):
+            uid, _ = queue.popleft()
+            del self.__queued[uid]
+
+            row = self.__rows[uid]
+            row.state = State.PROCESSING
+            row.attempt_count = (row.attempt_count or 0) + 1
+            row.last_attempt = now
+            row.last_update = now
+            row.version += 1
+            row.next_attempt_at = None
+            row.error = None
+            self.__mark_dirty(uid)
+            claimed.append(_copy(row))
+
+    def __to_args(self, row: State) -> dict:
+        return {
+            'uid': row.uid.urn
+            , 'resource': row.resource
+            , 'host': host_of(row.resource)
+            , 'state': row.state
+            , 'attempt_count': row.attempt_count
+            , 'last_attempt': _to_int_timestamp(row.last_attempt)
+            , 'error': row.error
+            , 'last_update': _to_int_timestamp(row.last_update)
+            , 'version': row.version
+            , 'next_attempt_at': _to_int_timestamp(row.next_attempt_at)
+            , 'priority': row.priority
+        }
+
+    def __snapshot_periodically(self):
+        while not self.__stop.wait(self.__snapshot_interval):
+            try:
+                self.snapshot()
+            except Exception as e:
+                print(str(e))
+
+
+class MemoryLoadContextManager(LoadContextManagerSQLite):
+    """
+    LoadContextManagerSQLite over in-memory dao's: objects are always claimed,
+    batches are larger by default, because claim costs no sql
+    """
+
+    def __init__(self,
+                 state_machine_dao: MemoryStateMachineDao,
+                 http_params_dao: MemoryHttpParamsDao,
+                 batch_size: int = 64,
+                 host_filters: Iterable = (),
+                 fair: bool = False,
+                 host_weights: Iterable[Tuple[str, int]] = ()):
+        """
+        :param state_machine_dao: in-memory dao of objects
+        :param http_params_dao: in-memory dao of http parameters
+        :param batch_size: count of objects claimed by next() at once
+        :param host_filters: see LoadContextManagerSQLite
+        :param fair: see LoadContextManagerSQLite
+        :param host_weights: see LoadContextManagerSQLite
+        """
+        super().__init__(
+            state_machine_dao,
+            http_params_dao,
+            claim=True,
+            batch_size=batch_size,
+            host_filters=host_filters,
+            fair=fair,
+            host_weights=host_weights,
+            hosts_refresh_ms=0
+        )
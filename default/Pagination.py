@@ -0,0 +1,337 @@
+import copy
+import json
+import time
+import uuid
+import fnmatch
+import threading
+from collections import OrderedDict
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, List, Iterable, Tuple, Callable
+
+from EntityLoader import LoadBehaviour, LoadResult, LoadContext
+from default.LoadContextManagerSQLite import request_fingerprint
+
+# namespace of uids of discovered resources, equal requests get equal uids
+_PAGE_NAMESPACE = uuid.UUID('5b0c6a52-8f0e-4d3c-9a43-2a3c8e7d1f60')
+
+
+def _select(value, path: str) -> list:
+    """
+    values of dotted path in json value, '*' steps over every item of list or object, numbers index lists
+    """
+    values = [value]
+    for step in path.split('.'):
+        selected = []
+        for item in values:
+            if step == '*':
+                if isinstance(item, list):
+                    selected.extend(item)
+                elif isinstance(item, dict):
+                    selected.extend(item.values())
+            elif isinstance(item, dict):
+                if step in item:
+                    selected.append(item[step])
+            elif isinstance(item, list) and step.isdigit() and int(step) < len(item):
+                selected.append(item[int(step)])
+        values = selected
+    return [item for item in values if item is not None]
+
+
+def _first(value, path: str):
+    values = _select(value, path)
+    return values[0] if values else None
+
+
+class PageRule(object):
+    """
+    where responses of resources matching pattern (fnmatch, e.g. 'https://api.example.com/items*') keep
+    their next page and linked resources, one way of finding next page is used:
+    - next_url: dotted path of absolute or relative url of next page in json body ('links.next');
+    - cursor: dotted path of cursor in json body, next page is the same resource with cursor_param set to it;
+    - link_header: url of next page is taken from Link header with rel="next";
+    - page_param: next page is the same resource with page_param incremented (from first_page),
+      while dotted path items is not empty.
+    children is dotted path of urls of linked resources ('data.*.url').
+    """
+
+    def __init__(self,
+                 pattern: str,
+                 next_url: Optional[str] = None,
+                 cursor: Optional[str] = None,
+                 cursor_param: str = 'cursor',
+                 link_header: bool = False,
+                 page_param: Optional[str] = None,
+                 items: Optional[str] = None,
+                 first_page: int = 1,
+                 children: Optional[str] = None):
+        assert pattern
+        assert sum((next_url is not None, cursor is not None, link_header, page_param is not None)) <= 1, \
+            'one way of finding next page is expected'
+        assert page_param is None or items, 'page_param requires items path'
+
+        self.Pattern = pattern
+        self.NextUrl = next_url
+        self.Cursor = cursor
+        self.CursorParam = cursor_param
+        self.LinkHeader = link_header
+        self.PageParam = page_param
+        self.Items = items
+        self.FirstPage = first_page
+        self.Children = children
+
+    @staticmethod
+    def from_dict(value: dict) -> 'PageRule':
+        return PageRule(**value)
+
+    def matches(self, resource: str) -> bool:
+        return fnmatch.fnmatchcase(resource, self.Pattern)
+
+
+def load_rules(path: str) -> List[PageRule]:
+    """
+    reads rules from json file: list of objects with arguments of PageRule,
+    e.g. [{"pattern": "https://api.example.com/items*", "cursor": "meta.next_cursor", "children": "data.*.href"}]
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return [PageRule.from_dict(value) for value in json.load(f)]
+
+
+class PaginatingLoadBehaviour(LoadBehaviour):
+    """
+    LoadBehaviour wrapper, which follows pagination of successful responses: next page and linked resources
+    found by the first PageRule matching resource are enqueued by importer in load, before the page gets
+    its state, with parent_uid of the page, its headers and priority. Failed import fails the page, so it is
+    loaded and its links are enqueued again.
+    Uid of discovered resource is derived from its request fingerprint, so importer skipping existing uids
+    (BulkImporter with dedup) enqueues every page once and cycles of links stop.
+
+    With prefetch_behaviour_factory next page is requested by prefetch thread right after its page was loaded,
+    and the load of next page takes that response if it came less than prefetch_ttl_ms ago.
+    Only this instance takes prefetched responses, so prefetch pays off when next page is claimed by the same
+    worker soon: there is one shard of objects and next pages are claimed before the rest of the queue
+    (next_page_priority above priorities of queued objects). Responses taken by nobody are counted
+    in prefetch_wasted.
+    Prefetched requests are not delayed by WaitBehaviour: tokens of host are still spent by the load
+    taking response, but the host sees requests earlier. Every prefetch thread loads by its own behaviour
+    made by prefetch_behaviour_factory, so behaviours must not share connections or caches with each other
+    or with loader (e.g. HttpLoadBehaviour with its own session pool).
+
+    Importer is used from loader thread, so every worker needs its own instance.
+    """
+
+    def __init__(self,
+                 load_behaviour: LoadBehaviour,
+                 rules: Iterable[PageRule],
+                 importer,
+                 prefetch_behaviour_factory: Optional[Callable[[], LoadBehaviour]] = None,
+                 prefetch_threads: int = 2,
+                 prefetch_ttl_ms: int = 60000,
+                 max_prefetched: int = 64,
+                 next_page_priority: Optional[int] = None):
+        """
+        :param load_behaviour: behaviour making actual loads
+        :param rules: rules of resources, the first matched rule is used
+        :param importer: object with import_entries(entries) returning ImportStats, e.g. BulkImporter
+        :param prefetch_behaviour_factory: makes behaviour loading next pages ahead in one prefetch thread,
+          None - no prefetch
+        :param prefetch_threads: count of simultaneous prefetched requests
+        :param prefetch_ttl_ms: how long prefetched response may be taken
+        :param max_prefetched: maximum count of kept prefetched responses, the oldest are dropped
+        :param next_page_priority: priority of next pages, None - priority of their page
+        """
+        assert load_behaviour
+        assert importer
+        assert prefetch_threads > 0
+        assert prefetch_ttl_ms > 0
+        assert max_prefetched > 0
+
+        self.__load_behaviour = load_behaviour
+        self.__rules = list(rules)  # type: List[PageRule]
+        self.__importer = importer
+        self.__prefetch_behaviour_factory = prefetch_behaviour_factory  # type: Optional[Callable[[], LoadBehaviour]]
+        self.__prefetch_local = threading.local()
+        self.__prefetch_threads = prefetch_threads  # type: int
+        self.__prefetch_ttl = prefetch_ttl_ms / 1000.0  # type: float
+        self.__max_prefetched = max_prefetched  # type: int
+        self.__next_page_priority = next_page_priority  # type: Optional[int]
+        self.__executor = None  # type: Optional[ThreadPoolExecutor]
+        self.__prefetched = OrderedDict()  # type: OrderedDict
+        self.discovered = 0  # type: int
+        self.prefetched = 0  # type: int
+        self.prefetch_hits = 0  # type: int
+        self.prefetch_wasted = 0  # type: int
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True, cancel_futures=True)
+            self.__executor = None
+        self.prefetch_wasted += len(self.__prefetched)
+        self.__prefetched.clear()
+
+    def load(self, obj: LoadContext) -> Optional[LoadResult]:
+        load_result = self.__take_prefetched(obj)
+        if load_result is None:
+            load_result = self.__load_behaviour.load(obj)
+
+        if load_result is not None and load_result.is_success():
+            rule = self.__rule_of(obj.Resource)
+            if rule is not None:
+                next_page, children = self.__discover(rule, obj, load_result)
+                entries = children if next_page is None else [next_page] + children
+                if entries:
+                    self.discovered += self.__importer.import_entries(entries).inserted
+                if next_page is not None and self.__prefetch_behaviour_factory is not None:
+                    self.__prefetch(next_page)
+
+        return load_result
+
+    def pre_load(self, obj: LoadContext):
+        self.__load_behaviour.pre_load(obj)
+
+    def handle_error(self, load_context: LoadContext, load_result: LoadResult, error_text: str):
+        self.__load_behaviour.handle_error(load_context, load_result, error_text)
+
+    def post_load(self, load_result: LoadResult):
+        self.__load_behaviour.post_load(load_result)
+
+    def __rule_of(self, resource: str) -> Optional[PageRule]:
+        for rule in self.__rules:
+            if rule.matches(resource):
+                return rule
+        return None
+
+    def __discover(self, rule: PageRule, obj: LoadContext, load_result: LoadResult) -> Tuple[Optional[dict], List[dict]]:
+        body = None
+        if rule.NextUrl or rule.Cursor or rule.PageParam or rule.Children:
+            try:
+                body = json.loads(load_result.resp_text_data or 'null')
+            except ValueError:
+                return None, []
+
+        priority = getattr(obj.LoadObject, 'priority', 0) or 0
+        next_page = self.__next_page(rule, obj, load_result, body)
+        if next_page is not None:
+            resource, params = next_page
+            next_page = self.__entry(obj, resource, params, priority if self.__next_page_priority is None else self.__next_page_priority)
+            if next_page['uid'] == self.__uid_of(obj.Resource, obj.params, obj.headers):
+                # page links itself
+                next_page = None
+
+        children = []
+        if rule.Children:
+            for url in _select(body, rule.Children):
+                if isinstance(url, str) and url:
+                    children.append(self.__entry(obj, urljoin(obj.Resource, url), None, priority))
+
+        return next_page, children
+
+    def __next_page(self, rule: PageRule, obj: LoadContext, load_result: LoadResult, body) -> Optional[Tuple[str, Optional[str]]]:
+        if rule.NextUrl:
+            url = _first(body, rule.NextUrl)
+            return (urljoin(obj.Resource, url), None) if isinstance(url, str) and url else None
+
+        if rule.LinkHeader:
+            links = getattr(load_result.result, 'links', None) or {}
+            url = links.get('next', {}).get('url')
+            return (urljoin(obj.Resource, url), None) if url else None
+
+        params = json.loads(obj.params) if obj.params else {}
+
+        if rule.Cursor:
+            cursor = _first(body, rule.Cursor)
+            if cursor in (None, '') or cursor == params.get(rule.CursorParam):
+                return None
+            params[rule.CursorParam] = cursor
+            return obj.Resource, json.dumps(params, ensure_ascii=False)
+
+        if rule.PageParam:
+            if not _first(body, rule.Items):
+                return None
+            params[rule.PageParam] = int(params.get(rule.PageParam, rule.FirstPage)) + 1
+            return obj.Resource, json.dumps(params, ensure_ascii=False)
+
+        return None
+
+    def __entry(self, obj: LoadContext, resource: str, params: Optional[str], priority: int) -> dict:
+        return {
+            'uid': self.__uid_of(resource, params, obj.headers),
+            'resource': resource,
+            'params': params,
+            'headers': obj.headers,
+            'priority': priority,
+            'parent_uid': str(obj.Uid)
+        }
+
+    def __uid_of(self, resource: str, params: Optional[str], headers: Optional[str]) -> str:
+        return str(uuid.uuid5(_PAGE_NAMESPACE, request_fingerprint(resource, params, headers)))
+
+    def __prefetch(self, entry: dict):
+        key = request_fingerprint(entry['resource'], entry['params'], entry['headers'])
+        if key in self.__prefetched:
+            return
+
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(
+                max_workers=self.__prefetch_threads,
+                thread_name_prefix='prefetch',
+                initializer=self.__init_prefetch_thread
+            )
+
+        now = time.monotonic()
+        while self.__prefetched and now - next(iter(self.__prefetched.values()))[0] > self.__prefetch_ttl:
+            self.__drop_oldest()
+        while len(self.__prefetched) >= self.__max_prefetched:
+            self.__drop_oldest()
+
+        load_context = LoadContext(uuid.UUID(entry['uid']), entry['resource'], entry['params'], entry['headers'], None, fingerprint=key)
+        self.__prefetched[key] = (now, self.__executor.submit(self.__prefetch_load, load_context))
+        self.prefetched += 1
+
+    def __init_prefetch_thread(self):
+        self.__prefetch_local.behaviour = self.__prefetch_behaviour_factory()
+
+    def __prefetch_load(self, load_context: LoadContext) -> Optional[LoadResult]:
+        return self.__prefetch_local.behaviour.load(load_context)
+
+    def __take_prefetched(self, obj: LoadContext) -> Optional[LoadResult]:
+        if not self.__prefetched:
+            return None
+
+        if obj.fingerprint is None:
+            obj.fingerprint = request_fingerprint(obj.Resource, obj.params, obj.headers)
+        item = self.__prefetched.pop(obj.fingerprint, None)
+        if item is None:
+            return None
+
+        submitted_at, future = item  # type: float, Future
+        if time.monotonic() - submitted_at > self.__prefetch_ttl:
+            future.cancel()
+            self.prefetch_wasted += 1
+            return None
+
+        try:
+            # response in flight is awaited, it comes earlier than a new one
+            load_result = future.result()
+        except Exception as e:
+            print(str(e))
+            self.prefetch_wasted += 1
+            return None
+        if load_result is None or not load_result.is_success():
+            self.prefetch_wasted += 1
+            return None
+
+        self.prefetch_hits += 1
+        load_result = copy.copy(load_result)
+        load_result.current_context = obj
+        return load_result
+
+    def __drop_oldest(self):
+        self.__prefetched.popitem(last=False)[1][1].cancel()
+        self.prefetch_wasted += 1
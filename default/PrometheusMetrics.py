@@ -0,0 +1,145 @@
+import os
+import bisect
+import threading
+from typing import Optional, Dict, Tuple, List, Iterable
+
+from Metrics import Metrics
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: Optional[str]) -> str:
+    if value is None:
+        return ''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Iterable[str], values: Iterable[Optional[str]]) -> str:
+    return ','.join(str.format('{0}="{1}"', name, _escape(value)) for name, value in zip(names, values))
+
+
+class _Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size: int):
+        self.counts = [0] * size  # type: List[int]
+        self.sum = 0.0  # type: float
+        self.count = 0  # type: int
+
+
+class PrometheusMetrics(Metrics):
+    """
+    keeps histograms of phase durations by phase and host and counters of loads by host, status and state,
+    exports them in prometheus text format. One instance may be shared by threads.
+
+    with dump_path set, open() starts a thread rewriting the file every dump_interval_ms
+    (atomically, so it can be read by node_exporter textfile collector), close() writes it the last time
+    """
+
+    def __init__(self,
+                 prefix: str = 'apicaller',
+                 buckets: Iterable[float] = DEFAULT_BUCKETS,
+                 dump_path: Optional[str] = None,
+                 dump_interval_ms: int = 10000):
+        """
+        :param prefix: prefix of metric names
+        :param buckets: upper bounds of histogram buckets in seconds
+        :param dump_path: file, which metrics are periodically written to, None - no dumps
+        :param dump_interval_ms: interval of dumps
+        """
+        self.__buckets = tuple(sorted(buckets))  # type: Tuple[float, ...]
+        assert self.__buckets
+        assert dump_interval_ms > 0
+
+        self.__prefix = prefix  # type: str
+        self.__dump_path = dump_path  # type: Optional[str]
+        self.__dump_interval = dump_interval_ms / 1000.0  # type: float
+        self.__histograms = {}  # type: Dict[Tuple[str, str], _Histogram]
+        self.__loads = {}  # type: Dict[Tuple[str, str, str], int]
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__dumper = None  # type: Optional[threading.Thread]
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        if self.__dump_path and self.__dumper is None:
+            self.__stop.clear()
+            self.__dumper = threading.Thread(target=self.__dump_periodically, name='metrics-dump', daemon=True)
+            self.__dumper.start()
+
+    def close(self):
+        if self.__dumper is not None:
+            self.__stop.set()
+            self.__dumper.join()
+            self.__dumper = None
+            self.dump(self.__dump_path)
+
+    def observe(self, phase: str, duration: float, host: Optional[str] = None):
+        key = (phase, host or '')
+        index = bisect.bisect_left(self.__buckets, duration)
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = _Histogram(len(self.__buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += duration
+            histogram.count += 1
+
+    def count(self, host: Optional[str], status: Optional[str], state: Optional[str]):
+        key = (host or '', str(status) if status is not None else '', state or '')
+        with self.__lock:
+            self.__loads[key] = self.__loads.get(key, 0) + 1
+
+    def to_prometheus(self) -> str:
+        """
+        :return: metrics in prometheus text exposition format
+        """
+        with self.__lock:
+            histograms = [(key, list(h.counts), h.sum, h.count) for key, h in sorted(self.__histograms.items())]
+            loads = sorted(self.__loads.items())
+
+        duration_name = self.__prefix + '_phase_duration_seconds'
+        loads_name = self.__prefix + '_loads_total'
+
+        lines = [
+            str.format('# HELP {0} duration of EntityLoader phases', duration_name),
+            str.format('# TYPE {0} histogram', duration_name)
+        ]
+        for key, counts, total, count in histograms:
+            labels = _labels(('phase', 'host'), key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.__buckets, counts):
+                cumulative += bucket_count
+                lines.append(str.format('{0}_bucket{{{1},le="{2!r}"}} {3}', duration_name, labels, bound, cumulative))
+            lines.append(str.format('{0}_bucket{{{1},le="+Inf"}} {2}', duration_name, labels, count))
+            lines.append(str.format('{0}_sum{{{1}}} {2!r}', duration_name, labels, total))
+            lines.append(str.format('{0}_count{{{1}}} {2}', duration_name, labels, count))
+
+        lines.append(str.format('# HELP {0} finished loads by host, response status and final state', loads_name))
+        lines.append(str.format('# TYPE {0} counter', loads_name))
+        for key, count in loads:
+            lines.append(str.format('{0}{{{1}}} {2}', loads_name, _labels(('host', 'status', 'state'), key), count))
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str):
+        """
+        atomically rewrites file with metrics in prometheus text format
+        """
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+    def __dump_periodically(self):
+        while not self.__stop.wait(self.__dump_interval):
+            try:
+                self.dump(self.__dump_path)
+            except Exception as e:
+                print(str(e))
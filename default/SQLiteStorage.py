@@ -0,0 +1,244 @@
+import sqlite3
+from typing import Optional, List, Tuple, Union
+
+from StateMachine import host_of
+
+# tables of sqlite.sql, created by migrate() if missing
+_TABLES = (
+    ('http_params', '''
+create table if not exists "http_params" (
+    "uid" text not null,
+    "resource" text not null,
+    "headers" text,
+    "params" text,
+    "fingerprint" text,
+    primary key("uid")
+)
+'''),
+    ('resource', '''
+create table if not exists "resource" (
+    "uid" text not null,
+    "resource" text not null,
+    "host" text,
+    "state" text not null,
+    "last_update" integer not null,
+    "last_attempt" integer,
+    "attempt_count" integer,
+    "version" integer not null,
+    "error" text,
+    "next_attempt_at" integer,
+    "lease_until" integer,
+    "worker_id" text,
+    "priority" integer not null default 0,
+    "parent_uid" text,
+    primary key("uid")
+)
+'''),
+    ('http_cache', '''
+create table if not exists "http_cache" (
+    "key" text not null,
+    "etag" text,
+    "last_modified" text,
+    "body" blob,
+    "body_digest" text,
+    "encoding" text,
+    "size" integer not null,
+    "last_access" integer not null,
+    primary key("key")
+)
+''')
+)
+
+# columns added to existing tables after their first version
+_COLUMNS = (
+    ('http_params', 'fingerprint', 'text'),
+    ('resource', 'host', 'text'),
+    ('resource', 'next_attempt_at', 'integer'),
+    ('resource', 'lease_until', 'integer'),
+    ('resource', 'worker_id', 'text'),
+    ('resource', 'priority', 'integer not null default 0'),
+    ('resource', 'parent_uid', 'text')
+)
+
+_INDEXES = (
+    ('ix_http_params_fingerprint', 'http_params', ('fingerprint', )),
+    ('ix_resource_state_next_attempt_at', 'resource', ('state', 'next_attempt_at')),
+    ('ix_resource_state_lease_until', 'resource', ('state', 'lease_until')),
+    ('ix_resource_state_priority_host_next_attempt_at', 'resource', ('state', 'priority', 'host', 'next_attempt_at')),
+    ('ix_resource_parent_uid', 'resource', ('parent_uid', )),
+    ('ix_http_cache_last_access', 'http_cache', ('last_access', ))
+)
+
+
+class SQLiteStorage(object):
+    """
+    one sqlite connection shared by dao's of one worker (pass it instead of connection string
+    to SQLiteStateMachineDao, HttpParamsDao and HttpValidatorCache), must be used from a single thread.
+
+    connection runs in WAL mode by default: readers do not block the writer, commit does not wait for fsync
+    of the database file (synchronous=normal is durable against crashes of process, not of OS).
+    sqlite3 module keeps up to cached_statements prepared statements keyed by sql text,
+    so dao's reuse them while their sql strings do not change.
+
+    open() and close() are counted: connection is opened by the first open() and closed by the last close(),
+    so every dao may open and close storage on its own.
+    """
+
+    def __init__(self,
+                 connection_string: str,
+                 journal_mode: str = 'wal',
+                 synchronous: str = 'normal',
+                 cache_size_kib: int = 64 * 1024,
+                 mmap_size: int = 256 * 1024 * 1024,
+                 busy_timeout_ms: int = 5000,
+                 cached_statements: int = 256,
+                 migrate: bool = False):
+        """
+        :param connection_string: path to sqlite database
+        :param journal_mode: value of "pragma journal_mode", None - keep mode of database
+        :param synchronous: value of "pragma synchronous": off, normal, full or extra
+        :param cache_size_kib: size of page cache of connection
+        :param mmap_size: maximum size of memory-mapped part of database file, 0 - no memory mapping
+        :param busy_timeout_ms: how long statement waits for locks of other connections
+        :param cached_statements: size of prepared statements cache of connection
+        :param migrate: run migrate() on open
+        """
+        assert connection_string
+        assert synchronous.lower() in ('off', 'normal', 'full', 'extra')
+        assert cache_size_kib > 0
+        assert mmap_size >= 0
+        assert busy_timeout_ms >= 0
+        assert cached_statements >= 0
+
+        self.__connection_string = connection_string  # type: str
+        self.__journal_mode = journal_mode  # type: Optional[str]
+        self.__synchronous = synchronous  # type: str
+        self.__cache_size_kib = cache_size_kib  # type: int
+        self.__mmap_size = mmap_size  # type: int
+        self.__busy_timeout = busy_timeout_ms / 1000.0  # type: float
+        self.__cached_statements = cached_statements  # type: int
+        self.__migrate = migrate  # type: bool
+        self.__connection = None  # type: Optional[sqlite3.Connection]
+        self.__users = 0  # type: int
+
+    @staticmethod
+    def of(storage: Union['SQLiteStorage', str]) -> 'SQLiteStorage':
+        """
+        :param storage: storage or path to sqlite database
+        :return: given storage or new storage of database
+        """
+        return storage if isinstance(storage, SQLiteStorage) else SQLiteStorage(storage)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        assert self.__connection, 'storage is not opened'
+        return self.__connection
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        if self.__connection is None:
+            connection = sqlite3.connect(
+                self.__connection_string,
+                timeout=self.__busy_timeout,
+                cached_statements=self.__cached_statements
+            )
+            try:
+                self.__apply_pragmas(connection)
+                self.__connection = connection
+                if self.__migrate:
+                    self.migrate()
+            except Exception:
+                self.__connection = None
+                connection.close()
+                raise
+        self.__users += 1
+
+    def close(self):
+        if self.__users == 0:
+            return
+        self.__users -= 1
+        if self.__users == 0:
+            if self.__connection.in_transaction:
+                self.__connection.commit()
+            self.__connection.close()
+            self.__connection = None
+
+    def pragmas(self) -> dict:
+        """
+        :return: pragmas set by storage as reported by sqlite
+        """
+        connection = self.connection
+        return {
+            name: connection.execute(str.format('pragma {0}', name)).fetchone()[0]
+            for name in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'busy_timeout')
+        }
+
+    def migrate(self) -> List[str]:
+        """
+        creates missing tables and indexes of sqlite.sql and adds columns missing in databases of older versions,
+        "host" of existing rows is filled when the column is added
+        :return: applied changes
+        """
+        connection = self.connection
+        applied = []  # type: List[str]
+
+        if connection.in_transaction:
+            connection.commit()
+        connection.execute('begin immediate')
+        try:
+            for table, sql in _TABLES:
+                if not self.__columns(table):
+                    connection.execute(sql)
+                    applied.append(str.format('create table {0}', table))
+
+            for table, column, definition in _COLUMNS:
+                if column not in self.__columns(table):
+                    connection.execute(str.format('alter table "{0}" add column "{1}" {2}', table, column, definition))
+                    applied.append(str.format('add column {0}.{1}', table, column))
+                    if (table, column) == ('resource', 'host'):
+                        self.__fill_hosts()
+
+            existing = {row[0] for row in connection.execute('select "name" from sqlite_master where "type" = \'index\'')}
+            for name, table, columns in _INDEXES:
+                if name not in existing:
+                    connection.execute(str.format(
+                        'create index "{0}" on "{1}" ({2})', name, table, ', '.join('"' + c + '"' for c in columns)
+                    ))
+                    applied.append(str.format('create index {0}', name))
+
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+        if applied:
+            connection.execute('analyze')
+        return applied
+
+    def __columns(self, table: str) -> List[str]:
+        return [row[1] for row in self.connection.execute(str.format('pragma table_info("{0}")', table))]
+
+    def __fill_hosts(self):
+        connection = self.connection
+        connection.create_function('host_of', 1, host_of, deterministic=True)
+        connection.execute('update "resource" set "host" = host_of("resource")')
+
+    def __apply_pragmas(self, connection: sqlite3.Connection):
+        pragmas = []  # type: List[Tuple[str, object]]
+        if self.__journal_mode:
+            pragmas.append(('journal_mode', self.__journal_mode))
+        pragmas.extend((
+            ('synchronous', self.__synchronous),
+            # negative cache_size is measured in KiB
+            ('cache_size', -self.__cache_size_kib),
+            ('mmap_size', self.__mmap_size),
+            ('busy_timeout', int(self.__busy_timeout * 1000))
+        ))
+        for name, value in pragmas:
+            connection.execute(str.format('pragma {0} = {1}', name, value)).fetchall()
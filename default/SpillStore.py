@@ -0,0 +1,244 @@
+import os
+import mmap
+import time
+import hashlib
+import tempfile
+from typing import Optional, Iterable, List, Set
+
+
+class Body(object):
+    """
+    lazy handle of response body
+    """
+
+    @property
+    def size(self) -> int:
+        raise NotImplemented()
+
+    def bytes(self) -> bytes:
+        raise NotImplemented()
+
+    def text(self, encoding: Optional[str] = None) -> str:
+        return self.bytes().decode(encoding or 'utf-8', errors='replace')
+
+
+class InlineBody(Body):
+    """
+    body kept in memory, used for bodies smaller than SpillStore's inline threshold
+    """
+    def __init__(self, data: bytes):
+        self.__data = data  # type: bytes
+
+    @property
+    def size(self) -> int:
+        return len(self.__data)
+
+    def bytes(self) -> bytes:
+        return self.__data
+
+
+class SpilledBody(Body):
+    """
+    body written to SpillStore, file is memory-mapped only when its data is requested
+    """
+    def __init__(self, path: str, digest: str, size: int):
+        self.__path = path  # type: str
+        self.__digest = digest  # type: str
+        self.__size = size  # type: int
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    @property
+    def digest(self) -> str:
+        """
+        sha256 of body, name of the file in SpillStore
+        """
+        return self.__digest
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    def map(self) -> mmap.mmap:
+        """
+        :return: read-only memory map of body, caller closes it
+        """
+        with open(self.__path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def bytes(self) -> bytes:
+        if self.__size == 0:
+            return b''
+        with self.map() as m:
+            return m[:]
+
+
+class SpillWriter(object):
+    """
+    accumulates chunks of one body, keeps them in memory until inline threshold is exceeded
+    """
+    def __init__(self, directory: str, inline_threshold: int):
+        self.__directory = directory  # type: str
+        self.__inline_threshold = inline_threshold  # type: int
+        self.__chunks = []  # type: List[bytes]
+        self.__size = 0  # type: int
+        self.__hash = hashlib.sha256()
+        self.__file = None
+
+    def write(self, chunk: bytes):
+        if not chunk:
+            return
+
+        self.__hash.update(chunk)
+        self.__size += len(chunk)
+
+        if self.__file is not None:
+            self.__file.write(chunk)
+            return
+
+        self.__chunks.append(chunk)
+        if self.__size > self.__inline_threshold:
+            self.__file = tempfile.NamedTemporaryFile(dir=self.__directory, prefix='.spill-', delete=False)
+            for buffered in self.__chunks:
+                self.__file.write(buffered)
+            self.__chunks = []
+
+    def close(self) -> Body:
+        if self.__file is None:
+            return InlineBody(b''.join(self.__chunks))
+
+        self.__file.close()
+        digest = self.__hash.hexdigest()
+        directory = os.path.join(self.__directory, digest[:2])
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, digest)
+
+        # content-addressed: equal bodies share one file
+        os.replace(self.__file.name, path)
+        self.__file = None
+
+        return SpilledBody(path, digest, self.__size)
+
+    def abort(self):
+        if self.__file is not None:
+            self.__file.close()
+            os.remove(self.__file.name)
+            self.__file = None
+        self.__chunks = []
+
+
+class SpillStore(object):
+    """
+    content-addressed directory of response bodies
+    bodies up to inline_threshold bytes stay in memory
+
+    spilled files are kept until delete() or collect() removes them: files are shared by equal bodies,
+    so the store can not know when a body is not needed anymore. With retention_ms, load behaviours call
+    collect_if_due() from post_load, which removes files written more than retention_ms ago and not kept
+    by HttpValidatorCache. Without it, the owner of the store must call collect() itself.
+    """
+    def __init__(self,
+                 directory: str,
+                 inline_threshold: int = 64 * 1024,
+                 chunk_size: int = 64 * 1024,
+                 retention_ms: Optional[int] = None):
+        """
+        :param directory: directory of spilled bodies, created if missed
+        :param inline_threshold: maximum size of body kept in memory
+        :param chunk_size: size of chunks read from response
+        :param retention_ms: how long spilled bodies are kept for their consumers (post_load),
+                             None - until collect() or delete() is called
+        """
+        assert directory
+        assert inline_threshold >= 0
+        assert chunk_size > 0
+        assert retention_ms is None or retention_ms > 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.__directory = directory  # type: str
+        self.__inline_threshold = inline_threshold  # type: int
+        self.__chunk_size = chunk_size  # type: int
+        self.__retention_ms = retention_ms  # type: Optional[int]
+        self.__collected_at = time.monotonic()  # type: float
+
+    @property
+    def chunk_size(self) -> int:
+        return self.__chunk_size
+
+    def writer(self) -> SpillWriter:
+        return SpillWriter(self.__directory, self.__inline_threshold)
+
+    def write(self, chunks: Iterable[bytes]) -> Body:
+        writer = self.writer()
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+        except Exception:
+            writer.abort()
+            raise
+        return writer.close()
+
+    def get(self, digest: str) -> Optional[SpilledBody]:
+        """
+        :param digest: sha256 of spilled body
+        :return: handle of spilled body, None if store has no such body
+        """
+        path = os.path.join(self.__directory, digest[:2], digest)
+        if not os.path.exists(path):
+            return None
+        return SpilledBody(path, digest, os.path.getsize(path))
+
+    def delete(self, digest: str) -> bool:
+        """
+        removes spilled body, bodies equal to it are removed too
+        :param digest: sha256 of spilled body
+        :return: True if body existed
+        """
+        try:
+            os.remove(os.path.join(self.__directory, digest[:2], digest))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def collect(self, keep: Iterable[str] = (), min_age_ms: int = 600000) -> int:
+        """
+        removes spilled bodies, which are not kept and were written more than min_age_ms ago,
+        and temporary files of interrupted writes
+        :param keep: digests of bodies, which must stay (e.g. HttpValidatorCache.digests())
+        :param min_age_ms: bodies of loads in flight are younger, rewritten equal body gets new age
+        :return: count of removed files
+        """
+        keep = set(keep)  # type: Set[str]
+        deadline = time.time() - min_age_ms / 1000.0
+        removed = 0
+
+        for root, _, files in os.walk(self.__directory):
+            for name in files:
+                if name in keep or not (name.startswith('.spill-') or len(name) == 64):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < deadline:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+
+        return removed
+
+    def collect_if_due(self, keep: Iterable[str] = ()) -> int:
+        """
+        runs collect() with min_age_ms = retention_ms at most every retention_ms / 2, does nothing without retention_ms
+        :param keep: digests of bodies, which must stay
+        :return: count of removed files
+        """
+        if self.__retention_ms is None:
+            return 0
+        now = time.monotonic()
+        if now - self.__collected_at < self.__retention_ms / 2000.0:
+            return 0
+        self.__collected_at = now
+        return self.collect(keep, self.__retention_ms)
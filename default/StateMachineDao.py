@@ -1,20 +1,117 @@
+import os
+import time
+import json
+import zlib
 import uuid
+import socket
 import sqlite3
 from datetime import datetime, timezone
-from typing import Optional
+from typing import Optional, List, Iterable, Tuple, Union
 
-from StateMachine import State, StateMachineDao
+from StateMachine import State, StateMachineDao, VersionConflictError
+from default.SQLiteStorage import SQLiteStorage
+
+
+def uid_shard(uid: str, shard_count: int) -> int:
+    """
+    stable shard of object, registered as sqlite function uid_shard(uid, shard_count)
+    """
+    return zlib.crc32(uid.encode('utf-8')) % shard_count
 
 
 class SQLiteStateMachineDao(StateMachineDao):
     """
     ATTENTION! UTC is required
+
+    group commit mode (group_commit_size > 1 or group_commit_interval_ms is set):
+    update() only buffers the transition, buffered transitions are written by executemany
+    in one transaction when the buffer reaches group_commit_size, when group_commit_interval_ms
+    passed since the oldest buffered transition (checked on update), on flush() and on close().
+    Buffered transitions are also written in the same transaction as the next create or claim,
+    and before any read of this dao.
+    Durability: transitions acknowledged by update() but not flushed yet are lost if the process dies,
+    such objects stay in the state of the last flushed transition (usually processing).
+
+    optimistic concurrency: update is applied only if row still has the version object was read with,
+    otherwise flush() raises VersionConflictError after committing other transitions
+    (conflicts of transitions written together with create or claim are only logged)
+
+    leases: claimed or updated processing object is leased by worker_id for lease_ms ("lease_until" column).
+    If worker dies or hangs, lease expires and claim (not more often than every reap_interval_ms)
+    moves such objects back to failed state: they are retried immediately,
+    or kept failed without next attempt when max_attempt_count attempts are made.
+    Processing rows without lease (written before leases were introduced) are never reaped.
     """
 
-    def __init__(self, connection_string):
-        self.__connection_string = connection_string  # type: str
+    __update_sql = '''
+update
+    "resource"
+set
+    "state" = :state
+    , "resource" = :resource
+    , "host" = :host
+    , attempt_count = :attempt_count
+    , last_attempt = :last_attempt
+    , "error" = :error
+    , last_update = :last_update
+    , "version" = :version
+    , next_attempt_at = :next_attempt_at
+    , lease_until = :lease_until
+    , worker_id = :worker_id
+    , "priority" = :priority
+where
+    "uid" = :uid
+    and "version" = :expected_version
+'''
+
+    def __init__(self,
+                 connection_string: Union[str, SQLiteStorage],
+                 group_commit_size: int = 1,
+                 group_commit_interval_ms: Optional[int] = None,
+                 shard_index: int = 0,
+                 shard_count: int = 1,
+                 lease_ms: int = 600000,
+                 reap_interval_ms: int = 10000,
+                 max_attempt_count: Optional[int] = None,
+                 worker_id: Optional[str] = None,
+                 change_poll_interval_ms: int = 50):
+        """
+        :param connection_string: path to sqlite database or storage shared with other dao's
+        :param group_commit_size: count of buffered transitions written by one transaction
+        :param group_commit_interval_ms: maximum age of buffered transition, None - no limit
+        :param shard_index: only objects with uid_shard(uid, shard_count) == shard_index are claimed
+        :param shard_count: count of shards, 1 - no sharding
+        :param lease_ms: how long processing object belongs to this dao, should exceed duration of load
+        :param reap_interval_ms: minimum interval between sweeps of expired leases made by claim
+        :param max_attempt_count: objects with expired lease are not retried after this count of attempts
+                                  (pass StateMachine's one), None - always retried
+        :param worker_id: owner of leases, host name and process id by default
+        :param change_poll_interval_ms: interval of "pragma data_version" polling by wait_for_change
+        """
+        assert group_commit_size > 0
+        assert group_commit_interval_ms is None or group_commit_interval_ms >= 0
+        assert 0 <= shard_index < shard_count
+        assert lease_ms > 0
+        assert reap_interval_ms >= 0
+        assert max_attempt_count is None or max_attempt_count > 0
+        assert change_poll_interval_ms > 0
+
+        self.__storage = SQLiteStorage.of(connection_string)  # type: SQLiteStorage
         self.__connection = None  # type: sqlite3.Connection
         self.__is_closed = False  # type: bool
+        self.__group_commit_size = group_commit_size  # type: int
+        self.__group_commit_interval = \
+            group_commit_interval_ms / 1000.0 if group_commit_interval_ms is not None else None  # type: Optional[float]
+        self.__pending = []  # type: List[dict]
+        self.__pending_since = None  # type: Optional[float]
+        self.__shard_index = shard_index  # type: int
+        self.__shard_count = shard_count  # type: int
+        self.__lease = lease_ms * 1000  # type: int
+        self.__reap_interval = reap_interval_ms / 1000.0  # type: float
+        self.__reaped_at = None  # type: Optional[float]
+        self.__max_attempt_count = max_attempt_count  # type: Optional[int]
+        self.__worker_id = worker_id or str.format('{0}:{1}', socket.gethostname(), os.getpid())  # type: str
+        self.__change_poll_interval = change_poll_interval_ms / 1000.0  # type: float
 
     def __enter__(self):
         self.open()
@@ -25,12 +122,65 @@ class SQLiteStateMachineDao(StateMachineDao):
 
     def open(self):
         if self.__connection is None:
-            self.__connection = sqlite3.connect(self.__connection_string)
+            self.__storage.open()
+            self.__connection = self.__storage.connection
+            self.__connection.create_function('uid_shard', 2, uid_shard, deterministic=True)
 
     def close(self):
         if self.__connection is not None and (not self.__is_closed):
-            self.__connection.close()
-            self.__is_closed = True
+            try:
+                self.flush()
+            finally:
+                self.__storage.close()
+                self.__is_closed = True
+
+    def flush(self):
+        """
+        writes buffered transitions and commits them
+        :raises VersionConflictError: some of transitions were not applied, because rows were changed by others
+        """
+        if self.__pending:
+            conflicts = self.__write_pending()
+            self.__connection.commit()
+            if conflicts:
+                raise VersionConflictError(conflicts)
+
+    def __write_pending(self) -> List[uuid.UUID]:
+        if not self.__pending:
+            return []
+
+        pending = self.__pending
+        self.__pending = []
+        self.__pending_since = None
+
+        if len(pending) == 1:
+            if self.__connection.execute(self.__update_sql, pending[0]).rowcount == 1:
+                return []
+            return [uuid.UUID(pending[0]['uid'])]
+
+        if not self.__connection.in_transaction:
+            self.__connection.execute('begin')
+        self.__connection.execute('savepoint pending')
+
+        cursor = self.__connection.executemany(self.__update_sql, pending)
+        if cursor.rowcount == len(pending):
+            self.__connection.execute('release pending')
+            return []
+
+        # some rows were changed by others: repeat row by row to find them
+        self.__connection.execute('rollback to pending')
+        conflicts = []
+        for args in pending:
+            if self.__connection.execute(self.__update_sql, args).rowcount == 0:
+                conflicts.append(uuid.UUID(args['uid']))
+        self.__connection.execute('release pending')
+
+        return conflicts
+
+    def __write_pending_logged(self):
+        conflicts = self.__write_pending()
+        if conflicts:
+            print(str.format('version conflict: {0}', ', '.join(uid.urn for uid in conflicts)))
 
     def __to_int_timestamp(self, value: Optional[datetime]) -> Optional[int]:
         if not value:
@@ -42,44 +192,54 @@ class SQLiteStateMachineDao(StateMachineDao):
             return None
         return datetime.fromtimestamp(value / 1000000.0, timezone.utc)
 
+    def __to_state(self, row) -> State:
+        return State(
+            uuid.UUID(row[0])
+            , row[1]
+            , row[2]
+            , row[3]
+            , self.__from_int_timestamp(row[4])
+            , row[5]
+            , self.__from_int_timestamp(row[6])
+            , row[7]
+            , self.__from_int_timestamp(row[8])
+            , row[9]
+        )
+
     def update(self, obj: State) -> State:
         assert obj
         assert self.__connection
 
-        sql = '''
-update
-    "resource"
-set
-    "state" = :state
-    , "resource" = :resource
-    , attempt_count = :attempt_count
-    , last_attempt = :last_attempt
-    , "error" = :error
-    , last_update = :last_update
-    , "version" = :version
-where
-    "uid" = :uid
-'''
-
         obj.last_update = datetime.now(timezone.utc)
         obj.version += 1
+        leased = obj.state == State.PROCESSING
 
         args = {
-            'state': obj.state
+            'expected_version': obj.version - 1
+            , 'state': obj.state
             , 'resource': obj.resource
+            , 'host': obj.host
             , 'attempt_count': obj.attempt_count
             , 'last_attempt': self.__to_int_timestamp(obj.last_attempt)
             , 'error': obj.error
             , 'last_update': self.__to_int_timestamp(obj.last_update)
             , 'version': obj.version
+            , 'next_attempt_at': self.__to_int_timestamp(obj.next_attempt_at)
+            , 'lease_until': self.__to_int_timestamp(obj.last_update) + self.__lease if leased else None
+            , 'worker_id': self.__worker_id if leased else None
+            , 'priority': obj.priority
             , 'uid': obj.uid.urn
         }
-        cur = self.__connection.execute(sql, args)
 
-        # todo: check updated
-        updated = cur.rowcount
+        if self.__pending_since is None:
+            self.__pending_since = time.monotonic()
+        self.__pending.append(args)
+
+        if len(self.__pending) >= self.__group_commit_size or (
+                self.__group_commit_interval is not None
+                and time.monotonic() - self.__pending_since >= self.__group_commit_interval):
+            self.flush()
 
-        self.__connection.commit()
         return obj
 
     def create(self, obj: State) -> State:
@@ -89,9 +249,9 @@ where
         sql = '''
 insert into
     "resource"
-("uid", "resource", "state", attempt_count, last_attempt, "error", last_update, "version")
+("uid", "resource", "host", "state", attempt_count, last_attempt, "error", last_update, "version", next_attempt_at, "priority")
 values
-(:uid, :resource, :state, :attempt_count, :last_attempt, :error, :last_update, :version)
+(:uid, :resource, :host, :state, :attempt_count, :last_attempt, :error, :last_update, :version, :next_attempt_at, :priority)
 '''
 
         obj.version = 1
@@ -100,13 +260,17 @@ values
         args = {
             'uid': obj.uid.urn
             , 'resource': obj.resource
+            , 'host': obj.host
             , 'state': obj.state
             , 'attempt_count': obj.attempt_count
             , 'last_attempt': self.__to_int_timestamp(obj.last_attempt)
             , 'error': obj.error
             , 'last_update': self.__to_int_timestamp(obj.last_update)
             , 'version': obj.version
+            , 'next_attempt_at': self.__to_int_timestamp(obj.next_attempt_at)
+            , 'priority': obj.priority
         }
+        self.__write_pending_logged()
         cur = self.__connection.execute(sql, args)
 
         # todo: check updated
@@ -116,7 +280,7 @@ values
 
         return obj
 
-    def by_uid(self, uid) -> State:
+    def by_uid(self, uid) -> Optional[State]:
         sql = '''
 select
     "uid"
@@ -127,30 +291,26 @@ select
     , "error"
     , last_update
     , "version"
+    , next_attempt_at
+    , "priority"
 from
     "resource"
 where
     "uid" = :uid
 '''
         args = {
-            'uid': str(uid)
+            'uid': uid.urn if isinstance(uid, uuid.UUID) else str(uid)
         }
+        self.flush()
         cursor = self.__connection.execute(sql, args)
 
         row = cursor.fetchone()
-
-        state = State(
-            uuid.UUID(row[0])
-            , row[1]
-            , row[2]
-            , row[3]
-            , self.__from_int_timestamp(row[4])
-            , row[5]
-            , self.__from_int_timestamp(row[6])
-            , row[7]
-        )
         cursor.close()
-        return state
+
+        if row is None:
+            return None
+
+        return self.__to_state(row)
 
     def delete(self, obj: State) -> bool:
         raise NotImplemented()
@@ -166,37 +326,487 @@ select
     , "error"
     , last_update
     , "version"
+    , next_attempt_at
+    , "priority"
 from
     "resource"
 where
     "state" = :created_state
+    and "priority" = :priority
+union all
+select
+    "uid"
+    , "resource"
+    , "state"
+    , attempt_count
+    , last_attempt
+    , "error"
+    , last_update
+    , "version"
+    , next_attempt_at
+    , "priority"
+from
+    "resource"
+where
+    "state" = :failed_state
+    and "priority" = :priority
+    and next_attempt_at <= :now
+limit 1
 '''
-        # or
-        # (
-        #     "state" =:failed_state
-        # and
-        # attempt_count <:max_attempt_count
-        # )
+        self.flush()
+        now = self.__to_int_timestamp(datetime.now(timezone.utc))
+        priority = self.__top_priority(now, (), False)
+        if priority is None:
+            return None
 
         args = {
             'created_state': State.CREATED,
             'failed_state': State.FAILED,
-            'max_attempt_count': 4
+            'priority': priority,
+            'now': now
         }
 
         cursor = self.__connection.execute(sql, args)
 
         row = cursor.fetchone()
-        state = State(
-            uuid.UUID(row[0])
-            , row[1]
-            , row[2]
-            , row[3]
-            , self.__from_int_timestamp(row[4])
-            , row[5]
-            , self.__from_int_timestamp(row[6])
-            , row[7]
-        )
+        if row is None:
+            cursor.close()
+            return None
+
+        state = self.__to_state(row)
         cursor.close()
         return state
 
+    def claim_unsuccessful(self, exclude_hosts: Iterable[str] = ()) -> Optional[State]:
+        claimed = self.claim_batch(1, exclude_hosts)
+        return claimed[0] if claimed else None
+
+    # objects of other hosts than excluded ones
+    __other_hosts_sql = '("host" is null or "host" not in (select value from json_each(:exclude_hosts)))'
+
+    # objects of the host
+    __host_sql = '"host" is :host'
+
+    __claim_sql = '''
+update
+    "resource"
+set
+    "state" = :processing_state
+    , attempt_count = coalesce(attempt_count, 0) + 1
+    , last_attempt = :now
+    , last_update = :now
+    , "version" = "version" + 1
+    , next_attempt_at = null
+    , "error" = null
+    , lease_until = :lease_until
+    , worker_id = :worker_id
+where
+    "uid" in (
+        select
+            "uid"
+        from
+            "resource"
+        where
+            "state" = :failed_state
+            and "priority" = :priority
+            and next_attempt_at <= :now
+            and {0}
+            and (:shard_count = 1 or uid_shard("uid", :shard_count) = :shard_index)
+        union all
+        select
+            "uid"
+        from
+            "resource"
+        where
+            "state" = :created_state
+            and "priority" = :priority
+            and {0}
+            and (:shard_count = 1 or uid_shard("uid", :shard_count) = :shard_index)
+        limit :limit
+    )
+returning
+    "uid"
+    , "resource"
+    , "state"
+    , attempt_count
+    , last_attempt
+    , "error"
+    , last_update
+    , "version"
+    , next_attempt_at
+    , "priority"
+'''
+
+    def claim_batch(self, limit: int, exclude_hosts: Iterable[str] = ()) -> List[State]:
+        """
+        single update ... returning statement (sqlite 3.35+), so concurrent connections never claim the same row
+        objects are claimed from the highest priority band only, the band is found by
+        ix_resource_state_priority_host_next_attempt_at index
+        """
+        assert self.__connection
+        assert limit > 0
+
+        self.__reap_if_due()
+
+        exclude_hosts = list(exclude_hosts)
+        now = self.__to_int_timestamp(datetime.now(timezone.utc))
+        priority = self.__top_priority(now, exclude_hosts, True)
+        if priority is None:
+            self.__write_pending_logged()
+            self.__connection.commit()
+            return []
+
+        return self.__claim(
+            self.__claim_sql.format(self.__other_hosts_sql),
+            {'exclude_hosts': json.dumps(exclude_hosts)},
+            now,
+            priority,
+            limit
+        )
+
+    def claim_host_batch(self, host: Optional[str], limit: int, priority: int) -> List[State]:
+        assert self.__connection
+        assert limit > 0
+
+        self.__reap_if_due()
+
+        return self.__claim(
+            self.__claim_sql.format(self.__host_sql),
+            {'host': host},
+            self.__to_int_timestamp(datetime.now(timezone.utc)),
+            priority,
+            limit
+        )
+
+    def claimable_hosts(self, exclude_hosts: Iterable[str] = ()) -> Tuple[Optional[int], List[Optional[str]]]:
+        """
+        hosts are enumerated by loose index scan of ix_resource_state_priority_host_next_attempt_at:
+        one index search per host instead of scan of all rows of the band.
+        Only objects of shard of this dao are taken into account
+        """
+        assert self.__connection
+
+        exclude_hosts = set(exclude_hosts)
+        now = self.__to_int_timestamp(datetime.now(timezone.utc))
+        priority = self.__top_priority(now, exclude_hosts, True)
+        if priority is None:
+            return None, []
+
+        sql = '''
+with recursive
+    "created_hosts"("host") as (
+        select
+            min("host")
+        from
+            "resource"
+        where
+            "state" = :created_state
+            and "priority" = :priority
+            and (:shard_count = 1 or uid_shard("uid", :shard_count) = :shard_index)
+        union all
+        select
+            (
+                select
+                    min(r."host")
+                from
+                    "resource" r
+                where
+                    r."state" = :created_state
+                    and r."priority" = :priority
+                    and r."host" > h."host"
+                    and (:shard_count = 1 or uid_shard(r."uid", :shard_count) = :shard_index)
+            )
+        from
+            "created_hosts" h
+        where
+            h."host" is not null
+    ),
+    "failed_hosts"("host") as (
+        select
+            min("host")
+        from
+            "resource"
+        where
+            "state" = :failed_state
+            and "priority" = :priority
+            and next_attempt_at <= :now
+            and (:shard_count = 1 or uid_shard("uid", :shard_count) = :shard_index)
+        union all
+        select
+            (
+                select
+                    min(r."host")
+                from
+                    "resource" r
+                where
+                    r."state" = :failed_state
+                    and r."priority" = :priority
+                    and r."host" > h."host"
+                    and r.next_attempt_at <= :now
+                    and (:shard_count = 1 or uid_shard(r."uid", :shard_count) = :shard_index)
+            )
+        from
+            "failed_hosts" h
+        where
+            h."host" is not null
+    )
+select "host" from "created_hosts" where "host" is not null
+union
+select "host" from "failed_hosts" where "host" is not null
+'''
+        without_host_sql = '''
+select
+    exists(
+        select 1 from "resource" where "state" = :created_state and "priority" = :priority and "host" is null
+            and (:shard_count = 1 or uid_shard("uid", :shard_count) = :shard_index)
+    )
+    or exists(
+        select 1 from "resource" where "state" = :failed_state and "priority" = :priority and "host" is null
+            and next_attempt_at <= :now
+            and (:shard_count = 1 or uid_shard("uid", :shard_count) = :shard_index)
+    )
+'''
+        args = {
+            'created_state': State.CREATED,
+            'failed_state': State.FAILED,
+            'priority': priority,
+            'now': now,
+            'shard_index': self.__shard_index,
+            'shard_count': self.__shard_count
+        }
+
+        cursor = self.__connection.execute(sql, args)
+        hosts = [row[0] for row in cursor if row[0] not in exclude_hosts]  # type: List[Optional[str]]
+        cursor.close()
+
+        cursor = self.__connection.execute(without_host_sql, args)
+        if cursor.fetchone()[0]:
+            hosts.append(None)
+        cursor.close()
+
+        return priority, hosts
+
+    def __top_priority(self, now: int, exclude_hosts: Iterable[str], by_shard: bool) -> Optional[int]:
+        sql = '''
+select
+    max("priority")
+from (
+    select
+        "priority"
+    from
+        "resource"
+    where
+        "state" = :created_state
+        and {0}
+        and (:shard_count = 1 or uid_shard("uid", :shard_count) = :shard_index)
+    order by
+        "priority" desc
+    limit 1
+) union all select
+    max("priority")
+from (
+    select
+        "priority"
+    from
+        "resource"
+    where
+        "state" = :failed_state
+        and next_attempt_at <= :now
+        and {0}
+        and (:shard_count = 1 or uid_shard("uid", :shard_count) = :shard_index)
+    order by
+        "priority" desc
+    limit 1
+)
+'''.format(self.__other_hosts_sql)
+        args = {
+            'created_state': State.CREATED,
+            'failed_state': State.FAILED,
+            'now': now,
+            'exclude_hosts': json.dumps(list(exclude_hosts)),
+            'shard_index': self.__shard_index,
+            'shard_count': self.__shard_count if by_shard else 1
+        }
+
+        cursor = self.__connection.execute(sql, args)
+        priorities = [row[0] for row in cursor if row[0] is not None]
+        cursor.close()
+
+        return max(priorities) if priorities else None
+
+    def __claim(self, sql: str, args: dict, now: int, priority: int, limit: int) -> List[State]:
+        args.update({
+            'processing_state': State.PROCESSING,
+            'created_state': State.CREATED,
+            'failed_state': State.FAILED,
+            'now': now,
+            'lease_until': now + self.__lease,
+            'worker_id': self.__worker_id,
+            'priority': priority,
+            'shard_index': self.__shard_index,
+            'shard_count': self.__shard_count,
+            'limit': limit
+        })
+
+        self.__write_pending_logged()
+        cursor = self.__connection.execute(sql, args)
+        rows = cursor.fetchall()
+        cursor.close()
+        self.__connection.commit()
+
+        return [self.__to_state(row) for row in rows]
+
+    def __reap_if_due(self):
+        if self.__reaped_at is None or time.monotonic() - self.__reaped_at >= self.__reap_interval:
+            self.reap_expired_leases()
+
+    def has_unsuccessful(self) -> bool:
+        """
+        only objects of shard of this dao are taken into account,
+        exhausted failed objects have no next_attempt_at
+        """
+        assert self.__connection
+
+        sql = '''
+select
+    exists(
+        select 1 from "resource" where "state" = :created_state
+            and (:shard_count = 1 or uid_shard("uid", :shard_count) = :shard_index)
+    )
+    or exists(
+        select 1 from "resource" where "state" = :failed_state and next_attempt_at is not null
+            and (:shard_count = 1 or uid_shard("uid", :shard_count) = :shard_index)
+    )
+'''
+        args = {
+            'created_state': State.CREATED,
+            'failed_state': State.FAILED,
+            'shard_index': self.__shard_index,
+            'shard_count': self.__shard_count
+        }
+
+        # buffered failed transitions may be the only objects left
+        if self.__pending:
+            self.__write_pending_logged()
+            self.__connection.commit()
+
+        cursor = self.__connection.execute(sql, args)
+        result = bool(cursor.fetchone()[0])
+        cursor.close()
+        return result
+
+    def reap_expired_leases(self) -> int:
+        assert self.__connection
+
+        sql = '''
+update
+    "resource"
+set
+    "state" = :failed_state
+    , "error" = :error
+    , last_update = :now
+    , "version" = "version" + 1
+    , next_attempt_at = case
+        when :max_attempt_count is null or coalesce(attempt_count, 0) < :max_attempt_count then :now
+        else null
+    end
+    , lease_until = null
+    , worker_id = null
+where
+    "state" = :processing_state
+    and lease_until <= :now
+'''
+        args = {
+            'failed_state': State.FAILED,
+            'processing_state': State.PROCESSING,
+            'error': 'lease expired',
+            'now': self.__to_int_timestamp(datetime.now(timezone.utc)),
+            'max_attempt_count': self.__max_attempt_count
+        }
+
+        self.__write_pending_logged()
+        reaped = self.__connection.execute(sql, args).rowcount
+        self.__connection.commit()
+        self.__reaped_at = time.monotonic()
+
+        if reaped:
+            print(str.format('{0} objects with expired lease are moved to failed state', reaped))
+
+        return reaped
+
+    def release(self, objects: Iterable[State]) -> int:
+        """
+        objects with the only (released) attempt become created again, others become failed and due now
+        """
+        assert self.__connection
+
+        sql = '''
+update
+    "resource"
+set
+    "state" = case when coalesce(attempt_count, 0) <= 1 then :created_state else :failed_state end
+    , attempt_count = max(coalesce(attempt_count, 0) - 1, 0)
+    , next_attempt_at = case when coalesce(attempt_count, 0) <= 1 then null else :now end
+    , last_update = :now
+    , "version" = "version" + 1
+    , lease_until = null
+    , worker_id = null
+where
+    "uid" = :uid
+    and "version" = :version
+    and "state" = :processing_state
+'''
+        now = self.__to_int_timestamp(datetime.now(timezone.utc))
+        args = [
+            {
+                'uid': obj.uid.urn
+                , 'version': obj.version
+                , 'created_state': State.CREATED
+                , 'failed_state': State.FAILED
+                , 'processing_state': State.PROCESSING
+                , 'now': now
+            }
+            for obj in objects
+        ]
+        if not args:
+            return 0
+
+        self.__write_pending_logged()
+        released = self.__connection.executemany(sql, args).rowcount
+        self.__connection.commit()
+
+        return released
+
+    def wait_for_change(self, timeout: float, stop=None) -> bool:
+        """
+        polls "pragma data_version", which changes when other connections commit
+        """
+        assert self.__connection
+
+        if self.__pending:
+            # conflicts are reported only, idle loader must not fail on them
+            self.__write_pending_logged()
+            self.__connection.commit()
+        data_version = self.__data_version()
+        deadline = time.monotonic() + timeout
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            interval = min(remaining, self.__change_poll_interval)
+            if stop is not None:
+                if stop.wait(interval):
+                    return False
+            else:
+                time.sleep(interval)
+
+            if self.__data_version() != data_version:
+                return True
+
+    def __data_version(self) -> int:
+        cursor = self.__connection.execute('pragma data_version')
+        data_version = cursor.fetchone()[0]
+        cursor.close()
+        return data_version
@@ -1,33 +1,152 @@
+import os
+import argparse
+import functools
+import contextlib
+from typing import Optional
+
+from default.SQLiteStorage import SQLiteStorage
 from default.StateMachineDao import SQLiteStateMachineDao
 from default.LoadContextManagerSQLite import LoadContextManagerSQLite, HttpParamsDao
-from default.HttpLoadBehaviour import HttpLoadBehaviour, SimpleWaitBehaviour
+from default.HttpLoadBehaviour import HttpLoadBehaviour, SimpleWaitBehaviour, TokenBucketWaitBehaviour
+from default.PrometheusMetrics import PrometheusMetrics
+from default.CircuitBreaker import CircuitBreaker
+from default.BulkImporter import BulkImporter
+from default.Pagination import PaginatingLoadBehaviour, load_rules
 
 from EntityLoader import EntityLoader
-from StateMachine import State, StateMachine
+from StateMachine import StateMachine
+from Runner import ShardedProcessRunner
+
+
+@contextlib.contextmanager
+def build_loader(conn_string: str,
+                 max_attempt_count: int,
+                 wait_ms: int,
+                 rate: Optional[float],
+                 burst: int,
+                 batch_size: int,
+                 group_commit_size: int,
+                 lease_ms: int,
+                 metrics_dir: Optional[str],
+                 fair: bool,
+                 circuit_breaker: bool,
+                 page_rules: Optional[str],
+                 prefetch_threads: int,
+                 next_page_priority: Optional[int],
+                 shard_index: int,
+                 shard_count: int):
+    """
+    opens dao's of the shard sharing one connection and yields EntityLoader, called inside of worker process
+    """
+    storage = SQLiteStorage(conn_string)
+    with SQLiteStateMachineDao(
+            storage,
+            group_commit_size=group_commit_size,
+            shard_index=shard_index,
+            shard_count=shard_count,
+            lease_ms=lease_ms,
+            max_attempt_count=max_attempt_count
+    ) as dao:  # type: SQLiteStateMachineDao
+        with HttpParamsDao(storage) as http_dao, PrometheusMetrics(
+                dump_path=os.path.join(metrics_dir, str.format('loader-{0}.prom', shard_index)) if metrics_dir else None
+        ) as metrics:
+
+            if rate:
+                wait_behaviour = TokenBucketWaitBehaviour(rate, burst)
+                host_filters = (wait_behaviour, )
+            else:
+                wait_behaviour = SimpleWaitBehaviour(wait_ms)
+                host_filters = ()
+
+            listeners = ()
+            if circuit_breaker:
+                breaker = CircuitBreaker()
+                host_filters += (breaker, )
+                listeners = (breaker, )
+
+            context_manager = LoadContextManagerSQLite(
+                dao,
+                http_dao,
+                claim=True,
+                batch_size=batch_size,
+                host_filters=host_filters,
+                fair=fair
+            )
+            state_machine = StateMachine(max_attempt_count=max_attempt_count, dao=dao)
+            load_behaviour = HttpLoadBehaviour()
 
-# state = State(
-#     uid=uuid.uuid4()
-#     , resource='some resource'
-#     , state=State.CREATED
-#     , attempt_count=0
-# )
+            if not page_rules:
+                yield EntityLoader(context_manager, load_behaviour, wait_behaviour, state_machine, metrics, listeners)
+                return
 
-conn_string = 'C:\\Users\\User\\PycharmProjects\\ApiCaller\\loader.db'
+            with BulkImporter(storage) as importer, PaginatingLoadBehaviour(
+                    load_behaviour,
+                    load_rules(page_rules),
+                    importer,
+                    prefetch_behaviour_factory=HttpLoadBehaviour if prefetch_threads else None,
+                    prefetch_threads=max(prefetch_threads, 1),
+                    next_page_priority=next_page_priority
+            ) as paginating_behaviour:
+                yield EntityLoader(context_manager, paginating_behaviour, wait_behaviour, state_machine, metrics, listeners)
 
-exists_state_uid = 'urn:uuid:06f18e09-24f8-4aa3-a710-eb27203e0e9b'
 
-with SQLiteStateMachineDao(conn_string) as dao:  # type: SQLiteStateMachineDao
-    with HttpParamsDao(conn_string) as http_dao:
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='loads resources of sqlite database by several sharded processes')
+    parser.add_argument('--db', required=True, help='path to sqlite database')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='count of worker processes (shards)')
+    parser.add_argument('--max-attempts', type=int, default=4, help='maximum count of attempts of one resource')
+    parser.add_argument('--wait-ms', type=int, default=1500, help='minimum duration of one load, ignored with --rate')
+    parser.add_argument('--rate', type=float, default=None, help='loads per second for one host of one worker')
+    parser.add_argument('--burst', type=int, default=1, help='loads, which one host may get at once, requires --rate')
+    parser.add_argument('--batch-size', type=int, default=16, help='count of resources claimed at once')
+    parser.add_argument('--group-commit-size', type=int, default=16, help='count of state transitions committed at once')
+    parser.add_argument('--lease-ms', type=int, default=600000, help='resources of dead workers are retried after this time')
+    parser.add_argument('--fair', action='store_true', help='round-robin over hosts of the highest priority')
+    parser.add_argument('--circuit-breaker', action='store_true', help='skip hosts failing most of recent loads')
+    parser.add_argument('--page-rules', default=None, help='json file of pagination rules, next pages and linked resources are enqueued')
+    parser.add_argument('--prefetch-threads', type=int, default=0, help='threads loading next pages ahead, requires --page-rules and --processes 1')
+    parser.add_argument('--next-page-priority', type=int, default=None, help='priority of next pages, default - priority of their page')
+    parser.add_argument('--metrics-dir', default=None, help='directory of prometheus text files, one per worker')
+    parser.add_argument('--report-interval-ms', type=int, default=10000)
+    parser.add_argument('--exit-when-empty', action='store_true', help='stop, when there are neither created resources nor failed ones with attempts left')
+    args = parser.parse_args(argv)
 
-        context_manager = LoadContextManagerSQLite(dao, http_dao)
-        state_machine = StateMachine(max_attempt_count=4, dao=dao)
-        load_behaviour = HttpLoadBehaviour()
-        wait_behaviour = SimpleWaitBehaviour(1500)
+    if args.prefetch_threads and args.processes > 1:
+        # next page usually belongs to another shard, its prefetched response would be taken by nobody
+        parser.error('--prefetch-threads requires --processes 1')
 
-        loader = EntityLoader(context_manager, load_behaviour, wait_behaviour, state_machine)
+    # once before workers start, concurrent alter table statements of workers would fail
+    with SQLiteStorage(args.db) as storage:
+        for change in storage.migrate():
+            print(change)
 
-        loaded = loader.load()
+    loader_factory = functools.partial(
+        build_loader,
+        args.db,
+        args.max_attempts,
+        args.wait_ms,
+        args.rate,
+        args.burst,
+        args.batch_size,
+        args.group_commit_size,
+        args.lease_ms,
+        args.metrics_dir,
+        args.fair,
+        args.circuit_breaker,
+        args.page_rules,
+        args.prefetch_threads,
+        args.next_page_priority
+    )
 
-        print(loaded.result.text)
+    runner = ShardedProcessRunner(
+        loader_factory,
+        processes=args.processes,
+        batch_size=args.batch_size,
+        report_interval_ms=args.report_interval_ms,
+        exit_when_empty=args.exit_when_empty
+    )
+    runner.run()
 
 
+if __name__ == '__main__':
+    main()
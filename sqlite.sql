@@ -3,17 +3,65 @@ CREATE TABLE "http_params" (
 	"resource"	text NOT NULL,
 	"headers"	text,
 	"params"	text,
+	"fingerprint"	text,
 	PRIMARY KEY("uid")
 );
 
+CREATE INDEX "ix_http_params_fingerprint" ON "http_params" (
+	"fingerprint"
+);
+
 CREATE TABLE "resource" (
 	"uid"	TEXT NOT NULL,
 	"resource"	TEXT NOT NULL,
+	"host"	TEXT,
 	"state"	TEXT NOT NULL,
 	"last_update"	INTEGER NOT NULL,
 	"last_attempt"	INTEGER,
 	"attempt_count"	INTEGER,
 	"version"	INTEGER NOT NULL,
 	"error"	TEXT,
+	"next_attempt_at"	INTEGER,
+	"lease_until"	INTEGER,
+	"worker_id"	TEXT,
+	"priority"	INTEGER NOT NULL DEFAULT 0,
+	"parent_uid"	TEXT,
 	PRIMARY KEY("uid")
 );
+
+CREATE INDEX "ix_resource_state_next_attempt_at" ON "resource" (
+	"state",
+	"next_attempt_at"
+);
+
+CREATE INDEX "ix_resource_state_lease_until" ON "resource" (
+	"state",
+	"lease_until"
+);
+
+CREATE INDEX "ix_resource_state_priority_host_next_attempt_at" ON "resource" (
+	"state",
+	"priority",
+	"host",
+	"next_attempt_at"
+);
+
+CREATE INDEX "ix_resource_parent_uid" ON "resource" (
+	"parent_uid"
+);
+
+CREATE TABLE "http_cache" (
+	"key"	TEXT NOT NULL,
+	"etag"	TEXT,
+	"last_modified"	TEXT,
+	"body"	BLOB,
+	"body_digest"	TEXT,
+	"encoding"	TEXT,
+	"size"	INTEGER NOT NULL,
+	"last_access"	INTEGER NOT NULL,
+	PRIMARY KEY("key")
+);
+
+CREATE INDEX "ix_http_cache_last_access" ON "http_cache" (
+	"last_access"
+);